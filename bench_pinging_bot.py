@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Micro-benchmarks of the PingingBot hot paths.
+
+    Run all the benchmarks with `python bench_pinging_bot.py` or just some of
+    them with `python bench_pinging_bot.py parse_time ...`. The e2e benchmark
+    drives the whole bot against a local fake Zulip server and saves its
+    results to bench_results.json, to be diffed between commits.
+"""
+
+from __future__ import unicode_literals
+import bisect
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import arrow
+import parsley
+import signal
+import tempfile
+from mock import patch
+from fake_zulip import FakeZulipServer
+from id_index import IdIndex
+from pinging_bot import PingingBot
+from snapshot import Snapshot
+
+# time strings checked in test_parse_time plus some issuer messages
+PARSE_TIME_CASES = ["5d", "5w", "2m", "m2", "7m", "2q", "10min", "10h",
+                    "300s", "today", "0d", "d0", "d", "w", "0w", "this week",
+                    "2w see you all there", "10", "d hello"]
+
+
+def _check(name, before, after):
+    """ Print parses (or operations) per second before and after a change. """
+
+    print "%-30s before: %12.1f/s  after: %12.1f/s  (x%.1f)" % (
+        name, before, after, after / before)
+
+
+def _rate(func, num):
+    return num / min(timeit.repeat(func, number=num, repeat=3))
+
+
+def _seconds(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def synthetic_msgs(num, senders=500, subject="some subject", start=0,
+                   bots=5, spacing=1):
+    """ Create a synthetic stream history with skewed sender activity. """
+
+    rand = random.Random(num)
+    msgs = []
+    for i in range(num):
+        sender = int(rand.paretovariate(1.2)) % senders
+        if sender < bots:
+            email = "s%d-bot@students.hackerschool.com" % sender
+        else:
+            email = "s%d@example.com" % sender
+
+        msgs.append({"id": i + 1,
+                     "timestamp": start + i * spacing,
+                     "subject": subject,
+                     "sender_id": sender,
+                     "sender_full_name": "Sender %d" % sender,
+                     "sender_email": email})
+
+    return msgs
+
+
+class OfflineBot(PingingBot):
+
+    """ PingingBot answering _get_msgs_chunk from an in-memory history. """
+
+    def __init__(self, server_msgs, chunk_size=PingingBot.CHUNK_SIZE,
+                 latency=0):
+        self.server_msgs = server_msgs  # ordered by id
+        self.latency = latency  # seconds of each round trip to Zulip
+        self.ids = [msg["id"] for msg in server_msgs]
+        self.CHUNK_SIZE = chunk_size
+        self.chunks_asked = 0
+        self.msgs_sent = 0
+
+    def _get_msgs_chunk(self, chunk_size, stream,
+                        anchor=PingingBot.LAST_MSG_ANCHOR, subject=None,
+                        forward=False):
+        self.chunks_asked += 1
+        time.sleep(self.latency)
+        if forward:
+            start = bisect.bisect_left(self.ids, anchor)
+            msgs = self.server_msgs[start:start + chunk_size + 1]
+        else:
+            end = bisect.bisect_right(self.ids, anchor)
+            msgs = self.server_msgs[max(0, end - chunk_size):end]
+        self.msgs_sent += len(msgs)
+
+        return msgs
+
+
+def bench_parse_time():
+    """ Grammar compiled on each parse vs. compiled once vs. fast paths. """
+
+    def grammar_result(time_str):
+        try:
+            return PingingBot.TIME_GRAMMAR(time_str).message()
+        except Exception:
+            return None
+
+    def fast_result(time_str):
+        try:
+            return PingingBot._parse_time_str(time_str)
+        except Exception:
+            return None
+
+    for time_str in PARSE_TIME_CASES:
+        assert grammar_result(time_str) == fast_result(time_str), time_str
+
+    def compiled_each_time():
+        for time_str in PARSE_TIME_CASES:
+            try:
+                parsley.makeGrammar(PingingBot.TIME_GRAMMAR_RULES,
+                                    {})(time_str).message()
+            except Exception:
+                pass
+
+    def compiled_once():
+        for time_str in PARSE_TIME_CASES:
+            grammar_result(time_str)
+
+    def fast_path():
+        for time_str in PARSE_TIME_CASES:
+            fast_result(time_str)
+
+    cases = len(PARSE_TIME_CASES)
+    before = _rate(compiled_each_time, 3) * cases
+    _check("parse_time (grammar once)", before,
+           _rate(compiled_once, 100) * cases)
+    _check("parse_time (fast path)", before, _rate(fast_path, 1000) * cases)
+
+
+def _list_get_participants(msgs, issuer):
+    """ get_participants as it was before ParticipantCollector. """
+
+    participants = []
+    for msg in msgs:
+        pinged_particip = "".join([PingingBot.PING_INI,
+                                   msg["sender_full_name"],
+                                   PingingBot.PING_END])
+
+        bot_msg = PingingBot._bot_msg(msg)
+        autoping = issuer == unicode(msg["sender_full_name"])
+        already_catched = pinged_particip not in participants
+
+        if not bot_msg and not autoping and already_catched:
+            participants.append(pinged_particip)
+
+    return participants
+
+
+def bench_participants(sizes=(10 ** 5, 10 ** 6)):
+    """ List based participants extraction vs. ParticipantCollector. """
+
+    for size in sizes:
+        msgs = synthetic_msgs(size)
+        issuer = msgs[-1]["sender_full_name"]
+
+        assert (_list_get_participants(msgs, issuer) ==
+                PingingBot.get_participants(msgs, issuer))
+
+        before = size / _seconds(lambda: _list_get_participants(msgs, issuer))
+        after = size / _seconds(
+            lambda: PingingBot.get_participants(msgs, issuer))
+        _check("get_participants %d msgs" % size, before, after)
+
+
+def _arrow_window_msgs(bot, time, subject):
+    """ Time window filtering as it was before comparing epoch integers. """
+
+    anchor = PingingBot.LAST_MSG_ANCHOR
+    earliest = arrow.now()
+
+    messages = []
+    while earliest > time:
+        msgs_chunk = bot._get_msgs_chunk(bot.CHUNK_SIZE, "stream", anchor)
+        earliest = arrow.get(msgs_chunk[0]["timestamp"])
+
+        last_anchor, anchor = anchor, msgs_chunk[0]["id"]
+        for msg in msgs_chunk:
+            msg_time = arrow.get(msg["timestamp"])
+            if msg["subject"] == subject and msg_time > time and \
+                    msg["id"] < last_anchor:
+                messages.append(msg)
+
+        if len(msgs_chunk) < bot.CHUNK_SIZE:
+            break
+
+    return messages
+
+
+def bench_time_window(size=10 ** 5):
+    """ Per message arrow.get vs. epoch integers and a binary search cut. """
+
+    now = arrow.now().timestamp
+    msgs = synthetic_msgs(size, start=now - size)
+    bot = OfflineBot(msgs)
+    cutoff = arrow.get(now - size * 3 // 4)
+
+    # same messages (chunks are sized differently, so their order differs)
+    assert (sorted(_arrow_window_msgs(bot, cutoff, "some subject")) ==
+            sorted(bot._iter_fetched_msgs(cutoff.timestamp, "stream",
+                                          "some subject")))
+
+    before = size / _seconds(
+        lambda: _arrow_window_msgs(bot, cutoff, "some subject"))
+    after = size / _seconds(lambda: list(bot._iter_fetched_msgs(
+        cutoff.timestamp, "stream", "some subject")))
+    _check("time window %d msgs" % size, before, after)
+
+
+def bench_chunk_sizes(size=10 ** 5, days=90):
+    """ Fixed CHUNK_SIZE chunks vs. chunks sized with the message rate. """
+
+    now = arrow.now().timestamp
+    spacing = days * 86400 // size
+    msgs = synthetic_msgs(size, start=now - size * spacing, spacing=spacing)
+
+    results = []
+    for window in [600, 3600, 86400, 7 * 86400, days * 86400]:
+        fixed = OfflineBot(msgs)
+        fixed.MIN_CHUNK_SIZE = fixed.CHUNK_SIZE
+        adaptive = OfflineBot(msgs)
+        list(adaptive._iter_fetched_msgs(now - 3600, "stream",
+                                         "some subject"))
+        adaptive.chunks_asked = adaptive.msgs_sent = 0
+
+        for bot in (fixed, adaptive):
+            list(bot._iter_fetched_msgs(now - window, "stream",
+                                        "some subject"))
+        results.append((window, fixed, adaptive))
+
+    for window, fixed, adaptive in results:
+        print ("%-30s before: %3d chunks %7d msgs  after: %3d chunks %7d "
+               "msgs" % ("chunk sizes %ds window" % window,
+                         fixed.chunks_asked, fixed.msgs_sent,
+                         adaptive.chunks_asked, adaptive.msgs_sent))
+
+
+def _peak_rss_kb(func):
+    """ Peak memory (KB) added by calling a function, in a forked process.
+
+    The tracemalloc module is not available in Python 2, and ru_maxrss only
+    grows during a process, so each measure is taken in a fresh fork.
+    """
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = func()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        os.write(write_end, b"%d %d" % (peak, len(result)))
+        os._exit(0)
+
+    os.close(write_end)
+    with os.fdopen(read_end) as f:
+        peak, num = map(int, f.read().split())
+    os.waitpid(pid, 0)
+
+    return peak, num
+
+
+def bench_memory(msgs=100000, senders=200):
+    """ Peak memory of a 3 months scan keeping dicts vs. CompactMsg. """
+
+    server = FakeZulipServer().start()
+    server.generate(msgs_per_stream=msgs, topics=1, senders=senders)
+
+    results = []
+    try:
+        for decode_msg in (None, PingingBot.decode_msg):
+            bot = PingingBot("pinging-bot@students.hackerschool.com", "key",
+                             "PingingBot", "PingBot", ["stream 0"],
+                             site=server.url)
+            bot.decode_msg = decode_msg
+            since = bot._get_shifted_time(3, "m")
+            results.append(_peak_rss_kb(
+                lambda: bot.get_msgs(since, "stream 0", "topic 0")))
+    finally:
+        server.stop()
+
+    (before, num), (after, _) = results
+    print "%-30s before: %10dKB  after: %10dKB  (x%.1f)" % (
+        "3 months scan %d msgs" % num, before, after,
+        float(before) / max(after, 1))
+
+
+def bench_id_index(size=10 ** 5, days=90, every=500, latency=0.05):
+    """ Windows paged back from the latest message vs. from the id index.
+
+    Windows much shorter than the distance between the points of the index
+    are paged back as before. Longer ones are retrieved in parallel ranges,
+    each chunk taking latency seconds.
+    """
+
+    now = arrow.now().timestamp
+    spacing = days * 86400 // size
+    msgs = synthetic_msgs(size, start=now - size * spacing, spacing=spacing)
+    points = {"stream": [(msg["id"], msg["timestamp"])
+                         for msg in msgs[::every]]}
+
+    results = []
+    for window in [3600, 86400, 7 * 86400, 30 * 86400]:
+        paged = OfflineBot(msgs, latency=latency)
+        indexed = OfflineBot(msgs, latency=latency)
+        indexed.id_index = IdIndex()
+        indexed.id_index.load(points)
+
+        for bot in (paged, indexed):
+            # the message rate is learned in a first pass
+            list(bot._iter_fetched_msgs(now - window, "stream",
+                                        "some subject"))
+            bot.chunks_asked = bot.msgs_sent = 0
+            start = time.time()
+            bot.found = sorted(bot._iter_fetched_msgs(
+                now - window, "stream", "some subject"))
+            bot.seconds = time.time() - start
+
+        assert paged.found == indexed.found
+        results.append((window, paged, indexed))
+
+    for window, paged, indexed in results:
+        print ("%-30s before: %3d chunks %6d msgs %5.2fs  after: %3d chunks "
+               "%6d msgs %5.2fs" % ("id index %ds window" % window,
+                                    paged.chunks_asked, paged.msgs_sent,
+                                    paged.seconds, indexed.chunks_asked,
+                                    indexed.msgs_sent, indexed.seconds))
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[int(round((len(values) - 1) * percent / 100.0))]
+
+
+def _server_totals(server):
+    with server.lock:
+        return sum(server.calls.values()), sum(server.bytes_sent.values())
+
+
+def run_pings(bot, server, pings, rounds, seed=0):
+    """ Respond to trigger messages measuring latency and API usage.
+
+    Args:
+        bot: PingingBot connected to the fake server.
+        server: FakeZulipServer with the stream history.
+        pings: Trigger messages content (e.g. "PingBot 1w").
+        rounds: Times each trigger message is sent (to a random topic).
+        seed: Seed used to choose the topics.
+
+    Returns:
+        Dict with the latency percentiles (ms), the API calls and the bytes
+        received per ping, of each trigger message.
+    """
+
+    rand = random.Random(seed)
+    results = {}
+
+    for content in pings:
+        latencies, calls, received = [], 0, 0
+
+        for i in range(rounds):
+            topic_msg = rand.choice(server.msgs)
+            msg = {"type": "stream", "content": content,
+                   "display_recipient": topic_msg["display_recipient"],
+                   "subject": topic_msg["subject"],
+                   "sender_full_name": "User 10",
+                   "sender_email": "user10@example.com"}
+
+            calls_before, bytes_before = _server_totals(server)
+            start = time.time()
+            bot.respond(msg)
+            latencies.append((time.time() - start) * 1000)
+            bot.send_queue.flush()
+            calls_after, bytes_after = _server_totals(server)
+
+            calls += calls_after - calls_before
+            received += bytes_after - bytes_before
+
+        results[content] = {"p50_ms": round(_percentile(latencies, 50), 1),
+                            "p90_ms": round(_percentile(latencies, 90), 1),
+                            "p99_ms": round(_percentile(latencies, 99), 1),
+                            "api_calls": float(calls) / rounds,
+                            "bytes": received // rounds}
+
+    return results
+
+
+E2E_PINGS = ["PingBot", "PingBot 10", "PingBot 10min", "PingBot 1d",
+             "PingBot 1w", "PingBot 2m"]
+
+
+def bench_e2e(msgs=50000, topics=50, senders=200, rounds=20,
+              output="bench_results.json"):
+    """ Ping latency and API usage against a local fake Zulip server. """
+
+    server = FakeZulipServer().start()
+    server.generate(msgs_per_stream=msgs, topics=topics, senders=senders)
+
+    results = {"msgs": msgs, "topics": topics, "senders": senders,
+               "rounds": rounds, "scenarios": {}}
+    scenarios = [("uncached", {}),
+                 ("history_cache", {"history_path": ":memory:"}),
+                 ("pooled_client", {"pooled_client": True})]
+
+    try:
+        for name, options in scenarios:
+            bot = PingingBot("pinging-bot@students.hackerschool.com", "key",
+                             "PingingBot", "PingBot", ["stream 0"],
+                             site=server.url, **options)
+            results["scenarios"][name] = run_pings(bot, server, E2E_PINGS,
+                                                   rounds)
+    finally:
+        server.stop()
+
+    for name, _ in scenarios:
+        for content, stats in sorted(results["scenarios"][name].items()):
+            print ("%-14s %-14s p50: %8.1fms  p90: %8.1fms  p99: %8.1fms  "
+                   "calls: %5.1f  bytes: %9d" % (
+                       name, content, stats["p50_ms"], stats["p90_ms"],
+                       stats["p99_ms"], stats["api_calls"], stats["bytes"]))
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True, separators=(",", ": "))
+        f.write("\n")
+
+
+def bench_startup(streams=2000, subscribe_delay=0.0005):
+    """ Streams listed and subscribed in one call vs. cached and batched. """
+
+    server = FakeZulipServer().start()
+    server.generate(streams=streams, msgs_per_stream=1)
+    server.subscribe_delay = subscribe_delay
+
+    try:
+        bot = PingingBot("pinging-bot@students.hackerschool.com", "key",
+                         "PingingBot", "PingBot", site=server.url)
+
+        def one_call():
+            all_streams = [{'name': stream['name']}
+                           for stream in bot.get_all_zulip_streams()]
+            bot.client.add_subscriptions(all_streams)
+
+        before = _seconds(one_call)
+        bot.stream_cache.invalidate()
+        after = _seconds(bot.subscribe_to_streams)
+    finally:
+        server.stop()
+
+    print "%-30s before: %10.3fs  after: %10.3fs  (x%.1f)" % (
+        "startup %d streams" % streams, before, after, before / after)
+
+
+# imports of a cold start: the bot module, plus what was imported eagerly
+IMPORT_EAGER = ("import zulip, parsley, pinging_bot; "
+                "pinging_bot.PingingBot.TIME_GRAMMAR")
+IMPORT_LAZY = "import pinging_bot"
+
+
+def _import_seconds(statement, runs=5):
+    """ Best time of some statement in fresh interpreters (python 2 has no
+    -X importtime, so each run is timed by a new process).
+    """
+
+    code = ("import time; start = time.time(); %s; "
+            "print(time.time() - start)" % statement)
+    return min(float(subprocess.check_output([sys.executable, "-c", code]))
+               for _ in range(runs))
+
+
+class _CatchUpFirst(PingingBot):
+
+    """ PingingBot catching up its snapshot before listening (as before). """
+
+    def _start_index_in_background(self, header=None):
+        since = self._catch_up(header) if header else None
+        self.participant_index.start(since or arrow.now().timestamp)
+
+
+def _first_event_seconds(server, defer_subscriptions, snapshot_path=None,
+                         bot_class=PingingBot):
+    """ Seconds from creating a bot to its first message event. """
+
+    received = threading.Event()
+    start = time.time()
+    bot = bot_class("pinging-bot@students.hackerschool.com", "key",
+                    "PingingBot", "PingBot", site=server.url,
+                    pooled_client=True, snapshot_path=snapshot_path,
+                    defer_subscriptions=defer_subscriptions)
+    bot.on_event = lambda event: received.set()
+
+    # main() only handles SIGTERM from the main thread
+    thread = threading.Thread(target=patch.object(
+        signal, "signal", lambda *args: None)(bot.main))
+    thread.daemon = True
+    thread.start()
+    while not received.is_set():
+        server.post_message("stream 0", "topic 0", "User 0", "hi")
+        received.wait(0.01)
+    seconds = time.time() - start
+
+    bot.subscribed.wait()
+    while bot.participant_index.since is None:
+        time.sleep(0.01)
+    bot.event_queue.stop()
+
+    return seconds
+
+
+def bench_cold_start(streams=2000, subscribe_delay=0.0005):
+    """ Import time and time to the first event after a restart. """
+
+    before = _import_seconds(IMPORT_EAGER)
+    after = _import_seconds(IMPORT_LAZY)
+    print "%-30s before: %10.3fs  after: %10.3fs  (x%.1f)" % (
+        "import", before, after, before / after)
+
+    server = FakeZulipServer(poll_timeout=1).start()
+    server.generate(streams=streams, msgs_per_stream=1)
+    server.subscribe_delay = subscribe_delay
+    try:
+        before = _first_event_seconds(server, False)
+        after = _first_event_seconds(server, True)
+    finally:
+        server.stop()
+
+    print "%-30s before: %10.3fs  after: %10.3fs  (x%.1f)" % (
+        "first event %d streams" % streams, before, after, before / after)
+
+
+def bench_warm_start(streams=200, msgs_per_stream=200):
+    """ Time to the first event after a restart with a snapshot to catch up
+    (before the events vs. in the background).
+    """
+
+    server = FakeZulipServer(poll_timeout=1).start()
+    server.generate(streams=streams, msgs_per_stream=msgs_per_stream)
+    saved_at = min(msg["timestamp"] for msg in server.msgs)
+    path = tempfile.mktemp(suffix=".jsonl")
+    seconds = []
+    try:
+        for bot_class in (_CatchUpFirst, PingingBot):
+            # every message of every stream was sent since the snapshot
+            Snapshot(path).write({"since": saved_at, "saved_at": saved_at,
+                                  "high_ids": {}}, [])
+            seconds.append(_first_event_seconds(server, True, path,
+                                                bot_class))
+    finally:
+        server.stop()
+        if os.path.exists(path):
+            os.remove(path)
+
+    before, after = seconds
+    print "%-30s before: %10.3fs  after: %10.3fs  (x%.1f)" % (
+        "first event %d msgs behind" % (streams * msgs_per_stream), before,
+        after, before / after)
+
+
+BENCHMARKS = {"parse_time": bench_parse_time,
+              "participants": bench_participants,
+              "time_window": bench_time_window,
+              "e2e": bench_e2e,
+              "startup": bench_startup,
+              "cold_start": bench_cold_start,
+              "warm_start": bench_warm_start,
+              "chunk_sizes": bench_chunk_sizes,
+              "memory": bench_memory,
+              "id_index": bench_id_index}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
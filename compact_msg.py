@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from operator import itemgetter
+
+MAX_INTERNED = 100000  # strings shared before the pool is started again
+_interned = {}
+
+
+def intern_value(value):
+    """ Return a shared copy of a repeated value (subject, sender...).
+
+    The builtin intern() only takes byte strings, so unicode strings (and
+    sender ids) are shared through a dict. The pool is emptied when it grows
+    past MAX_INTERNED, records created before keep their copies.
+    """
+
+    if len(_interned) > MAX_INTERNED:
+        _interned.clear()
+
+    return _interned.setdefault(value, value)
+
+
+class CompactMsg(tuple):
+
+    """ Zulip message reduced to the fields used to collect participants.
+
+        Zulip messages come with the content, avatar, links and a dozen more
+        fields the bot never reads. A CompactMsg is a tuple of the FIELDS
+        (without a per instance dict) and its subject and sender are shared
+        between the messages repeating them. It is read like the message
+        dicts (msg["sender_id"]), so both can be used interchangeably.
+    """
+
+    __slots__ = ()
+
+    FIELDS = ("id", "timestamp", "subject", "sender_full_name",
+              "sender_email", "sender_id")
+    INDEXES = {field: index for index, field in enumerate(FIELDS)}
+
+    def __new__(cls, id, timestamp, subject, sender_full_name, sender_email,
+                sender_id):
+        return tuple.__new__(cls, (id, timestamp, intern_value(subject),
+                                   intern_value(sender_full_name),
+                                   intern_value(sender_email),
+                                   intern_value(sender_id)))
+
+    @classmethod
+    def from_json(cls, obj):
+        """ Hook for json.loads turning message objects into CompactMsg.
+
+        Args:
+            obj: Any JSON object decoded, only the ones with a sender and a
+                timestamp (the messages) are replaced.
+        """
+
+        if "sender_id" not in obj or "timestamp" not in obj:
+            return obj
+
+        return cls(*[obj.get(field) for field in cls.FIELDS])
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self.INDEXES[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        index = self.INDEXES.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        """ Field names, so dict(msg) gives the message as a dict. """
+
+        return list(self.FIELDS)
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __repr__(self):
+        return "CompactMsg(%s)" % ", ".join(
+            "%s=%r" % (field, value)
+            for field, value in zip(self.FIELDS, self))
+
+    id = property(itemgetter(0))
+    timestamp = property(itemgetter(1))
+    subject = property(itemgetter(2))
+    sender_full_name = property(itemgetter(3))
+    sender_email = property(itemgetter(4))
+    sender_id = property(itemgetter(5))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from collections import deque
+import Queue
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher():
+
+    """ Bounded work queue served by a pool of worker threads.
+
+        Work items are submitted under a key (the stream of a trigger
+        message) and items with the same key are handled one at a time, in
+        the order they were submitted, while items of other keys are handled
+        concurrently by the other workers.
+
+        Attributes:
+            handler: Function called by the workers with each item.
+            workers: Number of worker threads.
+            max_queue: Maximum items waiting or being handled; submitting more
+                blocks the caller for up to submit_timeout seconds.
+            submit_timeout: Seconds to wait for room in a full queue before
+                dropping the item.
+    """
+
+    def __init__(self, handler, workers=4, max_queue=100, submit_timeout=1):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.submit_timeout = submit_timeout
+
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.pending = {}  # key: deque of (submitted time, item)
+        self.ready = Queue.Queue()  # keys with items and no item in process
+        self.depth = 0
+        self.threads = []
+
+        self.stats = {"submitted": 0, "handled": 0, "dropped": 0,
+                      "errors": 0, "max_depth": 0, "wait_seconds": 0.0,
+                      "max_wait_seconds": 0.0}
+
+    def start(self):
+        """ Start the worker threads. """
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name="dispatcher-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, item):
+        """ Queue an item to be handled after the previous ones of its key.
+
+        Args:
+            key: Items with the same key are handled sequentially.
+            item: Item passed to the handler.
+
+        Returns:
+            False if the queue stayed full and the item was dropped.
+        """
+
+        with self.lock:
+            deadline = time.time() + self.submit_timeout
+            while self.depth >= self.max_queue:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats["dropped"] += 1
+                    return False
+                self.not_full.wait(remaining)
+
+            self.stats["submitted"] += 1
+            self.depth += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.depth)
+
+            # a key already pending is scheduled again by its current worker
+            if key in self.pending:
+                self.pending[key].append((time.time(), item))
+                return True
+
+            self.pending[key] = deque([(time.time(), item)])
+
+        self.ready.put(key)
+        return True
+
+    def _work(self):
+        while True:
+            key = self.ready.get()
+
+            with self.lock:
+                submitted, item = self.pending[key].popleft()
+                wait = time.time() - submitted
+                self.stats["wait_seconds"] += wait
+                self.stats["max_wait_seconds"] = max(
+                    self.stats["max_wait_seconds"], wait)
+
+            error = False
+            try:
+                self.handler(item)
+            except Exception:
+                error = True
+                logger.exception("error handling %r", item)
+
+            with self.lock:
+                self.depth -= 1
+                self.stats["handled"] += 1
+                self.stats["errors"] += 1 if error else 0
+                self.not_full.notify()
+
+                if self.pending[key]:
+                    self.ready.put(key)
+                else:
+                    del self.pending[key]
+
+    def get_stats(self):
+        """ Return a copy of the stats including current queue depth. """
+
+        with self.lock:
+            stats = dict(self.stats, depth=self.depth)
+
+        stats["mean_wait_seconds"] = (stats["wait_seconds"] /
+                                      (stats["handled"] or 1))
+
+        return stats
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class EventQueue():
+
+    """ Zulip event queue long-polled through the pooled ZulipTransport.
+
+        Replaces zulip.Client.call_on_each_event: the long poll shares the
+        connection pool (and the retries and stats) of the REST calls, a new
+        queue is registered when Zulip forgets ours, and the loop can be
+        stopped from another thread.
+
+        Attributes:
+            transport: ZulipTransport used to call Zulip.
+            event_types: Types of the events received (None = all).
+            poll_timeout: Seconds a long poll may wait for events.
+            retry_wait: Seconds waited after a failed poll.
+    """
+
+    def __init__(self, transport, event_types=("message", "stream"),
+                 poll_timeout=90, retry_wait=1):
+        self.transport = transport
+        self.event_types = event_types
+        self.poll_timeout = poll_timeout
+        self.retry_wait = retry_wait
+
+        self.queue_id = None
+        self.last_event_id = -1
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def register(self):
+        """ Register a new event queue in Zulip. """
+
+        data = {}
+        if self.event_types is not None:
+            data["event_types"] = json.dumps(list(self.event_types))
+
+        response = self.transport.post("register", data=data)
+        if response.status_code != 200:
+            raise RuntimeError("could not register an event queue (%s)" %
+                               response.content)
+
+        json_res = response.json()
+        self.queue_id = json_res["queue_id"]
+        self.last_event_id = json_res["last_event_id"]
+
+    def poll(self):
+        """ Wait for the next events, registering a queue if needed.
+
+        Returns:
+            Events received (possibly none if the poll timed out).
+        """
+
+        if self.queue_id is None:
+            self.register()
+
+        response = self.transport.get(
+            "events", params={"queue_id": self.queue_id,
+                              "last_event_id": self.last_event_id},
+            timeout=self.poll_timeout + 10)
+
+        if response.status_code != 200:
+            json_res = response.json()
+            if json_res.get("code") == "BAD_EVENT_QUEUE_ID":
+                self.queue_id = None  # events meanwhile are lost
+            raise RuntimeError("could not get events (%s)" % json_res)
+
+        events = response.json()["events"]
+        for event in events:
+            self.last_event_id = max(self.last_event_id, int(event["id"]))
+
+        return events
+
+    def run(self, callback):
+        """ Call a function with each event until stop() is called.
+
+        Args:
+            callback: Function receiving each event (dict).
+        """
+
+        while not self.stopping.is_set():
+            try:
+                events = self.poll()
+            except (IOError, RuntimeError) as error:
+                logger.warning("event queue: %s", error)
+                self.stopping.wait(self.retry_wait)
+                continue
+
+            for event in events:
+                if event["type"] != "heartbeat":
+                    callback(event)
+
+    def start(self, callback):
+        """ Run the event loop in a background thread. """
+
+        self.thread = threading.Thread(target=self.run, args=(callback,),
+                                       name="event-queue")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """ Stop the event loop after the poll in progress. """
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Local stand-in for the Zulip REST API, used by tests and benchmarks.
+
+    Implements the subset of the API used by the bot: listing streams,
+    subscribing, reading messages with anchor/num_before/num_after/narrow,
+    sending messages and the register/events queue. Streams are filled with
+    synthetic messages by FakeZulipServer.generate().
+"""
+
+from __future__ import unicode_literals
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import bisect
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+import urlparse
+
+
+class FakeZulipServer(ThreadingMixIn, HTTPServer):
+
+    """ In-memory Zulip server listening on a local port.
+
+        Attributes:
+            url: Site url to give to the bot (e.g. "http://127.0.0.1:8080").
+            msgs: Every message, ordered by id.
+            topic_narrow: Accept narrowing messages to a topic (old servers
+                answer 400 to it).
+            poll_timeout: Seconds a GET /events waits for new events.
+            subscribe_delay: Seconds the server spends subscribing to each
+                stream (to simulate a large organization).
+            send_limit: Messages that can be sent per minute (the server
+                answers with the X-RateLimit headers of Zulip).
+            calls: Number of calls received per endpoint.
+            bytes_sent: Bytes of the responses per endpoint.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, topic_narrow=True, poll_timeout=10):
+        HTTPServer.__init__(self, ("127.0.0.1", port), _Handler)
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+        self.topic_narrow = topic_narrow
+        self.poll_timeout = poll_timeout
+        self.subscribe_delay = 0
+        self.send_limit = 10000
+        self.sent_in_window = (0, 0)  # (window reset time, messages sent)
+
+        self.lock = threading.Condition()
+        self.msgs = []
+        self.ids = []
+        self.streams = []
+        self.events = []  # every event, queues just remember where they are
+        self.queues = {}  # queue id: event types (None = every event)
+        self.calls = {}
+        self.bytes_sent = {}
+        self.thread = None
+        self.stopped = False
+        self.connections = set()
+
+    def start(self):
+        """ Serve requests in a background thread. """
+
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name="fake-zulip")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving, closing the connections kept alive by clients. """
+
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+            deadline = time.time() + 1
+            while self.connections and time.time() < deadline:
+                self.lock.wait(0.01)
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        HTTPServer.shutdown_request(self, request)
+        with self.lock:
+            self.connections.discard(request)
+            self.lock.notify_all()
+
+    def handle_error(self, request, client_address):
+        # connections closed by stop() are not errors
+        if not self.stopped:
+            HTTPServer.handle_error(self, request, client_address)
+
+    def generate(self, streams=1, msgs_per_stream=10000, topics=50,
+                 topic_skew=1.2, senders=200, days=90, seed=0):
+        """ Fill the server with synthetic stream messages.
+
+        Args:
+            streams: Number of streams created ("stream 0", "stream 1"...).
+            msgs_per_stream: Messages sent to each stream.
+            topics: Topics of each stream ("topic 0", "topic 1"...).
+            topic_skew: Zipf exponent of the topic popularity (0 = uniform).
+            senders: Distinct senders (a few of them are bots).
+            days: Messages are spread over the last days.
+            seed: Seed of the random generator.
+        """
+
+        rand = random.Random(seed)
+        now = int(time.time())
+        weights = [1.0 / (rank + 1) ** topic_skew for rank in range(topics)]
+        cumulative = [sum(weights[:i + 1]) for i in range(topics)]
+
+        names = ["stream %d" % (len(self.streams) + num)
+                 for num in range(streams)]
+        new_msgs = []
+        for stream in names:
+            for i in range(msgs_per_stream):
+                topic = bisect.bisect(cumulative,
+                                      rand.random() * cumulative[-1])
+                new_msgs.append((rand.randint(now - days * 86400, now),
+                                 stream, "topic %d" % min(topic, topics - 1),
+                                 rand.randrange(senders)))
+
+        with self.lock:
+            self.streams.extend(names)
+            for timestamp, stream, topic, sender in sorted(new_msgs):
+                self._append_msg(stream, topic, sender, "some content",
+                                 timestamp)
+
+    def create_stream(self, name):
+        """ Create a stream, delivering it to the event queues. """
+
+        with self.lock:
+            self.streams.append(name)
+            self._add_event({"type": "stream", "op": "create",
+                             "streams": [{"name": name}]})
+            self.lock.notify_all()
+
+    def post_message(self, stream, subject, sender, content):
+        """ Send a message as a user, delivering it to the event queues. """
+
+        with self.lock:
+            if stream not in self.streams:
+                self.streams.append(stream)
+            msg = self._append_msg(stream, subject, sender, content,
+                                   int(time.time()))
+            self._add_event({"type": "message", "message": msg})
+            self.lock.notify_all()
+
+        return msg
+
+    def _append_msg(self, stream, subject, sender, content, timestamp):
+        if isinstance(sender, int):
+            is_bot = sender < 3
+            email = "user%d%s" % (sender, "-bot@students.hackerschool.com"
+                                  if is_bot else "@example.com")
+            name = "User %d" % sender
+            sender_id = sender
+        else:
+            email, name, sender_id = sender, sender.split("@")[0], \
+                abs(hash(sender)) % 10 ** 6
+
+        msg_id = (self.ids[-1] if self.ids else 0) + 1
+        msg = {"id": msg_id,
+               "timestamp": max(timestamp, self.msgs[-1]["timestamp"]
+                                if self.msgs else 0),
+               "type": "stream",
+               "display_recipient": stream,
+               "recipient_id": self.streams.index(stream) + 1,
+               "subject": subject,
+               "subject_links": [],
+               "content": content,
+               "content_type": "text/x-markdown",
+               "client": "website",
+               "sender_id": sender_id,
+               "sender_email": email,
+               "sender_full_name": name,
+               "sender_short_name": email.split("@")[0],
+               "sender_domain": email.split("@")[-1],
+               "avatar_url": "https://secure.gravatar.com/avatar/%s" %
+                             ("%032x" % sender_id),
+               "gravatar_hash": "%032x" % sender_id}
+
+        self.msgs.append(msg)
+        self.ids.append(msg_id)
+        return msg
+
+    def _add_event(self, event):
+        event["id"] = len(self.events)
+        self.events.append(event)
+
+    def get_messages(self, anchor, num_before, num_after, narrow):
+        """ Messages around an anchor matching a narrow (None if invalid). """
+
+        filters = {}
+        for term in narrow:
+            if isinstance(term, dict):
+                operator, operand = term["operator"], term["operand"]
+            else:
+                operator, operand = term
+
+            if operator == "topic" and not self.topic_narrow:
+                return None
+            if operator not in ("stream", "topic", "subject"):
+                return None
+            filters["subject" if operator == "topic" else operator] = operand
+
+        def match(msg):
+            return (msg["display_recipient"] == filters.get(
+                "stream", msg["display_recipient"]) and
+                msg["subject"] == filters.get("subject", msg["subject"]))
+
+        with self.lock:
+            position = bisect.bisect_right(self.ids, anchor)
+
+            before = []
+            i = position - 1
+            while i >= 0 and len(before) < num_before + 1:
+                if match(self.msgs[i]):
+                    before.append(self.msgs[i])
+                i -= 1
+            before.reverse()
+
+            after = []
+            i = position
+            while i < len(self.msgs) and len(after) < num_after:
+                if match(self.msgs[i]):
+                    after.append(self.msgs[i])
+                i += 1
+
+        # num_before does not count the anchor message itself
+        if before and before[-1]["id"] != anchor:
+            before = before[1:] if len(before) > num_before else before
+
+        return before + after
+
+    def register(self, event_types=None):
+        with self.lock:
+            queue_id = "%d:%d" % (int(time.time()), len(self.queues))
+            self.queues[queue_id] = event_types
+            return queue_id, len(self.events) - 1
+
+    def get_events(self, queue_id, last_event_id, dont_block=False):
+        """ Events later than last_event_id, waiting for them if needed. """
+
+        deadline = time.time() + self.poll_timeout
+        with self.lock:
+            if queue_id not in self.queues:
+                return None
+            event_types = self.queues[queue_id]
+
+            while True:
+                events = [event for event in self.events[last_event_id + 1:]
+                          if event_types is None or
+                          event["type"] in event_types]
+
+                remaining = deadline - time.time()
+                if events or dont_block or remaining <= 0:
+                    return events
+                self.lock.wait(remaining)
+
+    def count(self, endpoint, num_bytes):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.bytes_sent[endpoint] = (self.bytes_sent.get(endpoint, 0) +
+                                         num_bytes)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET", urlparse.parse_qs(
+            urlparse.urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        self._dispatch("POST", urlparse.parse_qs(self.rfile.read(length)))
+
+    def _dispatch(self, method, query):
+        params = {key: values[-1].decode("utf-8")
+                  for key, values in query.items()}
+        endpoint = urlparse.urlparse(self.path).path
+        if endpoint.startswith("/api/"):
+            endpoint = endpoint[len("/api"):]
+
+        handler = {("GET", "/v1/streams"): self._streams,
+                   ("GET", "/v1/messages"): self._get_messages,
+                   ("POST", "/v1/messages"): self._send_message,
+                   ("POST", "/v1/register"): self._register,
+                   ("GET", "/v1/events"): self._events,
+                   ("POST", "/v1/users/me/subscriptions"): self._subscribe,
+                   }.get((method, endpoint))
+
+        self.response_headers = {}
+        if handler is None:
+            status, body = 404, {"result": "error", "msg": "Not found"}
+        else:
+            status, body = handler(params)
+
+        data = json.dumps(body) if body is not None else ""
+        self.server.count(endpoint, len(data))
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for header, value in self.response_headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _streams(self, params):
+        with self.server.lock:
+            streams = [{"name": name, "stream_id": i + 1}
+                       for i, name in enumerate(self.server.streams)]
+
+        etag = '"%s"' % hashlib.md5(json.dumps(streams)).hexdigest()
+        self.response_headers["ETag"] = etag
+        if self.headers.get("If-None-Match") == etag:
+            return 304, None
+
+        return 200, {"result": "success", "streams": streams}
+
+    def _get_messages(self, params):
+        anchor = params.get("anchor", "newest")
+        anchor = 2 ** 64 - 1 if anchor == "newest" else int(anchor)
+
+        msgs = self.server.get_messages(
+            anchor, int(params.get("num_before", 0)),
+            int(params.get("num_after", 0)),
+            json.loads(params.get("narrow", "[]")))
+
+        if msgs is None:
+            return 400, {"result": "error", "msg": "Invalid narrow operator"}
+        return 200, {"result": "success", "messages": msgs}
+
+    def _send_message(self, params):
+        msg = self.server.post_message(
+            params.get("to"), params.get("subject", params.get("topic")),
+            self._user(), params.get("content", ""))
+
+        with self.server.lock:
+            reset = (int(time.time()) // 60 + 1) * 60
+            window, sent = self.server.sent_in_window
+            sent = sent + 1 if window == reset else 1
+            self.server.sent_in_window = (reset, sent)
+        self.response_headers.update({
+            "X-RateLimit-Limit": str(self.server.send_limit),
+            "X-RateLimit-Remaining": str(max(0, self.server.send_limit -
+                                             sent)),
+            "X-RateLimit-Reset": str(reset)})
+
+        return 200, {"result": "success", "id": msg["id"]}
+
+    def _register(self, params):
+        event_types = params.get("event_types")
+        queue_id, last_event_id = self.server.register(
+            json.loads(event_types) if event_types else None)
+        return 200, {"result": "success", "queue_id": queue_id,
+                     "last_event_id": last_event_id}
+
+    def _events(self, params):
+        events = self.server.get_events(
+            params.get("queue_id"), int(params.get("last_event_id", -1)),
+            params.get("dont_block") == "true")
+
+        if events is None:
+            return 400, {"result": "error", "code": "BAD_EVENT_QUEUE_ID",
+                         "msg": "Bad event queue id"}
+        return 200, {"result": "success", "events": events}
+
+    def _subscribe(self, params):
+        streams = json.loads(params.get("subscriptions", "[]"))
+        time.sleep(self.server.subscribe_delay * len(streams))
+        with self.server.lock:
+            for stream in streams:
+                if stream["name"] not in self.server.streams:
+                    self.server.streams.append(stream["name"])
+        return 200, {"result": "success", "subscribed": {},
+                     "already_subscribed": {}}
+
+    def _user(self):
+        """ Email of the user calling (from the basic auth header). """
+
+        auth = self.headers.get("Authorization", "")
+        try:
+            return auth.split()[1].decode("base64").split(":")[0]
+        except (IndexError, ValueError):
+            return "pinging-bot@students.hackerschool.com"
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import sqlite3
+import threading
+from compact_msg import CompactMsg
+
+
+class HistoryCache():
+
+    """ Persistent store of Zulip stream messages already retrieved.
+
+        Messages are kept in a SQLite database keyed by (stream, message id),
+        together with the range of ids known to be complete for each stream
+        (or for a single subject of a stream, when messages are retrieved
+        narrowed to a subject), so the bot only has to ask Zulip for messages
+        newer than the newest cached one (or older than the oldest one).
+
+        For each stream (or stream-subject) the coverage is described by:
+            low_id: Oldest message id stored (anchor to keep paging back).
+            high_id: Newest message id stored.
+            floor: All the messages with id <= high_id and timestamp > floor
+                are in the cache (0 means the whole stream is cached).
+
+        Attributes:
+            path: Path of the SQLite database (":memory:" to not persist).
+    """
+
+    FIELDS = CompactMsg.FIELDS
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    stream TEXT, id INTEGER, timestamp INTEGER, subject TEXT,
+                    sender_full_name TEXT, sender_email TEXT,
+                    sender_id INTEGER, PRIMARY KEY (stream, id))""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS messages_subject
+                ON messages (stream, subject, timestamp)""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS coverage (
+                    stream TEXT, subject TEXT, low_id INTEGER,
+                    high_id INTEGER, floor INTEGER,
+                    PRIMARY KEY (stream, subject))""")
+
+    def coverage(self, stream, subject=""):
+        """ Return (low_id, high_id, floor) cached for a stream or None.
+
+        Args:
+            stream: Zulip stream of the messages.
+            subject: Subject the messages were narrowed to ("" = all).
+        """
+
+        with self.lock:
+            return self.conn.execute(
+                "SELECT low_id, high_id, floor FROM coverage "
+                "WHERE stream = ? AND subject = ?",
+                (stream, subject)).fetchone()
+
+    def set_coverage(self, stream, low_id, high_id, floor, subject=""):
+        """ Record the range of messages known to be complete in a stream. """
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?)",
+                (stream, subject, low_id, high_id, floor))
+
+    def reset(self, stream):
+        """ Forget every message and the coverage of a stream. """
+
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE stream = ?",
+                              (stream,))
+            self.conn.execute("DELETE FROM coverage WHERE stream = ?",
+                              (stream,))
+
+    def add(self, stream, msgs):
+        """ Store a chunk of messages retrieved from a stream.
+
+        Args:
+            stream: Zulip stream the messages belong to.
+            msgs: Zulip messages (dicts or CompactMsg) as returned by the API.
+        """
+
+        rows = [(stream,) + tuple(msg[field] for field in self.FIELDS)
+                for msg in msgs]
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows)
+
+    def get_msgs(self, stream, subject, since, min_id=None, before_id=None,
+                 newest_first=False):
+        """ Get cached messages of a stream-subject newer than a timestamp.
+
+        Args:
+            stream: Zulip stream of the messages.
+            subject: Subject of the messages (None = every topic).
+            since: Epoch timestamp, only later messages are returned.
+            min_id: Only return messages with this id or higher (optional).
+            before_id: Only return messages with a lower id (optional).
+            newest_first: Return messages from latest to earliest.
+        """
+
+        return list(self.iter_msgs(stream, subject, since, min_id, before_id,
+                                   newest_first))
+
+    def iter_msgs(self, stream, subject, since, min_id=None, before_id=None,
+                  newest_first=False, batch_size=1000):
+        """ Iterate over cached messages reading them in batches.
+
+        Takes the same arguments than get_msgs, but only batch_size messages
+        are read from the database at a time.
+        """
+
+        while True:
+            query = ["SELECT", ", ".join(self.FIELDS), "FROM messages",
+                     "WHERE stream = ? AND timestamp > ?"]
+            params = [stream, since]
+
+            if subject is not None:
+                query.append("AND subject = ?")
+                params.append(subject)
+
+            if min_id is not None:
+                query.append("AND id >= ?")
+                params.append(min_id)
+
+            if before_id is not None:
+                query.append("AND id < ?")
+                params.append(before_id)
+
+            query.append("ORDER BY id DESC" if newest_first else "ORDER BY id")
+            query.append("LIMIT ?")
+            params.append(batch_size)
+
+            with self.lock:
+                rows = self.conn.execute(" ".join(query), params).fetchall()
+
+            for row in rows:
+                yield CompactMsg(*row)
+
+            if len(rows) < batch_size:
+                return
+
+            # next batch starts after the last message read
+            if newest_first:
+                before_id = rows[-1][0]
+            else:
+                min_id = rows[-1][0] + 1
+
+    def evict(self, horizon):
+        """ Remove messages older than an epoch timestamp from the cache.
+
+        Args:
+            horizon: Epoch timestamp, messages not later are deleted.
+        """
+
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE timestamp <= ?",
+                              (horizon,))
+
+            coverages = self.conn.execute(
+                "SELECT stream, subject, floor FROM coverage").fetchall()
+
+            for stream, subject, floor in coverages:
+                if subject:
+                    low_id = self.conn.execute(
+                        "SELECT MIN(id) FROM messages "
+                        "WHERE stream = ? AND subject = ?",
+                        (stream, subject)).fetchone()[0]
+                else:
+                    low_id = self.conn.execute(
+                        "SELECT MIN(id) FROM messages WHERE stream = ?",
+                        (stream,)).fetchone()[0]
+
+                if low_id is None:
+                    self.conn.execute(
+                        "DELETE FROM coverage "
+                        "WHERE stream = ? AND subject = ?", (stream, subject))
+                else:
+                    self.conn.execute(
+                        "UPDATE coverage SET low_id = ?, floor = ? "
+                        "WHERE stream = ? AND subject = ?",
+                        (low_id, max(floor, horizon), stream, subject))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
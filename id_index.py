@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import bisect
+import threading
+
+
+class IdIndex():
+
+    """ Sparse map from timestamps to message ids of each stream.
+
+        Zulip can only be asked for messages around a message id, so a time
+        window is normally reached paging back from the latest message. The
+        index remembers some (timestamp, id) points of each stream, taken
+        from the pages retrieved and from the messages received, so the
+        message starting a window can be found with a binary search and the
+        window retrieved going forward from it.
+
+        Message ids grow with time, so every message later than the
+        timestamp of a point has a greater id than the point.
+
+        Attributes:
+            resolution: Minimum seconds between two points of a stream
+                taken from received messages.
+            max_points: Points kept per stream (every other point is dropped
+                when there are more).
+    """
+
+    def __init__(self, resolution=60, max_points=2000):
+        self.resolution = resolution
+        self.max_points = max_points
+
+        self.lock = threading.Lock()
+        self.timestamps = {}  # stream: sorted timestamps of the points
+        self.ids = {}  # stream: ids of the points (same order)
+
+    def add(self, stream, msg_id, timestamp):
+        """ Add the point of a message received (if the last one is older
+        than resolution seconds).
+        """
+
+        with self.lock:
+            timestamps = self.timestamps.get(stream)
+            if timestamps and timestamp - timestamps[-1] < self.resolution:
+                return
+            self._insert(stream, msg_id, timestamp)
+
+    def add_msgs(self, stream, msgs):
+        """ Add the points of the first and last messages of a page. """
+
+        if not msgs:
+            return
+
+        with self.lock:
+            for msg in (msgs[0], msgs[-1]):
+                self._insert(stream, msg["id"], msg["timestamp"])
+
+    def floor(self, stream, timestamp):
+        """ Latest point of a stream not later than a timestamp.
+
+        Returns:
+            Tuple (id, timestamp), or None if no point is that old.
+        """
+
+        with self.lock:
+            timestamps = self.timestamps.get(stream, [])
+            index = bisect.bisect_right(timestamps, timestamp)
+            if not index:
+                return None
+            return self.ids[stream][index - 1], timestamps[index - 1]
+
+    def split(self, stream, start, parts):
+        """ Split the messages of a stream later than a point in ranges.
+
+        Args:
+            stream: Zulip stream of the messages.
+            start: Point (id, timestamp) where the first range starts.
+            parts: Maximum number of ranges.
+
+        Returns:
+            Points (id, timestamp) where each range starts, the first one is
+            start and the last range has no end.
+        """
+
+        with self.lock:
+            ids = self.ids.get(stream, [])
+            first = bisect.bisect_right(ids, start[0])
+            later = zip(ids[first:], self.timestamps[stream][first:]) \
+                if ids else []
+
+        step = float(len(later) + 1) / max(1, parts)
+        starts = [start]
+        for part in range(1, parts):
+            index = int(part * step) - 1
+            if index >= 0 and later[index] not in starts:
+                starts.append(later[index])
+
+        return starts
+
+    def dump(self):
+        """ Copy the index as {stream: [[id, timestamp], ...]}. """
+
+        with self.lock:
+            return {stream: zip(self.ids[stream], timestamps)
+                    for stream, timestamps in self.timestamps.items()}
+
+    def load(self, points):
+        """ Add points dumped (e.g. from a snapshot). """
+
+        with self.lock:
+            for stream, stream_points in points.items():
+                for msg_id, timestamp in stream_points:
+                    self._insert(stream, msg_id, timestamp)
+
+    def _insert(self, stream, msg_id, timestamp):
+        ids = self.ids.setdefault(stream, [])
+        timestamps = self.timestamps.setdefault(stream, [])
+
+        index = bisect.bisect_left(ids, msg_id)
+        if index < len(ids) and ids[index] == msg_id:
+            return
+        ids.insert(index, msg_id)
+        timestamps.insert(index, timestamp)
+
+        # the latest point is kept, it is the most useful one
+        if len(ids) > self.max_points:
+            del ids[-2::-2]
+            del timestamps[-2::-2]
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import bisect
+import cProfile
+import logging
+import os
+import pstats
+import random
+import StringIO
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _NoSpan():
+
+    """ Span doing nothing, used when metrics are disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class _Span():
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.time() - self.start,
+                             **self.labels)
+        return False
+
+
+class Metrics():
+
+    """ Counters and latency histograms of the bot, in Prometheus format.
+
+        Metrics are identified by a name and labels (e.g.
+        observe("pingbot_stage_seconds", 0.1, stage="send")). Gauges are
+        read when rendering from the collectors added (functions returning a
+        dict of metric name to value).
+
+        Attributes:
+            buckets: Upper bounds (seconds) of the histogram buckets.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels): value
+        self.histograms = {}  # (name, labels): [bucket counts, sum, count]
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        """ Increment a counter. """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """ Add a duration to a histogram. """
+
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def span(self, name, **labels):
+        """ Context manager timing a block into a histogram. """
+
+        return _Span(self, name, labels)
+
+    def add_collector(self, collector):
+        """ Add a function returning gauges {name: value} when rendering. """
+
+        self.collectors.append(collector)
+
+    def render(self):
+        """ Render every metric in the Prometheus text format. """
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(values[0]), values[1], values[2]))
+                                for key, values in self.histograms.items())
+
+        lines = []
+        typed = set()
+
+        def add_type(name, metric_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s %s" % (name, metric_type))
+
+        for (name, labels), value in counters:
+            add_type(name, "counter")
+            lines.append("%s%s %s" % (name, _labels(labels), value))
+
+        for (name, labels), (buckets, total, count) in histograms:
+            add_type(name, "histogram")
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), buckets):
+                cumulative += bucket
+                lines.append("%s_bucket%s %d" % (
+                    name, _labels(labels + (("le", bound),)), cumulative))
+            lines.append("%s_sum%s %s" % (name, _labels(labels), total))
+            lines.append("%s_count%s %d" % (name, _labels(labels), count))
+
+        for collector in self.collectors:
+            for name, value in sorted(collector().items()):
+                add_type(name, "gauge")
+                lines.append("%s %s" % (name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """ Serve the metrics on http://host:port/metrics from a thread. """
+
+        server = _MetricsServer((host, port), _MetricsHandler)
+        server.metrics = self
+
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="metrics")
+        thread.daemon = True
+        thread.start()
+
+        return server
+
+    def write_periodically(self, path, interval=60):
+        """ Write the metrics to a file every interval seconds. """
+
+        def write():
+            while True:
+                time.sleep(interval)
+                with open(path + ".tmp", "w") as f:
+                    f.write(self.render().encode("utf-8"))
+                os.rename(path + ".tmp", path)
+
+        thread = threading.Thread(target=write, name="metrics-snapshot")
+        thread.daemon = True
+        thread.start()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, _escape("%s" % value))
+                             for key, value in labels)
+
+
+def _escape(value):
+    """ Escape a label value as the Prometheus text format requires. """
+
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        data = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class SlowPingProfiler():
+
+    """ Profile a sample of the pings and keep the slowest profiles.
+
+        Attributes:
+            rate: Fraction of the pings profiled (0 to 1).
+            keep: Number of slowest profiles kept.
+            directory: Where the slowest profiles are dumped, to be read
+                with pstats (None = only kept in memory).
+            slowest: List of (seconds, label, profile stats text), from the
+                slowest to the fastest.
+    """
+
+    def __init__(self, rate=0.01, keep=5, directory=None):
+        self.rate = rate
+        self.keep = keep
+        self.directory = directory
+
+        self.lock = threading.Lock()
+        self.slowest = []
+
+    def run(self, label, func, *args):
+        """ Call a function, profiling it if it is sampled. """
+
+        if random.random() >= self.rate:
+            return func(*args)
+
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self._keep(time.time() - start, label, profile)
+
+    def _keep(self, seconds, label, profile):
+        with self.lock:
+            if len(self.slowest) >= self.keep and \
+                    seconds <= self.slowest[-1][0]:
+                return
+
+            text = StringIO.StringIO()
+            pstats.Stats(profile, stream=text).sort_stats(
+                "cumulative").print_stats(30)
+            self.slowest.append((seconds, label, text.getvalue()))
+            self.slowest.sort(key=lambda profiled: -profiled[0])
+            del self.slowest[self.keep:]
+
+        logger.info("profiled slow ping (%.3fs): %s", seconds, label)
+        if self.directory:
+            profile.dump_stats(os.path.join(
+                self.directory, "ping-%.3fs-%d.prof" % (seconds, time.time())))
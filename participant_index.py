@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from collections import OrderedDict
+import threading
+
+
+class ParticipantIndex():
+
+    """ In-memory index of the participants of each stream-subject.
+
+        The index is fed with every message the bot receives from the live
+        event stream, and keeps for each (stream, subject) an ordered map of
+        sender full name to the timestamp when the sender was last seen,
+        from the earliest to the latest seen.
+
+        Attributes:
+            since: Epoch timestamp from when the index holds every message
+                (None = the index is not receiving messages yet).
+            stream_since: Later timestamp from when some streams are
+                complete (e.g. streams that were indexed by another shard).
+            high_ids: Id of the latest message indexed of each stream.
+    """
+
+    def __init__(self):
+        self.since = None
+        self.stream_since = {}
+        self.lock = threading.Lock()
+        self.topics = {}
+        self.high_ids = {}
+
+    def start(self, since):
+        """ Mark the index as complete for messages later than a timestamp. """
+
+        self.since = since
+
+    def start_stream(self, stream, since):
+        """ Mark a stream as complete only for messages later than a
+        timestamp (when it is later than since).
+        """
+
+        with self.lock:
+            self.stream_since[stream] = max(
+                since, self.stream_since.get(stream, since))
+
+    def add(self, msg):
+        """ Update the index with a message received by the bot.
+
+        Args:
+            msg: Zulip message (dict) as received from the event stream.
+        """
+
+        if msg.get("type") != "stream":
+            return
+
+        key = (msg["display_recipient"], msg["subject"])
+        name, timestamp = msg["sender_full_name"], msg["timestamp"]
+        with self.lock:
+            self.high_ids[key[0]] = max(self.high_ids.get(key[0], 0),
+                                        msg["id"])
+
+            senders = self.topics.setdefault(key, OrderedDict())
+            if senders.get(name, timestamp) > timestamp:
+                return
+
+            senders.pop(name, None)
+            latest = senders[next(reversed(senders))] if senders else None
+            senders[name] = timestamp
+
+            # messages retrieved late (e.g. by a backfill) keep senders sorted
+            if latest is not None and timestamp < latest:
+                self.topics[key] = OrderedDict(
+                    sorted(senders.items(), key=lambda item: item[1]))
+
+    def covers(self, timestamp, stream=None):
+        """ Check if every message later than a timestamp is indexed (of a
+        stream, or of every stream if None).
+        """
+
+        if self.since is None:
+            return False
+
+        if stream is None:
+            since = max([self.since] + self.stream_since.values())
+        else:
+            since = max(self.since, self.stream_since.get(stream, self.since))
+        return timestamp >= since
+
+    def dump(self):
+        """ Copy the index as a list of (stream, subject, [(name, ts)...]). """
+
+        with self.lock:
+            return [(stream, subject, senders.items())
+                    for (stream, subject), senders in self.topics.items()]
+
+    def load(self, topics, high_ids, stream_since=None):
+        """ Fill the index with topics dumped (e.g. from a snapshot).
+
+        Args:
+            topics: Iterable of (stream, subject, [(name, timestamp)...]).
+            high_ids: Id of the latest message indexed of each stream.
+            stream_since: Later timestamp from when some streams are
+                complete (optional).
+        """
+
+        with self.lock:
+            for stream, subject, senders in topics:
+                self.topics[(stream, subject)] = OrderedDict(senders)
+            self.high_ids.update(high_ids)
+            self.stream_since.update(stream_since or {})
+
+    def get_since(self, stream, subject, timestamp, issuer=None):
+        """ Get senders seen in a stream-subject later than a timestamp.
+
+        Args:
+            stream: Zulip stream of the participants.
+            subject: Subject of the participants (None = every topic).
+            timestamp: Epoch timestamp from when participants are collected.
+            issuer: Participant that will be left out (optional).
+
+        Returns:
+            Full names of the participants, from the earliest to the latest.
+        """
+
+        participants = []
+        with self.lock:
+            senders = self._senders(stream, subject)
+            for name in reversed(senders):
+                if senders[name] <= timestamp:
+                    break
+                if name != issuer:
+                    participants.append(name)
+
+        participants.reverse()
+        return participants
+
+    def prune(self, before):
+        """ Forget senders last seen at or before a timestamp (and the
+        topics left without senders), so the index does not grow forever.
+        """
+
+        with self.lock:
+            for stream, since in self.stream_since.items():
+                if since <= before:
+                    del self.stream_since[stream]
+
+            for key, senders in self.topics.items():
+                while senders and senders[next(iter(senders))] <= before:
+                    senders.popitem(last=False)
+                if not senders:
+                    del self.topics[key]
+
+    def get_last(self, stream, subject, num, issuer=None, since=None):
+        """ Get the last distinct senders of a stream-subject.
+
+        Args:
+            stream: Zulip stream of the participants.
+            subject: Subject of the participants (None = every topic).
+            num: Maximum number of participants to return.
+            issuer: Participant that will be left out (optional).
+            since: Senders last seen before this timestamp are not returned
+                (optional, e.g. the start of the index, as older ones may
+                not be the last ones).
+
+        Returns:
+            Full names of the participants, from the latest to the earliest.
+        """
+
+        participants = []
+        with self.lock:
+            senders = self._senders(stream, subject)
+            for name in reversed(senders):
+                if len(participants) >= num or \
+                        since is not None and senders[name] < since:
+                    break
+                if name != issuer:
+                    participants.append(name)
+
+        return participants
+
+    def _senders(self, stream, subject):
+        """ Senders of a topic (or of every topic of a stream, if subject is
+        None) with their latest timestamp, from the earliest to the latest.
+        """
+
+        if subject is not None:
+            return self.topics.get((stream, subject), OrderedDict())
+
+        latest = {}
+        for (topic_stream, _), senders in self.topics.iteritems():
+            if topic_stream == stream:
+                for name, timestamp in senders.iteritems():
+                    latest[name] = max(timestamp, latest.get(name, 0))
+
+        return OrderedDict(sorted(latest.items(), key=lambda item: item[1]))
+
+
+class ParticipantCollector():
+
+    """ Distinct participants of a bunch of messages, in order of appearance.
+
+        Senders are keyed by sender_id, and whether a sender is left out
+        (the issuer of the ping or a bot) is decided only the first time the
+        sender is seen, so each message costs a set lookup or two. The name
+        of the latest message of a sender is kept (users can be renamed, and
+        pinging an old name notifies nobody), whatever the order of the
+        messages. Ping strings are only built at the end, by format().
+
+        Attributes:
+            issuer: Full name of the participant that will be left out.
+            is_bot: Function telling if a message was sent by a bot.
+    """
+
+    def __init__(self, issuer=None, is_bot=None):
+        self.issuer = issuer
+        self.is_bot = is_bot
+        self.seen = set()  # sender ids already checked
+        self.names = OrderedDict()  # sender id: full name of participants
+        self.name_ids = {}  # sender id: id of the message of the name kept
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_all(self, msgs, limit=None):
+        """ Collect the senders of some messages.
+
+        Args:
+            msgs: Messages (any iterable, consumed lazily).
+            limit: Stop consuming messages once this many participants were
+                collected (optional).
+        """
+
+        seen = self.seen
+        names = self.names
+        name_ids = self.name_ids
+
+        if limit is not None and len(names) >= limit:
+            return
+
+        for msg in msgs:
+            sender_id = msg["sender_id"]
+            if sender_id in seen:
+                if sender_id in name_ids and msg["id"] > name_ids[sender_id]:
+                    names[sender_id] = msg["sender_full_name"]
+                    name_ids[sender_id] = msg["id"]
+                continue
+
+            seen.add(sender_id)
+            if msg["sender_full_name"] == self.issuer or \
+                    self.is_bot and self.is_bot(msg):
+                continue
+
+            names[sender_id] = msg["sender_full_name"]
+            name_ids[sender_id] = msg["id"]
+            if limit is not None and len(names) >= limit:
+                return
+
+    def format(self, ping_ini="@**", ping_end="**"):
+        """ Create the strings used to ping the participants collected. """
+
+        return ["".join([ping_ini, name, ping_end])
+                for name in OrderedDict.fromkeys(self.names.itervalues())]
@@ -2,12 +2,76 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
-import zulip
-import requests
+import bisect
 import os
-import parsley
+import re
+import sys
 import arrow
 import json
+import logging
+import signal
+import threading
+import time
+from collections import OrderedDict
+from itertools import izip_longest
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from history_cache import HistoryCache
+from participant_index import ParticipantIndex, ParticipantCollector
+from zulip_transport import ZulipTransport
+from dispatcher import Dispatcher
+from recorder import MessageRecorder
+from stream_cache import StreamCache
+from scan_cache import ScanCache
+from event_queue import EventQueue
+from metrics import Metrics, SlowPingProfiler, NO_SPAN
+from snapshot import Snapshot
+from send_queue import SendError, SendQueue, TokenBucket
+from compact_msg import CompactMsg
+from id_index import IdIndex
+from sharding import HashRing, Supervisor
+from preview_cache import Preview, PreviewCache
+
+logger = logging.getLogger(__name__)
+
+
+class _LazyGrammar(object):
+
+    """ Parsley grammar compiled (and parsley imported) on first use.
+
+        Compiling the grammar takes about as long as importing the rest of
+        the bot, and the common time strings never need it (see
+        _parse_time_str), so it is left out of the start up.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.grammar = None
+        self.lock = threading.Lock()
+
+    def __get__(self, obj, cls=None):
+        if self.grammar is None:
+            with self.lock:
+                if self.grammar is None:
+                    import parsley
+                    self.grammar = parsley.makeGrammar(self.rules, {})
+        return self.grammar
+
+
+class _Timestamps(object):
+
+    """ Timestamps of a list of messages, read only when looked at (a view
+        to bisect, without copying a whole chunk for every cut).
+    """
+
+    def __init__(self, msgs):
+        self.msgs = msgs
+
+    def __len__(self):
+        return len(self.msgs)
+
+    def __getitem__(self, index):
+        return self.msgs[index]["timestamp"]
 
 
 class PingingBot():
@@ -25,41 +89,202 @@ class PingingBot():
             key_word: Word that triggers the bot's action.
             short_key_word: Alternative short key word.
             subscribed_streams: Streams to suscribe ([] = all streams)
+            history_path: Path of the local messages history cache (None =
+                always ask Zulip for the whole history).
+            pool_size: Connections kept alive to call the Zulip REST API.
+            workers: Threads responding to trigger messages concurrently.
+            max_queue: Maximum trigger messages waiting for a worker.
+            recorder: MessageRecorder capturing the messages of some pings
+                (None = nothing is captured).
+            site: Url of the Zulip server (None = Zulip default server).
+            scan_ttl: Seconds the messages retrieved for a ping are reused
+                by other pings of the same stream-subject.
+            pooled_client: Listen to events and send messages through the
+                pooled ZulipTransport instead of the blocking zulip.Client.
+            profiler: SlowPingProfiler profiling a sample of the pings
+                (None = pings are not profiled).
+            snapshot_path: File where the participant index is saved to
+                start warm after a restart (None = always start cold).
+            backfill_workers: Streams caught up in parallel when starting
+                from a snapshot.
+            shard: Tuple (shard, number of shards) to only subscribe to and
+                answer the streams of a shard (None = every stream).
+            defer_subscriptions: Subscribe to the streams in the background
+                once main() is listening, instead of before returning.
     """
 
-    CHUNK_SIZE = 5000  # size of the chunk of messages asked each time
+    CHUNK_SIZE = 5000  # maximum size of the chunks of messages asked
+    MIN_CHUNK_SIZE = 100  # size of the chunks when nothing is known
+    CHUNK_MARGIN = 1.25  # chunks are sized for 25% more messages than needed
+    SUBSCRIBE_BATCH = 100  # streams subscribed in each call
+    STREAMS_TTL = 300  # seconds the list of all streams is used
+    LAST_MSG_ANCHOR = 18446744073709551615  # maximum 64-bit int: last message
     PING_INI = "@**"  # initial string required to ping a user name
     PING_END = "**"  # final string required to ping a user name
 
+    # grammar of the time strings ("2w", "m2", "10min", "today", etc.)
+    TIME_GRAMMAR_RULES = """
+        today = 'today' ws -> (0, "d")
+        this = 'this' ws <letter+>:freq -> (0, freq[0])
+
+        min = 'min' letter* ws <digit*>:num -> (int(num or 0), "min")
+        min2 = <digit*>:num ws 'min' letter* -> (int(num or 0), "min")
+
+        t1 = <letter+>:freq ws <digit*>:num -> (int(num or 0), freq[0])
+        t2 = <digit*>:num ws <letter+>:freq -> (int(num or 0), freq[0])
+
+        time_expr = today | this | min | min2 | t1 | t2
+        issuer_msg = ' ' ws <anything*>:msg -> msg
+
+        message = time_expr:time issuer_msg?:msg -> (time, msg)
+
+        link_stream = <(~'**' ~'>' anything)+>
+        link_topic = <(~'**' anything)+>
+        source = '#**' link_stream:stream ('>' link_topic)?:topic '**'
+            -> (stream.strip(), topic.strip() if topic else None)
+        sources = 'in' ws source:first (ws ','? ws source)*:rest
+            -> [first] + rest
+        sources_clause = sources:sources <anything*>:rest -> (sources, rest)
+        """
+    TIME_GRAMMAR = _LazyGrammar(TIME_GRAMMAR_RULES)
+
+    # fast paths for the most common time strings (see _parse_time_str)
+    NUM_RE = re.compile(r"^[0-9]+$")
+    THIS_RE = re.compile(r"^this ?([a-z]+)(?: (.*))?$")
+    NUM_FREQ_RE = re.compile(
+        r"^(?P<num>[0-9]+) ?(?P<freq>[a-z]+)(?: (?P<msg>.*))?$")
+    FREQ_NUM_RE = re.compile(
+        r"^(?P<freq>[a-z]+)(?: ?(?P<num>[0-9]+)(?: (?P<msg>.*))?)?$")
+
+    history = None  # local cache of the streams messages (see HistoryCache)
+    topic_narrow = True  # ask Zulip for the messages of a subject only
+    msgs_fetched = 0  # messages retrieved from Zulip so far
+    bytes_fetched = 0  # bytes of messages retrieved from Zulip so far
+    msgs_kept = 0  # messages retrieved actually used so far
+    fetch_lock = threading.Lock()  # guards the totals above
+    fetch_local = threading.local()  # counters of each thread's searches
+    participant_index = None  # participants seen since the bot is listening
+    dispatcher = None  # queue of trigger messages served by worker threads
+    recorder = None  # opt-in capture of the messages of some pings
+    stream_cache = None  # names of all the streams (see StreamCache)
+    scan_cache = None  # history scans shared by concurrent pings
+    msg_rates = None  # messages per second seen in each stream-subject
+    rates_lock = threading.Lock()  # guards msg_rates
+    MAX_RATES = 10000  # stream-subjects whose rate is kept (the most recent)
+    event_queue = None  # events long-polled with the transport (pooled)
+    client = None  # blocking zulip.Client (when not pooled)
+    client_queue = None  # event queue registered with the zulip.Client
+    EVENT_TYPES = ["message", "stream"]  # events listened to
+    metrics = None  # counters and timing of the stages of the pings
+    profiler = None  # opt-in profiling of the slowest pings
+    SLOW_PING = 10  # seconds from which a ping is logged as slow
+    MAX_SOURCES = 10  # topics or streams that can be pinged at once
+    SOURCE_WORKERS = 4  # topics or streams collected in parallel
+    SOURCE_TIMEOUT = 20  # seconds to collect the participants of a source
+    source_pool = None  # threads collecting sources (shared by the pings)
+    pools_lock = threading.Lock()  # guards the creation of the pools
+    private_streams = frozenset()  # invite-only streams, never a source
+    id_index = None  # message ids where time windows start (see IdIndex)
+    RANGE_WORKERS = 4  # ranges of a time window retrieved in parallel
+    range_pool = None  # threads retrieving ranges (shared by the pings)
+    ring = None  # streams of each shard, when the bot is sharded
+    shard = 0  # shard of this bot (see HashRing)
+    snapshot = None  # saved participant index to start warm (see Snapshot)
+    SNAPSHOT_INTERVAL = 300  # seconds between snapshots
+    MAX_BACKFILL = 20000  # messages caught up per stream from a snapshot
+    backfill_workers = 4  # streams caught up in parallel from a snapshot
+    send_queue = None  # outbound messages sent by a background thread
+    MAX_MESSAGE_LENGTH = 10000  # longer pings are split in several messages
+    SEND_RATE = 3.0  # messages sent per second until Zulip tells its limit
+    SEND_BURST = 10  # messages that can be sent at once
+    decode_msg = staticmethod(CompactMsg.from_json)  # JSON messages hook
+    MENTIONS_SEP_RE = re.compile(r"(?<=\*\*) (?=@\*\*)")
+    preview_cache = None  # participants previewed privately (see Preview)
+    PREVIEW_TTL = 600  # seconds a preview is kept after its last command
+    PREVIEW_COMMANDS = ("preview", "confirm", "exclude", "extend", "cancel")
+    PREVIEW_TOKEN_RE = re.compile(r"^[0-9a-f]{6}$")  # see PreviewCache.add
+    defer_subscriptions = False  # subscribe once main() is listening
+    subscribed = None  # set once the streams were subscribed
+
     def __init__(self, zulip_username, zulip_api_key, key_word, short_key_word,
-                 subscribed_streams=[]):
+                 subscribed_streams=[], history_path=None, pool_size=10,
+                 workers=4, max_queue=100, recorder=None, site=None,
+                 scan_ttl=30, pooled_client=False, profiler=None,
+                 snapshot_path=None, backfill_workers=4, shard=None,
+                 defer_subscriptions=False):
         self.username = zulip_username
         self.api_key = zulip_api_key
         self.key_word = key_word.lower()
         self.short_key_word = short_key_word.lower()
         self.subscribed_streams = subscribed_streams
-
-        self.client = zulip.Client(zulip_username, zulip_api_key)
-        self.subscriptions = self.subscribe_to_streams()
+        self.site = site
+        if shard:
+            self.shard = shard[0]
+            self.ring = HashRing(shard[1])
+        self.transport = ZulipTransport(
+            zulip_username, zulip_api_key,
+            site.rstrip("/") + "/api/v1" if site else ZulipTransport.API_URL,
+            pool_size=pool_size)
+
+        if history_path:
+            self.history = HistoryCache(history_path)
+        self.participant_index = ParticipantIndex()
+        self.dispatcher = Dispatcher(self.respond, workers, max_queue)
+        self.recorder = recorder
+        self.scan_cache = ScanCache(scan_ttl)
+        self.profiler = profiler
+        self.metrics = Metrics()
+        self.metrics.add_collector(self._gauges)
+        self.snapshot = Snapshot(snapshot_path) if snapshot_path else None
+        self.backfill_workers = backfill_workers
+        self.id_index = IdIndex()
+        self.send_queue = SendQueue(
+            self._deliver, TokenBucket(self.SEND_RATE, self.SEND_BURST),
+            metrics=self.metrics)
+        self.preview_cache = PreviewCache(self.PREVIEW_TTL)
+
+        self.stream_cache = StreamCache(self._fetch_streams, self.STREAMS_TTL)
+        self.subscribe_workers = pool_size
+
+        if pooled_client:
+            self.event_queue = EventQueue(self.transport)
+            self.client = None
+        else:
+            import zulip  # only the blocking client needs it
+            self.client = zulip.Client(zulip_username, zulip_api_key,
+                                       site=site)
+
+        self.subscribed = threading.Event()
+        self.defer_subscriptions = defer_subscriptions
+        if defer_subscriptions:
+            self.failed_subscriptions = []
+        else:
+            self.failed_subscriptions = self.subscribe_to_streams()
+            self.subscribed.set()
 
     @property
     def streams(self):
         """ Standardizes a list of streams in the form [{'name': stream}]. """
 
         if not self.subscribed_streams:
-            streams = [{'name': stream['name']}
-                       for stream in self.get_all_zulip_streams()]
+            streams = [{'name': name} for name in self.stream_cache.get()
+                       if self.owns(name)]
             return streams
 
         else:
-            streams = [{'name': stream} for stream in self.subscribed_streams]
+            streams = [{'name': stream} for stream in self.subscribed_streams
+                       if self.owns(stream)]
             return streams
 
+    def owns(self, key):
+        """ Check if a stream (or a private sender) belongs to this shard. """
+
+        return self.ring is None or self.ring.shard_of(key) == self.shard
+
     def get_all_zulip_streams(self):
         """ Call Zulip API to get a list of all streams. """
 
-        response = requests.get('https://api.zulip.com/v1/streams',
-                                auth=(self.username, self.api_key))
+        response = self.transport.get("streams")
 
         if response.status_code == 200:
             return response.json()['streams']
@@ -70,10 +295,109 @@ class PingingBot():
         else:
             raise RuntimeError(':( we failed to GET streams.\n(%s)' % response)
 
-    def subscribe_to_streams(self):
-        """ Subscribes to zulip streams. """
+    def _fetch_streams(self, etag=None):
+        """ Get the names of all streams unless they did not change.
 
-        self.client.add_subscriptions(self.streams)
+        Args:
+            etag: ETag of the last list of streams received (optional).
+
+        Returns:
+            Tuple (names of the streams, ETag of the list) or None if the
+            streams did not change since the etag.
+        """
+
+        headers = {"If-None-Match": etag} if etag else {}
+        response = self.transport.get("streams", headers=headers)
+
+        if response.status_code == 304:
+            return None
+
+        elif response.status_code == 401:
+            raise RuntimeError('check yo auth')
+
+        elif response.status_code != 200:
+            raise RuntimeError(':( we failed to GET streams.\n(%s)' % response)
+
+        streams = response.json()['streams']
+        self.private_streams = frozenset(stream['name'] for stream in streams
+                                         if stream.get('invite_only'))
+
+        names = [stream['name'] for stream in streams]
+        return names, response.headers.get("ETag")
+
+    def subscribe_to_streams(self, streams=None):
+        """ Subscribes to zulip streams, in batches sent in parallel.
+
+        Args:
+            streams: Streams in the form [{'name': stream}] (None = all the
+                streams of the bot).
+
+        Returns:
+            Names of the streams that could not be subscribed.
+        """
+
+        start = time.time()
+        if streams is None:
+            streams = self.streams
+
+        batches = [streams[i:i + self.SUBSCRIBE_BATCH]
+                   for i in range(0, len(streams), self.SUBSCRIBE_BATCH)]
+        if not batches:
+            return []
+
+        pool = ThreadPool(min(self.subscribe_workers, len(batches)))
+        try:
+            failed = sum(pool.map(self._subscribe_batch, batches), [])
+        finally:
+            pool.close()
+
+        logger.info("subscribed to %d streams in %.2f seconds, %d failed",
+                    len(streams) - len(failed), time.time() - start,
+                    len(failed))
+
+        return failed
+
+    def _subscribe_batch(self, streams):
+        """ Subscribe to some streams returning the ones that failed. """
+
+        try:
+            response = self.transport.post(
+                "users/me/subscriptions",
+                data={"subscriptions": json.dumps(streams)})
+        except IOError as error:
+            logger.warning("subscription failed: %s", error)
+            return [stream['name'] for stream in streams]
+
+        if response.status_code != 200:
+            logger.warning("subscription failed: %s", response.content)
+            return [stream['name'] for stream in streams]
+
+        return response.json().get("unauthorized", [])
+
+    def on_stream_event(self, event):
+        """ Keep the streams up to date with streams created or deleted.
+
+            Args:
+                event: Zulip event of type "stream".
+        """
+
+        names = [stream['name'] for stream in event.get("streams", [])]
+
+        if event.get("op") == "create":
+            for name in names:
+                self.stream_cache.add(name)
+            self.private_streams = self.private_streams.union(
+                stream['name'] for stream in event.get("streams", [])
+                if stream.get('invite_only'))
+
+            # subscribing must not hold the messages behind the event
+            if not self.subscribed_streams:
+                self._subscribe_in_background(
+                    [{'name': name} for name in names if self.owns(name)])
+
+        elif event.get("op") == "delete":
+            for name in names:
+                self.stream_cache.remove(name)
 
     def respond(self, msg):
         """ If key_word in msg, ping participants of the subject.
@@ -82,52 +406,430 @@ class PingingBot():
                 msg: Zulip message listen by the bot.
         """
 
-        # decode message if not unicode
-        if type(msg["content"]) is not unicode:
-            msg["content"] = msg["content"].decode("utf-8", "ignore")
+        if not self._is_trigger(msg):
+            return
 
-        first_word = msg['content'].split()[0].lower().strip()
-        if self.key_word == first_word or self.short_key_word == first_word:
+        start = time.time()
+        if self.profiler:
+            self.profiler.run(msg["content"], self._respond, msg)
+        else:
+            self._respond(msg)
+        seconds = time.time() - start
 
-            # try to parse message looking for time string or participants num
-            time, num_participants = None, None
-            time, issuer_msg = self.parse_time(msg["content"])
-            num_participants = self.parse_num_participants(msg["content"])
+        if self.metrics:
+            self.metrics.observe("pingbot_ping_seconds", seconds)
+        if seconds >= self.SLOW_PING:
+            logger.warning("slow ping (%.1fs): %s", seconds, msg["content"])
+
+    def _respond(self, msg):
+        """ Ping participants of the subject of a trigger message.
+
+            The trigger may name other topics or streams to ping instead of
+            its own subject (see parse_sources), or be a command of the
+            private preview of a ping (see _respond_preview).
 
-            # use time if succesful parsing
-            if time:
-                msgs = self.get_msgs(
-                    time, msg["display_recipient"], msg["subject"])
+            Stages are timed (parse, collect, format and send). Collecting
+            participants includes retrieving the history, timed by page too
+            (fetch_page).
 
-                participants = self.get_participants(
-                    msgs, msg["sender_full_name"])
+            Args:
+                msg: Zulip message starting with the key word.
+        """
 
+        preview_command = self._preview_command(msg)
+        if preview_command:
+            self._respond_preview(msg, *preview_command)
+            return
+
+        # try to parse message looking for time string or participants num
+        with self._span("parse"):
+            time, num_participants = None, None
+            sources, content = self.parse_sources(msg["content"])
+            time, issuer_msg = self.parse_time(content)
+            num_participants = self.parse_num_participants(content)
+
+        # participants of private streams are not disclosed to other ones
+        refused = [source for source in sources or []
+                   if source[0] != msg["display_recipient"] and
+                   not self._is_public(source[0])]
+        if refused:
+            sources = [source for source in sources if source not in refused]
+            if not sources:
+                self._send_private(msg["sender_email"], "Only the topics of "
+                                   "public streams can be pinged from "
+                                   "another stream.")
+                return
+
+        # use time if succesful parsing
+        if time:
+            with self._span("collect"):
+                participants, failed = self._collect(
+                    self.get_participants_since, time, msg, sources)
+
+            with self._span("format"):
                 ping_msg = self.ping_participants_msg(msg, participants, time,
                                                       issuer_msg)
+            self._count("pingbot_pings_total", kind="time")
 
-            # otherwise, participants number could be provided
-            elif num_participants:
-                participants = self.get_last_participants(
-                    num_participants, msg["display_recipient"],
-                    msg["subject"], msg["sender_full_name"])
+        # otherwise, participants number could be provided
+        elif num_participants:
+            with self._span("collect"):
+                participants, failed = self._collect(
+                    self.get_last_participants, num_participants, msg,
+                    sources)
 
+            with self._span("format"):
                 ping_msg = self.ping_last_participants_msg(msg, participants)
+            self._count("pingbot_pings_total", kind="num")
+
+        # any other message formatting, triggers the maximum time range
+        else:
+            time = self._get_shifted_time(3, "m")
+
+            with self._span("collect"):
+                participants, failed = self._collect(
+                    self.get_participants_since, time, msg, sources)
+
+            with self._span("format"):
+                ping_msg = self.ping_participants_msg(msg, participants, time)
+            self._count("pingbot_pings_total", kind="default")
+
+        if failed:
+            ping_msg["content"] += "\n_Participants of %s could not be " \
+                "collected in time._" % ", ".join(
+                    self._format_source(source) for source in failed)
+        if refused:
+            ping_msg["content"] += "\n_%s not pinged: only the topics of " \
+                "public streams can be pinged from another stream._" % \
+                ", ".join(self._format_source(source) for source in refused)
+        ping_msg["to"] = ping_msg["display_recipient"]
+
+        with self._span("send"):
+            self.send_message(ping_msg)
 
-            # any other message formatting, triggers the maximum time range
+    def _collect(self, get, arg, msg, sources):
+        """ Collect participants of the trigger subject or of some sources.
+
+        Args:
+            get: get_participants_since or get_last_participants.
+            arg: Time or number of participants passed to get.
+            msg: Trigger message.
+            sources: Topics or streams to ping (None = the trigger subject).
+
+        Returns:
+            Tuple (participants, sources that failed or timed out).
+        """
+
+        if not sources:
+            return get(arg, msg["display_recipient"], msg["subject"],
+                       msg["sender_full_name"]), []
+
+        limit = None if get == self.get_participants_since else arg
+        return self.get_participants_from(sources, get, arg,
+                                          msg["sender_full_name"], limit)
+
+    def _respond_preview(self, msg, command, args):
+        """ Answer a command of the private preview of a ping.
+
+            "preview [time] [message]" collects the participants of the
+            trigger subject once and sends them privately to the issuer
+            under a token. The issuer then works on the participants kept
+            with that token (in private or in the stream):
+
+            - "confirm <token>" sends the ping, without retrieving history.
+            - "exclude <token> Name, Name" leaves some participants out.
+            - "extend <token> <time>" adds the participants of older
+              messages, only retrieving the messages not scanned yet.
+            - "cancel <token>" drops the preview.
+
+            Args:
+                msg: Zulip message starting with the key word.
+                command: One of PREVIEW_COMMANDS.
+                args: Rest of the message after the command.
+        """
+
+        key_word = msg["content"].split()[0]
+        self._count("pingbot_previews_total", command=command)
+
+        if command == "preview":
+            if msg.get("type") != "stream":
+                self._send_private(msg["sender_email"], "A preview can only "
+                                   "be asked for in the topic to ping.")
+                return
+            with self._span("collect"):
+                preview = self._preview(msg, " ".join([key_word, args]))
+            token = self.preview_cache.add(preview, self.owns)
+            self._send_preview(preview, token, key_word)
+            return
+
+        token, _, rest = args.partition(" ")
+        preview = self.preview_cache.get(token, msg["sender_email"])
+        if not preview:
+            self._send_private(msg["sender_email"], "Preview `%s` is unknown "
+                               "or expired." % token)
+            return
+
+        with preview.lock:
+            if command == "confirm":
+                if self.preview_cache.remove(token):
+                    with self._span("send"):
+                        self.send_message(self._preview_ping(preview))
+                    self._count("pingbot_pings_total", kind="preview")
+                return
+
+            if command == "cancel":
+                if self.preview_cache.remove(token):
+                    self._send_private(preview.issuer_email,
+                                       "Preview `%s` cancelled." % token)
+                return
+
+            if command == "exclude":
+                self._exclude(preview, rest)
+            elif command == "extend":
+                since, _ = self.parse_time(" ".join([key_word, rest]))
+                if since and since < preview.since:
+                    with self._span("collect"):
+                        self._extend_preview(preview, since)
+
+            self._send_preview(preview, token, key_word)
+
+    def _preview(self, msg, content):
+        """ Collect the participants of a preview of the trigger subject.
+
+        Args:
+            msg: Trigger message asking for the preview.
+            content: Content with the time and message of the ping (the
+                maximum time range is used when there is no time).
+        """
+
+        time, issuer_msg = self.parse_time(content)
+        if not time:
+            time = self._get_shifted_time(3, "m")
+
+        stream, subject = msg["display_recipient"], msg["subject"]
+        preview = Preview(msg["sender_email"], msg["sender_full_name"],
+                          stream, subject, time,
+                          ParticipantCollector(msg["sender_full_name"],
+                                               self._bot_msg),
+                          issuer_msg)
+
+        counters = self._fetch_counters()
+        preview.collector.add_all(preview.track(
+            self.iter_msgs(time, stream, subject)))
+        self._record_fetch_stats(counters)
+
+        return preview
+
+    def _extend_preview(self, preview, since):
+        """ Add the participants of a preview from an earlier time.
+
+        Only messages older than the ones already scanned are retrieved,
+        going to the past from the oldest one.
+
+        Args:
+            preview: Preview to extend.
+            since: Time (earlier than the one of the preview) from when
+                participants will be collected.
+        """
+
+        counters = self._fetch_counters()
+        pages = self._iter_pages(preview.stream,
+                                 self._narrow_subject(preview.subject),
+                                 anchor=preview.oldest_id or
+                                 self.LAST_MSG_ANCHOR,
+                                 since=since.timestamp)
+        preview.collector.add_all(preview.track(self._iter_between(
+            pages, preview.subject, since.timestamp,
+            preview.since.timestamp)))
+        self._record_fetch_stats(counters)
+
+        preview.since = since
+
+    @classmethod
+    def _iter_between(cls, pages, subject, since, until):
+        """ Iterate from the latest to the earliest message of some pages
+        (see _iter_pages) later than since and not later than until.
+        """
+
+        for msgs_chunk, _ in pages:
+            for msg in reversed(msgs_chunk):
+                if msg["timestamp"] <= since:
+                    return
+                if msg["timestamp"] <= until and msg["subject"] == subject:
+                    yield msg
+
+    @classmethod
+    def _exclude(cls, preview, names_str):
+        """ Leave out of a preview the participants of a list of names
+        separated by commas (mentions are accepted too).
+        """
+
+        excluded = {name.strip(" @*").lower()
+                    for name in names_str.split(",")}
+        names = preview.collector.names
+
+        # excluded senders are still seen, so extending will not add them
+        for sender_id, name in names.items():
+            if name.lower() in excluded:
+                del names[sender_id]
+
+    def _send_preview(self, preview, token, key_word):
+        """ Send privately to its issuer the participants of a preview. """
+
+        names = preview.collector.format("**", "**")
+        content = "".join([
+            "Preview `", token, "` of the ping to #**", preview.stream, ">",
+            preview.subject, "** from ", preview.since.humanize(), " (",
+            str(len(names)), " participants)\n", " ".join(names), "\n",
+            "Reply `", key_word, " confirm ", token, "` to send it, `",
+            key_word, " exclude ", token, " Name, Name` to leave some "
+            "participants out, `", key_word, " extend ", token, " 6m` to "
+            "add older participants or `", key_word, " cancel ", token,
+            "`."])
+
+        self._send_private(preview.issuer_email, content)
+
+    def _send_private(self, email, content):
+        self.send_message({"type": "private", "to": email,
+                           "content": content})
+
+    def _preview_ping(self, preview):
+        """ Create the message pinging the participants of a preview. """
+
+        msg = {"type": "stream", "display_recipient": preview.stream,
+               "to": preview.stream, "subject": preview.subject,
+               "sender_full_name": preview.issuer_name}
+        participants = preview.collector.format(self.PING_INI, self.PING_END)
+
+        return self.ping_participants_msg(msg, participants, preview.since,
+                                          preview.issuer_msg)
+
+    def _span(self, stage):
+        """ Time a stage of the pings (if metrics are enabled). """
+
+        if not self.metrics:
+            return NO_SPAN
+        return self.metrics.span("pingbot_stage_seconds", stage=stage)
+
+    def _count(self, name, value=1, **labels):
+        if self.metrics:
+            self.metrics.inc(name, value, **labels)
+
+    def _gauges(self):
+        """ Current state of the queues and caches, for the metrics. """
+
+        gauges = {}
+        if self.dispatcher:
+            stats = self.dispatcher.get_stats()
+            gauges["pingbot_queue_depth"] = stats["depth"]
+            gauges["pingbot_queue_dropped"] = stats["dropped"]
+            gauges["pingbot_queue_max_wait_seconds"] = \
+                stats["max_wait_seconds"]
+        if self.scan_cache:
+            for name, value in self.scan_cache.get_stats().items():
+                gauges["pingbot_scan_cache_%s" % name] = value
+        if self.send_queue:
+            for name, value in self.send_queue.get_stats().items():
+                gauges["pingbot_send_queue_%s" % name] = value
+        if self.ring:
+            gauges["pingbot_shard"] = self.shard
+            gauges["pingbot_shard_topics"] = len(self.participant_index.topics)
+
+        return gauges
+
+    def send_message(self, msg):
+        """ Queue a message to be sent to Zulip (see SendQueue).
+
+            Messages longer than MAX_MESSAGE_LENGTH are split in several
+            messages, between the participants pinged.
+
+            Args:
+                msg: Message with its "type", "to", "subject" (only stream
+                    messages) and "content".
+        """
+
+        for content in self._split_content(msg["content"],
+                                           self.MAX_MESSAGE_LENGTH):
+            part = dict(msg, content=content)
+            if self.send_queue:
+                self.send_queue.put(part)
             else:
-                time = self._get_shifted_time(3, "m")
+                self._deliver(part)
 
-                msgs = self.get_msgs(
-                    time, msg["display_recipient"], msg["subject"])
+    def _deliver(self, msg):
+        """ Send a message to Zulip returning the response headers.
 
-                participants = self.get_participants(
-                    msgs, msg["sender_full_name"])
+            The message is sent once, the SendQueue decides if a failure is
+            retried (see SendError).
+        """
 
-                ping_msg = self.ping_participants_msg(msg, participants, time)
+        if not self.event_queue:
+            result = self.client.send_message(msg)
+            if result.get("result") != "success":
+                raise SendError(result.get("msg", result),
+                                retry=result.get("code") == "RATE_LIMIT_HIT")
+            return None
+
+        response = self.transport.post(
+            "messages", data={key: msg[key] for key in
+                              ("type", "to", "subject", "content")
+                              if key in msg}, retries=0)
+        if response.status_code != 200:
+            raise SendError(response.content,
+                            retry=response.status_code == 429,
+                            headers=response.headers)
+
+        return response.headers
 
-            ping_msg["to"] = ping_msg["display_recipient"]
+    @classmethod
+    def _split_content(cls, content, max_length):
+        """ Split a message in parts no longer than max_length.
+
+        Lines are kept whole when possible, and long lines are split between
+        mentions (or cut, if a single mention or word is too long).
+
+        Args:
+            content: Content of the message.
+            max_length: Maximum length of each part.
+        """
+
+        if len(content) <= max_length:
+            return [content]
+
+        parts, current = [], ""
+        for line_num, line in enumerate(content.split("\n")):
+            for word_num, word in enumerate(cls.MENTIONS_SEP_RE.split(line)):
+                sep = " " if word_num else "\n" if line_num else ""
+                for i in range(0, len(word) or 1, max_length):
+                    piece = word[i:i + max_length]
+                    if current and \
+                            len(current) + len(sep) + len(piece) > max_length:
+                        parts.append(current)
+                        current = piece
+                    else:
+                        current += sep + piece
+                    sep = ""
+
+        parts.append(current)
+        return parts
+
+    def _is_trigger(self, msg):
+        """ Check if a message starts with the bot key word.
+
+            Args:
+                msg: Zulip message listen by the bot.
+        """
+
+        # decode message if not unicode
+        if type(msg["content"]) is not unicode:
+            msg["content"] = msg["content"].decode("utf-8", "ignore")
+
+        words = msg['content'].split()
+        if not words:
+            return False
 
-            self.client.send_message(ping_msg)
+        first_word = words[0].lower().strip()
+        return self.key_word == first_word or self.short_key_word == first_word
 
     def get_last_participants(self, num_particip, stream, subject, issuer):
         """ Get last participants in a stream-subject.
@@ -135,46 +837,329 @@ class PingingBot():
         Args:
             num_particip: Number of participants to be pinged.
             stream: Zulip stream of the participants.
-            subject: Subject of the participants.
+            subject: Subject of the participants (None = every topic).
             issuer: Zulip participant that is pinging the others.
         """
 
-        anchor = 18446744073709551615
-        earliest = arrow.now()
-        max_past_time = self._get_shifted_time(3, "m")
+        # participants seen since the index is complete need no history
+        # retrieval (topics of a snapshot that was not caught up are not)
+        index = self.participant_index
+        if index and index.since is not None:
+            names = index.get_last(stream, subject, num_particip, issuer,
+                                   since=index.since)
+            if len(names) >= num_particip:
+                return self._format_participants(names)
 
-        participants = []
-        while earliest > max_past_time and len(participants) < num_particip:
-            msgs_chunk = self._get_msgs_chunk(self.CHUNK_SIZE, stream, anchor)
+        counters = self._fetch_counters()
 
-            timestamp = msgs_chunk[0]["timestamp"]
-            earliest = arrow.get(timestamp)
+        # no more history is retrieved once enough participants are found
+        msgs = self.iter_msgs(self._get_shifted_time(3, "m"), stream, subject,
+                              newest_first=True)
+        participants = self._get_last_participants(msgs, num_particip, issuer)
 
-            anchor = msgs_chunk[0]["id"]
+        self._record_fetch_stats(counters)
 
-            # reversed msgs_chunk start from earliest to latest
-            for msg in reversed(msgs_chunk):
-                pinged_particip = "".join([self.PING_INI,
-                                           msg["sender_full_name"],
-                                           self.PING_END])
+        return participants
 
-                already = pinged_particip in participants
-                is_bot = self._bot_msg(msg)
-                same_person = issuer == msg["sender_full_name"]
-                correct_subj = msg["subject"] == subject
+    def get_participants_from(self, sources, get, arg, issuer, limit=None):
+        """ Get participants of several topics or streams in parallel.
 
-                if (not already and not is_bot and not same_person and
-                        correct_subj):
-                    participants.append(pinged_particip)
+        Sources are collected by a pool of SOURCE_WORKERS threads shared by
+        every ping, and the ones that take more than SOURCE_TIMEOUT seconds
+        (counted from the start of the fan-out) are given up, so a slow
+        stream does not hold the others (it keeps one of the threads busy
+        until it finishes).
 
-                if len(participants) >= num_particip:
-                    break
+        Args:
+            sources: List of (stream, subject) (subject None = every topic of
+                the stream).
+            get: Method collecting a source, get_participants_since or
+                get_last_participants.
+            arg: Time or number of participants passed to get.
+            issuer: Participant that is pinging the other ones.
+            limit: Maximum number of participants merged (optional).
+
+        Returns:
+            Tuple (participants, sources that failed or timed out).
+            Participants of every source are merged taking one of each
+            source in turn, without repetitions.
+        """
+
+        sources = list(OrderedDict.fromkeys(sources))
+        pool = self._pool("source_pool", self.SOURCE_WORKERS)
+        results = [pool.apply_async(self._counted(get),
+                                    (arg, stream, subject, issuer))
+                   for stream, subject in sources]
+
+        deadline = time.time() + self.SOURCE_TIMEOUT
+        collected, failed = [], []
+        for source, result in zip(sources, results):
+            try:
+                collected.append(result.get(max(0, deadline - time.time())))
+            except TimeoutError:
+                logger.warning("participants of %s timed out", source)
+                failed.append(source)
+            except Exception:
+                logger.exception("participants of %s failed", source)
+                failed.append(source)
+
+        merged = OrderedDict()
+        for participants in izip_longest(*collected):
+            for participant in participants:
+                if participant is not None:
+                    merged[participant] = True
+
+        return merged.keys()[:limit], failed
+
+    def _pool(self, name, size):
+        """ Thread pool of the bot kept in an attribute (created the first
+        time it is used).
+        """
+
+        with self.pools_lock:
+            if getattr(self, name) is None:
+                setattr(self, name, ThreadPool(size))
+            return getattr(self, name)
+
+    @classmethod
+    def _format_source(cls, source):
+        """ Zulip link to a (stream, subject) source. """
+
+        stream, subject = source
+        return "#**%s**" % (stream if subject is None else
+                            "%s>%s" % (stream, subject))
+
+    @classmethod
+    def _get_last_participants(cls, msgs, num_particip, issuer):
+        """ Extract the first participants from messages (latest first).
+
+        Args:
+            msgs: Messages from the latest to the earliest (any iterable).
+            num_particip: Number of participants to be pinged.
+            issuer: Zulip participant that is pinging the others.
+        """
+
+        collector = ParticipantCollector(issuer, cls._bot_msg)
+        collector.add_all(msgs, num_particip)
+
+        return collector.format(cls.PING_INI, cls.PING_END)
+
+    def _refresh_history(self, stream, subject=None):
+        """ Retrieve messages of a stream newer than the latest cached one.
+
+        Only the gap between the newest cached message and now is asked to
+        Zulip. Messages older than the maximum time range are evicted.
+
+        Args:
+            stream: Zulip stream whose cached history will be updated.
+            subject: Subject to narrow the messages to (None = all).
+        """
+
+        self.history.evict(self._max_past_timestamp())
+        coverage = self.history.coverage(stream, subject or "")
+
+        newest_id = None
+        for msgs_chunk, complete in self._iter_pages(stream, subject):
+            self.history.add(stream, msgs_chunk)
+            newest_id = newest_id or msgs_chunk[-1]["id"]
+            earliest = msgs_chunk[0]
+
+            # the gap is closed when we reach the newest cached message
+            if coverage and earliest["id"] <= coverage[1]:
+                low_id, floor = coverage[0], coverage[2]
+            elif not coverage or complete:
+                low_id, floor = earliest["id"], earliest["timestamp"]
+            else:
+                continue
+
+            self.history.set_coverage(stream, low_id, newest_id,
+                                      0 if complete else floor, subject or "")
+            break
+
+    def _extend_history(self, stream, subject=None, since=None,
+                        chunk_size=None):
+        """ Retrieve one chunk of messages older than the earliest cached.
+
+        Args:
+            stream: Zulip stream whose cached history will be extended.
+            subject: Subject to narrow the messages to (None = all).
+            since: Epoch timestamp from when messages are needed, used to
+                size the chunk (optional).
+            chunk_size: Size of the chunk (None = sized by _chunk_size).
+
+        Returns:
+            True if there may be older messages still not cached.
+        """
+
+        low_id, high_id, floor = self.history.coverage(stream, subject or "")
+        if not floor:
+            return False
+
+        chunk_size = chunk_size or self._chunk_size(stream, subject, since,
+                                                    floor)
+        msgs_chunk, complete = next(
+            self._iter_pages(stream, subject, low_id, chunk_size=chunk_size),
+            (None, True))
+        if not msgs_chunk:
+            self.history.set_coverage(stream, low_id, high_id, 0,
+                                      subject or "")
+            return False
+
+        self.history.add(stream, msgs_chunk)
+        floor = 0 if complete else msgs_chunk[0]["timestamp"]
+        self.history.set_coverage(stream, msgs_chunk[0]["id"], high_id, floor,
+                                  subject or "")
+
+        return not complete
+
+    def _sync_history(self, stream, since, subject=None):
+        """ Make the history cache hold all messages of a stream since a time.
+
+        Args:
+            stream: Zulip stream whose cached history will be updated.
+            since: Epoch timestamp from when the messages are needed.
+            subject: Subject to narrow the messages to (None = all).
+        """
+
+        # messages older than the maximum time range are never cached
+        since = max(since, self._max_past_timestamp())
+
+        # a cache that does not reach the window is filled going forward
+        # from where the window starts, when the id index knows it
+        coverage = self.history.coverage(stream, subject or "")
+        start = self._window_start(stream, since)
+        if start and (not coverage or
+                      coverage[2] > since and start[0] < coverage[0]):
+            self._fill_history(stream, subject, start, coverage)
 
-            # stop asking for messages if less than chunk size were retrieved
-            if not msgs_chunk or len(msgs_chunk) < self.CHUNK_SIZE:
+        self._refresh_history(stream, subject)
+
+        while self.history.coverage(stream, subject or ""):
+            if self.history.coverage(stream, subject or "")[2] <= since:
+                break
+            if not self._extend_history(stream, subject, since):
                 break
 
-        return participants
+    def _fill_history(self, stream, subject, start, coverage=None):
+        """ Retrieve messages of a stream going forward from a point of the
+        id index, up to the earliest cached message (or the latest one).
+
+        Args:
+            stream: Zulip stream whose cached history will be filled.
+            subject: Subject to narrow the messages to (None = all).
+            start: Point (id, timestamp) of the id index to start from.
+            coverage: Coverage (low_id, high_id, floor) of the cache, if any.
+        """
+
+        end = (coverage[0], coverage[2]) if coverage else None
+        low_id, high_id = None, None
+        for msgs_chunk in self._iter_range_chunks(stream, subject, start, end):
+            self.history.add(stream, msgs_chunk)
+            low_id = low_id or msgs_chunk[0]["id"]
+            high_id = msgs_chunk[-1]["id"]
+
+        if coverage:
+            self.history.set_coverage(stream, low_id or coverage[0],
+                                      coverage[1], start[1], subject or "")
+        elif high_id:
+            self.history.set_coverage(stream, low_id, high_id, start[1],
+                                      subject or "")
+
+    def _narrow_subject(self, subject):
+        """ Subject to narrow retrieved messages to, if Zulip supports it. """
+
+        return subject if self.topic_narrow else None
+
+    def _fetch_counters(self):
+        """ Start counting the messages fetched and kept by a search.
+
+        Counters are kept per thread, so concurrent pings do not count the
+        messages of each other (see _counted for the pools of a search).
+        """
+
+        counters = {"fetched": 0, "bytes": 0, "kept": 0}
+        self._searches().append(counters)
+        return counters
+
+    def _record_fetch_stats(self, counters):
+        """ Keep messages fetched vs. kept since some _fetch_counters(). """
+
+        self._searches().remove(counters)
+        self.fetch_local.last = dict(counters)
+
+    @property
+    def last_fetch_stats(self):
+        """ Messages fetched vs. kept in the last search of this thread. """
+
+        return getattr(self.fetch_local, "last", None)
+
+    def _searches(self):
+        """ Counters of the searches in progress in this thread. """
+
+        if not hasattr(self.fetch_local, "searches"):
+            self.fetch_local.searches = []
+        return self.fetch_local.searches
+
+    def _add_fetched(self, fetched=0, fetched_bytes=0, kept=0):
+        with self.fetch_lock:
+            self.msgs_fetched += fetched
+            self.bytes_fetched += fetched_bytes
+            self.msgs_kept += kept
+
+        for counters in self._searches():
+            counters["fetched"] += fetched
+            counters["bytes"] += fetched_bytes
+            counters["kept"] += kept
+
+    def _counted(self, func):
+        """ Wrap a function run by a pool thread, so the messages it fetches
+        count for the searches in progress in the calling thread.
+        """
+
+        searches = list(self._searches())
+
+        def run(*args):
+            local = self._searches()
+            local.extend(searches)
+            try:
+                return func(*args)
+            finally:
+                del local[len(local) - len(searches):]
+
+        return run
+
+    @classmethod
+    def parse_sources(cls, msg_content):
+        """ Take out the topics or streams to ping from message content.
+
+        Sources are Zulip links following "in", right after the key word or
+        after the time string (e.g. "PingBot 2w in #**stream>topic**,
+        #**other stream** hi all"). A topic link pings that topic and a
+        stream link every topic of the stream.
+
+        Args:
+            msg_content: Content of a Zulip message to be parsed.
+
+        Returns:
+            Tuple (sources, content without them). sources is a list of
+            (stream, subject or None), or None if there are no sources.
+        """
+
+        words = msg_content.split(None, 2)
+        for start in (1, 2):
+            tail = " ".join(words[start:])
+            if not tail.startswith("in"):
+                continue
+
+            try:
+                sources, rest = cls.TIME_GRAMMAR(tail).sources_clause()
+            except Exception:
+                continue
+
+            content = " ".join(words[:start] + [rest.strip()])
+            return sources[:cls.MAX_SOURCES], content.strip()
+
+        return None, msg_content
 
     @classmethod
     def parse_time(cls, msg_content):
@@ -191,25 +1176,9 @@ class PingingBot():
             # taking out the bot key word
             time_str = " ".join(msg_split[1:]).strip()
 
-            grammar = parsley.makeGrammar("""
-                today = 'today' ws -> (0, "d")
-                this = 'this' ws <letter+>:freq -> (0, freq[0])
-
-                min = 'min' letter* ws <digit*>:num -> (int(num or 0), "min")
-                min2 = <digit*>:num ws 'min' letter* -> (int(num or 0), "min")
-
-                t1 = <letter+>:freq ws <digit*>:num -> (int(num or 0), freq[0])
-                t2 = <digit*>:num ws <letter+>:freq -> (int(num or 0), freq[0])
-
-                time_expr = today | this | min | min2 | t1 | t2
-                issuer_msg = ' ' ws <anything*>:msg -> msg
-
-                message = time_expr:time issuer_msg?:msg -> (time, msg)
-                """, {})
-
             # try to match for time first
             try:
-                time, msg = grammar(time_str).message()
+                time, msg = cls._parse_time_str(time_str)
                 num, freq = time
 
                 # convert more than 3 "m" in "min"
@@ -219,8 +1188,7 @@ class PingingBot():
 
                 shifted_time = cls._get_shifted_time(num, freq)
 
-            except Exception as inst:
-                print inst
+            except Exception:
                 shifted_time = None
                 msg = None
 
@@ -230,6 +1198,38 @@ class PingingBot():
 
         return shifted_time, msg
 
+    @classmethod
+    def _parse_time_str(cls, time_str):
+        """ Parse a time string into ((num, freq), issuer_msg).
+
+        Common time strings are matched with precompiled regular expressions
+        that give the same result than the grammar, anything else is parsed
+        with the TIME_GRAMMAR.
+
+        Args:
+            time_str: Lowercase message content without the bot key word.
+        """
+
+        if time_str == "today":
+            return (0, "d"), None
+
+        if cls.NUM_RE.match(time_str):
+            raise ValueError("a number of participants is not a time string")
+
+        match = cls.THIS_RE.match(time_str)
+        if match:
+            freq, msg = match.groups()
+            return (0, freq[0]), msg
+
+        match = cls.NUM_FREQ_RE.match(time_str) or \
+            cls.FREQ_NUM_RE.match(time_str)
+        if match and not time_str.startswith(("today", "this")):
+            num, freq, msg = match.group("num", "freq", "msg")
+            freq = "min" if freq.startswith("min") else freq[0]
+            return (int(num or 0), freq), msg
+
+        return cls.TIME_GRAMMAR(time_str).message()
+
     @classmethod
     def parse_num_participants(cls, msg_content):
         """ Try to parse a number of participants to ping from message.
@@ -247,7 +1247,7 @@ class PingingBot():
             try:
                 num_participants = int(msg_content_elems[1].lower().strip())
             except Exception as inst:
-                print inst
+                logger.debug("no number of participants: %s", inst)
 
         else:
             num_participants = 0
@@ -288,105 +1288,519 @@ class PingingBot():
 
         return shifted_time
 
+    @classmethod
+    def _max_past_timestamp(cls):
+        """ Epoch timestamp of the maximum time range (3 months ago). """
+
+        return cls._get_shifted_time(3, "m").timestamp
+
     def get_msgs(self, time, stream, subject):
         """ Get all messages from a stream-subject after a certain "time".
 
         Args:
             time: Time from when collected messages will start.
             stream: Name of the zulip stream where to collect messages.
-            subject: Name of the subject where to collect messages.
+            subject: Name of the subject where to collect messages
+                (None = every topic).
+        """
+
+        counters = self._fetch_counters()
+        messages = list(self.iter_msgs(time, stream, subject))
+        self._record_fetch_stats(counters)
+
+        return messages
+
+    def iter_msgs(self, time, stream, subject, newest_first=False):
+        """ Iterate lazily over messages from a stream-subject after "time".
+
+        History is retrieved (or read from the cache) one chunk at a time,
+        as the messages are consumed, and no more is retrieved once the
+        caller stops iterating.
+
+        Args:
+            time: Time from when collected messages will start.
+            stream: Name of the zulip stream where to collect messages.
+            subject: Name of the subject where to collect messages
+                (None = every topic).
+            newest_first: Iterate from the latest to the earliest message.
         """
 
-        anchor = 18446744073709551615
-        earliest = arrow.now()
-        # print time
+        if self.history:
+            msgs = self._iter_cached_msgs(time.timestamp, stream, subject,
+                                          newest_first)
+        else:
+            msgs = self._iter_fetched_msgs(time.timestamp, stream, subject,
+                                           newest_first)
+
+        for msg in msgs:
+            self._add_fetched(kept=1)
+            yield msg
 
-        messages = []
-        while earliest > time:
-            msgs_chunk = self._get_msgs_chunk(self.CHUNK_SIZE, stream, anchor)
+    def _iter_fetched_msgs(self, since, stream, subject, newest_first=False):
+        """ Iterate over messages of a stream-subject asking Zulip for them.
 
-            timestamp = msgs_chunk[0]["timestamp"]
-            earliest = arrow.get(timestamp)
+        When the id index knows where the window starts, messages are
+        retrieved going forward from there (see _iter_indexed_msgs).
+
+        Args:
+            since: Epoch timestamp, only later messages are iterated.
+            stream: Name of the zulip stream where to collect messages.
+            subject: Name of the subject where to collect messages
+                (None = every topic).
+            newest_first: Iterate from the latest to the earliest message
+                (otherwise, chunks go to the past but each one is iterated
+                from its earliest to its latest message).
+        """
+
+        start = None if newest_first else self._window_start(stream, since)
+        if start:
+            for msg in self._iter_indexed_msgs(since, stream, subject, start):
+                yield msg
+            return
+
+        # chunks are sized to reach since, unless the caller may stop early
+        pages = self._iter_pages(stream, self._narrow_subject(subject),
+                                 since=None if newest_first else since)
+        for msgs_chunk, _ in pages:
+
+            # only the chunk reaching "since" needs to be cut, once
+            last_chunk = msgs_chunk[0]["timestamp"] <= since
+            if last_chunk:
+                msgs_chunk = msgs_chunk[self._cutoff_index(msgs_chunk, since):]
+
+            if newest_first:
+                msgs_chunk = reversed(msgs_chunk)
 
-            anchor = msgs_chunk[0]["id"]
-            msgs = []
             for msg in msgs_chunk:
-                msg_time = arrow.get(msg["timestamp"])
+                if subject is None or msg["subject"] == subject:
+                    yield msg
 
-                if msg["subject"] == subject and msg_time > time:
-                    msgs.append(msg)
+            if last_chunk:
+                return
 
-            messages.extend(msgs)
+    def _window_start(self, stream, since):
+        """ Point of the id index where a time window can start.
 
-            # stop asking for messages if less than chunk size were retrieved
-            if not msgs_chunk or len(msgs_chunk) < self.CHUNK_SIZE:
-                break
+        The point is only used if retrieving from it costs no more than
+        CHUNK_MARGIN over the window (or resolution seconds more).
 
-        return messages
+        Returns:
+            Tuple (id, timestamp), or None to page back from the latest.
+        """
+
+        start = self.id_index.floor(stream, since) if self.id_index else None
+        if start is None:
+            return None
+
+        window = max(0, arrow.now().timestamp - since)
+        max_gap = max(self.id_index.resolution,
+                      window * (self.CHUNK_MARGIN - 1))
+
+        return start if since - start[1] <= max_gap else None
+
+    def _iter_indexed_msgs(self, since, stream, subject, start):
+        """ Iterate over messages of a stream-subject from an indexed id.
+
+        The window is retrieved going forward, in parallel ranges (see
+        _iter_range_chunks).
+
+        Args:
+            since: Epoch timestamp, only later messages are iterated.
+            stream: Name of the zulip stream where to collect messages.
+            subject: Name of the subject where to collect messages
+                (None = every topic).
+            start: Point (id, timestamp) of the index not later than since.
+
+        Yields:
+            Messages from the earliest to the latest.
+        """
+
+        chunks = self._iter_range_chunks(
+            stream, self._narrow_subject(subject), start)
+        for msgs_chunk in chunks:
+            for msg in msgs_chunk:
+                if msg["timestamp"] > since and \
+                        (subject is None or msg["subject"] == subject):
+                    yield msg
+
+    def _iter_range_chunks(self, stream, subject, start, end=None):
+        """ Iterate over chunks of messages of a stream going forward from
+        a point of the id index.
+
+        The messages are split in ranges at the points of the id index, which
+        are retrieved by a pool of RANGE_WORKERS threads shared by every ping.
+        Each range is iterated as soon as it and the ones before it were
+        retrieved. A single range is retrieved lazily, as chunks are consumed.
+
+        Args:
+            stream: Zulip stream where messages will be retrieved.
+            subject: Subject to narrow the messages to (None = all).
+            start: Point (id, timestamp) of the id index to start from.
+            end: Point (id, timestamp) where the messages end, not included
+                (None = up to the latest message).
+
+        Yields:
+            Non empty chunks of messages, from the earliest to the latest.
+        """
+
+        starts = self.id_index.split(stream, start, self.RANGE_WORKERS)
+        if end:
+            starts = [point for point in starts
+                      if point == start or point[0] < end[0]]
+        ranges = zip(starts, starts[1:] + [end])
+
+        if len(ranges) == 1:
+            chunks = [self._iter_range(stream, subject, start, end)]
+        else:
+            pool = self._pool("range_pool", self.RANGE_WORKERS)
+            chunks = pool.imap(self._counted(
+                lambda bounds: list(self._iter_range(
+                    stream, subject, *bounds))), ranges)
+
+        for range_chunks in chunks:
+            for msgs_chunk in range_chunks:
+                yield msgs_chunk
+
+    def _iter_range(self, stream, subject, first, end=None):
+        """ Iterate over chunks of messages of a stream going forward.
+
+        Args:
+            stream: Zulip stream where messages will be retrieved.
+            subject: Subject to narrow the messages to (None = all).
+            first: Point (id, timestamp) where the range starts.
+            end: Point (id, timestamp) where the range ends, not included
+                (None = up to the latest message).
+
+        Yields:
+            Non empty chunks of messages, from the earliest to the latest.
+        """
+
+        anchor, since = first
+        chunk_size = self._chunk_size(stream, subject, since,
+                                      end[1] if end else None)
+        while True:
+            msgs_chunk = self._get_msgs_chunk(chunk_size, stream, anchor,
+                                              subject, forward=True)
+            if not msgs_chunk:
+                return
+
+            # the anchor is only part of the range in the first chunk
+            newer = [msg for msg in msgs_chunk if msg["id"] > anchor]
+            complete = len(newer) < chunk_size
+            if anchor != first[0]:
+                msgs_chunk = newer
+            if end and msgs_chunk and msgs_chunk[-1]["id"] >= end[0]:
+                msgs_chunk = [msg for msg in msgs_chunk if msg["id"] < end[0]]
+                complete = True
+
+            self._observe_rate(stream, subject, newer)
+            if msgs_chunk:
+                yield msgs_chunk
+            if complete or not newer:
+                return
+
+            # the next chunk is sized to reach the end of the range
+            anchor = newer[-1]["id"]
+            chunk_size = self._chunk_size(
+                stream, subject, newer[-1]["timestamp"],
+                end[1] if end else None, chunk_size)
+
+    @classmethod
+    def _cutoff_index(cls, msgs, since):
+        """ Index of the first message later than a timestamp.
+
+        Messages are ordered by id, so timestamps are ordered too and the
+        index is found with a binary search, reading O(log n) timestamps.
+
+        Args:
+            msgs: Messages from the earliest to the latest.
+            since: Epoch timestamp.
+        """
+
+        return bisect.bisect_right(_Timestamps(msgs), since)
+
+    def _iter_cached_msgs(self, since, stream, subject, newest_first=False):
+        """ Iterate over messages of a stream-subject using the history cache.
+
+        Args:
+            since: Epoch timestamp, only later messages are iterated.
+            stream: Name of the zulip stream where to collect messages.
+            subject: Name of the subject where to collect messages
+                (None = every topic).
+            newest_first: Iterate from the latest to the earliest message,
+                extending the cache to the past only when the cached messages
+                were not enough.
+        """
+
+        narrow_subject = self._narrow_subject(subject)
 
-    def _get_msgs_chunk(self, chunk_size, stream, anchor=18446744073709551615):
+        # messages older than the maximum time range are never cached
+        since = max(since, self._max_past_timestamp())
+
+        if not newest_first:
+            self._sync_history(stream, since, narrow_subject)
+            for msg in self.history.iter_msgs(stream, subject, since):
+                yield msg
+            return
+
+        self._refresh_history(stream, narrow_subject)
+
+        before_id, chunk_size = None, None
+        while self.history.coverage(stream, narrow_subject or ""):
+            low_id, high_id, floor = self.history.coverage(
+                stream, narrow_subject or "")
+
+            # iterate the cached part not iterated yet
+            for msg in self.history.iter_msgs(stream, subject, since, low_id,
+                                              before_id, newest_first=True):
+                yield msg
+
+            # the caller may stop early: chunks start small and double
+            before_id = low_id
+            chunk_size = self._chunk_size(stream, narrow_subject,
+                                          previous=chunk_size)
+            if floor <= since or not self._extend_history(
+                    stream, narrow_subject, chunk_size=chunk_size):
+                return
+
+    def _iter_pages(self, stream, subject=None, anchor=LAST_MSG_ANCHOR,
+                    since=None, chunk_size=None):
+        """ Iterate over chunks of messages of a stream going to the past.
+
+        This is the pagination engine used by every history retrieval: a
+        chunk is only asked to Zulip when the previous one was consumed, and
+        each chunk is sized by _chunk_size with the message rate observed.
+
+        Args:
+            stream: Zulip stream where messages will be retrieved.
+            subject: Subject to narrow the messages to (None = all).
+            anchor: Messages older than the anchor (message id) are iterated.
+                Default is the maximum 64-bit integer meaning "last message".
+            since: Epoch timestamp the messages are needed from (None = the
+                caller may stop at any chunk).
+            chunk_size: Size of the first chunk (None = sized by _chunk_size).
+
+        Yields:
+            Tuples (chunk, complete) with non empty chunks of messages (from
+            earliest to latest), each one older than the previous one.
+            complete is True if there are no older messages.
+        """
+
+        chunk_size = chunk_size or self._chunk_size(stream, subject, since)
+        while True:
+            msgs_chunk = self._get_msgs_chunk(chunk_size, stream, anchor,
+                                              subject)
+            if not msgs_chunk:
+                return
+
+            # less than chunk size means there are no older messages
+            complete = len(msgs_chunk) < chunk_size
+            earliest_id = msgs_chunk[0]["id"]
+            self._observe_rate(stream, subject, msgs_chunk)
+
+            # the anchor message was already iterated (or is not wanted)
+            if msgs_chunk[-1]["id"] == anchor:
+                msgs_chunk = msgs_chunk[:-1]
+
+            if msgs_chunk:
+                yield msgs_chunk, complete
+
+            if complete or earliest_id >= anchor:
+                return
+            anchor = earliest_id
+            chunk_size = self._chunk_size(stream, subject, since,
+                                          msgs_chunk[0]["timestamp"]
+                                          if msgs_chunk else None, chunk_size)
+
+    def _chunk_size(self, stream, subject=None, since=None, before=None,
+                    previous=None):
+        """ Number of messages to ask in the next chunk of a stream-subject.
+
+        With a time window and a known message rate, the chunk is sized to
+        reach since (plus CHUNK_MARGIN). Otherwise, the first chunk has
+        MIN_CHUNK_SIZE messages and each following one doubles. Chunks are
+        never bigger than CHUNK_SIZE.
+
+        Args:
+            stream: Zulip stream where messages will be retrieved.
+            subject: Subject the messages are narrowed to (None = all).
+            since: Epoch timestamp the messages are needed from (optional).
+            before: Epoch timestamp of the earliest message already
+                retrieved (None = now).
+            previous: Size of the previous chunk (optional).
+        """
+
+        min_size = min(self.MIN_CHUNK_SIZE, self.CHUNK_SIZE)
+        with self.rates_lock:
+            rate = (self.msg_rates or {}).get((stream, subject))
+
+        if since is not None and rate:
+            before = before or arrow.now().timestamp
+            size = int(rate * max(0, before - since) * self.CHUNK_MARGIN) + 1
+        elif previous:
+            size = previous * 2
+        else:
+            size = min_size
+
+        return max(min_size, min(self.CHUNK_SIZE, size))
+
+    def _observe_rate(self, stream, subject, msgs_chunk):
+        """ Update the message rate of a stream-subject with a chunk. """
+
+        if len(msgs_chunk) < 2:
+            return
+
+        seconds = max(1, msgs_chunk[-1]["timestamp"] -
+                      msgs_chunk[0]["timestamp"])
+        rate = (len(msgs_chunk) - 1) / float(seconds)
+
+        with self.rates_lock:
+            if self.msg_rates is None:
+                self.msg_rates = OrderedDict()
+
+            # the least recently observed stream-subject is forgotten
+            previous = self.msg_rates.pop((stream, subject), rate)
+            self.msg_rates[(stream, subject)] = (previous + rate) / 2
+            if len(self.msg_rates) > self.MAX_RATES:
+                self.msg_rates.popitem(last=False)
+
+    def _get_msgs_chunk(self, chunk_size, stream, anchor=LAST_MSG_ANCHOR,
+                        subject=None, forward=False):
         """ Retrieve a chunk of messages from a Zulip stream.
 
+        Messages are decoded into CompactMsg records (see decode_msg), only
+        the fields used to collect participants are kept.
+
         Args:
             chunk_size: Maximum number of messages to retrieve.
             stream: Zulip stream where messages will be retrieved.
             anchor: Time anchor from where to retrieve messages going to the
                 past. Default is a maximum 64-bit integer number meaning
                 "last message".
+            subject: Subject to narrow the messages to (None = all). If the
+                server does not know the topic narrow (old servers), the
+                whole stream is retrieved and subject narrowing is not tried
+                anymore.
+            forward: Retrieve messages newer than the anchor instead.
         """
 
-        print "chunk", chunk_size, "stream", stream, "anchor", anchor
+        logger.debug("chunk %d stream %s anchor %s subject %s", chunk_size,
+                     stream, anchor, subject)
+
+        narrow = [{"operator": "stream", "operand": stream}]
+        if subject is not None:
+            narrow.append({"operator": "topic", "operand": subject})
 
         payload = {"anchor": anchor,
-                   "narrow": "".join(['[{"operator":"stream","operand":"',
-                                      unicode(stream), '"}]']),
-                   "num_before": chunk_size,
-                   "num_after": 0,
+                   "narrow": json.dumps(narrow),
+                   "num_before": 0 if forward else chunk_size,
+                   "num_after": chunk_size if forward else 0,
                    "apply_markdown": "false"}
 
-        response = requests.get('https://api.zulip.com/v1/messages',
-                                params=payload,
-                                auth=(self.username, self.api_key))
+        with self._span("fetch_page"):
+            response = self.transport.get("messages", params=payload)
 
         if response.status_code == 200:
-            json_res = response.json()
+            json_res = response.json(object_hook=self.decode_msg)
             messages = json_res["messages"]
+            self._add_fetched(len(messages), len(response.content))
+            self._count("pingbot_pages_total")
+            self._count("pingbot_page_msgs_total", len(messages))
+            self._count("pingbot_page_bytes_total", len(response.content))
+
+        elif response.status_code == 400 and subject is not None and \
+                self._narrow_rejected(response):
+            logger.warning("topic narrow rejected, retrieving the stream: %s",
+                           response.content)
+            self.topic_narrow = False
+            return self._get_msgs_chunk(chunk_size, stream, anchor,
+                                        forward=forward)
 
         else:
-            print response.json()
+            logger.error("messages could not be retrieved: %s",
+                         response.content)
             messages = None
 
         if messages:
-            print "num messages retrieved", len(messages)
+            logger.debug("num messages retrieved %d", len(messages))
+            if self.id_index:
+                self.id_index.add_msgs(stream, messages)
 
         return messages
 
     @classmethod
-    def get_participants(cls, msgs, issuer):
-        """ Extract a list of participants from a bunch of messages.
+    def _narrow_rejected(cls, response):
+        """ Check if an error of Zulip is about the narrow operators (and
+        not, e.g., about the stream or the anchor).
+        """
+
+        try:
+            error = response.json().get("msg", "")
+        except ValueError:
+            return False
+
+        return "operator" in error.lower()
+
+    def get_participants_since(self, time, stream, subject, issuer):
+        """ Get participants of a stream-subject after a certain "time".
+
+        Participants seen since the bot started listening are answered by the
+        participant index, older history is retrieved with get_msgs.
 
         Args:
-            msgs: Messages from where to extract participant names.
+            time: Time from when participants will be collected.
+            stream: Zulip stream of the participants.
+            subject: Subject of the participants (None = every topic).
             issuer: Participant that is pinging the other ones.
         """
 
-        json.dump({"messages": msgs}, open("msg.json", "wb"))
-
-        participants = []
-        for msg in msgs:
-            pinged_particip = "".join([cls.PING_INI,
-                                       msg["sender_full_name"],
-                                       cls.PING_END])
+        # only the streams of this shard are indexed (see on_message)
+        if self.participant_index and self.owns(stream) and \
+                self.participant_index.covers(time.timestamp, stream):
+            names = self.participant_index.get_since(stream, subject,
+                                                     time.timestamp, issuer)
+            return self._format_participants(names)
+
+        counters = self._fetch_counters()
+
+        # pings of a stream-subject (from any stream) share history scans,
+        # which keep the latest message of each sender
+        if self.scan_cache:
+            msgs = self.scan_cache.get(
+                stream, subject, time.timestamp,
+                lambda: self.iter_msgs(time, stream, subject))
+        else:
+            msgs = self.iter_msgs(time, stream, subject)
 
-            bot_msg = cls._bot_msg(msg)
-            autoping = issuer == unicode(msg["sender_full_name"])
-            already_catched = pinged_particip not in participants
+        if self.recorder and self.recorder.sampled():
+            msgs = list(msgs)
+            self.recorder.record(msgs, issuer)
 
-            if not bot_msg and not autoping and already_catched:
-                participants.append(pinged_particip)
+        participants = self.get_participants(msgs, issuer)
+        self._record_fetch_stats(counters)
 
         return participants
 
+    @classmethod
+    def _format_participants(cls, names):
+        """ Create the strings used to ping a list of participant names. """
+
+        return ["".join([cls.PING_INI, name, cls.PING_END]) for name in names]
+
+    @classmethod
+    def get_participants(cls, msgs, issuer):
+        """ Extract a list of participants from a bunch of messages.
+
+        Args:
+            msgs: Messages from where to extract participant names.
+            issuer: Participant that is pinging the other ones.
+        """
+
+        collector = ParticipantCollector(issuer, cls._bot_msg)
+        collector.add_all(msgs)
+
+        return collector.format(cls.PING_INI, cls.PING_END)
+
     @classmethod
     def _bot_msg(cls, msg):
         return "-bot@students.hackerschool.com" in msg["sender_email"]
@@ -442,22 +1856,429 @@ class PingingBot():
 
         return msg
 
+    def on_message(self, msg):
+        """ Index the participant of a message received and respond to it.
+
+            Trigger messages are queued to be answered by the dispatcher
+            workers, so the event thread never waits for Zulip.
+
+            Args:
+                msg: Zulip message listen by the bot.
+        """
+
+        # pings of the same stream are answered one after the other
+        if msg.get("type") == "stream":
+            key = msg["display_recipient"]
+        else:
+            key = self._preview_token(msg) or msg["sender_email"]
+
+        # every shard receives every message, but only handles its own
+        if not self.owns(key):
+            return
+        self._count("pingbot_msgs_total")
+
+        if not self._bot_msg(msg):
+            self.participant_index.add(msg)
+        if self.id_index and msg.get("type") == "stream":
+            self.id_index.add(msg["display_recipient"], msg["id"],
+                              msg["timestamp"])
+
+        if not self._is_trigger(msg):
+            return
+
+        if not self.dispatcher:
+            self.respond(msg)
+            return
+
+        if not self.dispatcher.submit(key, msg):
+            logger.warning("too many pings waiting, dropped %s", msg["id"])
+            self._count("pingbot_dropped_pings_total")
+
+    def _is_public(self, stream):
+        """ Check if a stream is known to be public.
+
+        The list of streams (which tells the private ones) is retrieved if
+        it was not yet (e.g. while the subscriptions are deferred). Streams
+        that are not listed, or a list that cannot be retrieved, count as
+        private.
+        """
+
+        if self.stream_cache:
+            try:
+                if stream not in self.stream_cache.get():
+                    return False
+            except (IOError, RuntimeError):
+                logger.exception("streams could not be listed")
+                return False
+
+        return stream not in self.private_streams
+
+    def _preview_command(self, msg):
+        """ Command of the private preview of a ping in a trigger message.
+
+        A command other than "preview" must be followed by a token, so that
+        e.g. "PingBot confirm attendance please" is a normal ping.
+
+        Returns:
+            (command, args) tuple, None if the message is not a command.
+        """
+
+        words = msg["content"].split(None, 2)
+        if not self.preview_cache or len(words) < 2:
+            return None
+
+        command = words[1].lower()
+        args = words[2] if len(words) > 2 else ""
+        if command == "preview" or command in self.PREVIEW_COMMANDS and \
+                self.PREVIEW_TOKEN_RE.match(args.partition(" ")[0]):
+            return command, args
+        return None
+
+    def _preview_token(self, msg):
+        """ Token of a private preview command (None for other messages).
+
+        Commands of a preview are handled by the shard that created it (see
+        PreviewCache.add), so they are keyed by the token.
+        """
+
+        preview_command = self._preview_command(msg)
+        if preview_command and preview_command[0] != "preview":
+            return preview_command[1].partition(" ")[0]
+        return None
+
+    def on_event(self, event):
+        """ Route an event received from Zulip to its handler.
+
+            Args:
+                event: Zulip event of type "message" or "stream".
+        """
+
+        if event["type"] == "message":
+            self.on_message(event["message"])
+
+        elif event["type"] == "stream":
+            self.on_stream_event(event)
+
+    def save_snapshot(self):
+        """ Save the participant index (and the event queue) to a snapshot.
+
+        Senders older than the maximum time range are forgotten first.
+        Nothing is saved until the index is complete (e.g. while a snapshot
+        is caught up), the previous snapshot is still good to start from.
+        """
+
+        if self.participant_index.since is None:
+            return
+
+        self.participant_index.prune(self._max_past_timestamp())
+        header = {"since": self.participant_index.since,
+                  "saved_at": arrow.now().timestamp,
+                  "high_ids": self.participant_index.high_ids,
+                  "stream_since": self.participant_index.stream_since,
+                  "shards": self.ring.shards if self.ring else 1}
+        if self.event_queue:
+            header["queue_id"] = self.event_queue.queue_id
+            header["last_event_id"] = self.event_queue.last_event_id
+        if self.id_index:
+            header["id_index"] = self.id_index.dump()
+
+        self.snapshot.write(header, self.participant_index.dump())
+
+    def warm_start(self):
+        """ Load the snapshot and catch up the messages sent since then.
+
+        main() does the same, catching up in the background (see
+        _load_snapshot and _catch_up).
+
+        Returns:
+            Epoch timestamp from when the participant index is complete,
+            or None if there was no snapshot or it could not be caught up.
+        """
+
+        header = self._load_snapshot()
+        self._register_events()
+
+        return self._catch_up(header) if header else None
+
+    def _load_snapshot(self):
+        """ Load the participant index (and id index) of the snapshot.
+
+        With the pooled client, the event queue of the snapshot is resumed
+        (Zulip keeps it for a while), otherwise a queue has to be registered
+        before catching up, so the messages sent meanwhile are received as
+        events.
+
+        Returns:
+            Header of the snapshot, or None if there was no snapshot.
+        """
+
+        header, topics = self.snapshot.read()
+        if header is None:
+            return None
+
+        self.participant_index.load(topics, header["high_ids"],
+                                    header.get("stream_since"))
+        self.participant_index.prune(self._max_past_timestamp())
+        if self.id_index:
+            self.id_index.load(header.get("id_index", {}))
+        if self.event_queue and header.get("queue_id"):
+            self.event_queue.queue_id = header["queue_id"]
+            self.event_queue.last_event_id = header["last_event_id"]
+
+        return header
+
+    def _catch_up(self, header):
+        """ Index the messages sent since a snapshot was saved.
+
+        Every stream is caught up in parallel (backfill_workers at a time)
+        from its latest message in the snapshot. Streams that moved to this
+        shard since the snapshot (the number of shards changed) are caught
+        up from when it was saved, and are only complete from then.
+
+        Args:
+            header: Header of the snapshot loaded (see _load_snapshot).
+
+        Returns:
+            Epoch timestamp from when the participant index is complete,
+            or None if the snapshot could not be caught up.
+        """
+
+        names = [stream['name'] for stream in self.streams]
+        if not names:
+            return header["since"]
+
+        # streams indexed by another shard when the snapshot was saved
+        shards = header.get("shards", 1)
+        ring = HashRing(shards) if shards > 1 else None
+        moved = set(name for name in names
+                    if (ring.shard_of(name) if ring else 0) != self.shard)
+        for name in moved:
+            self.participant_index.start_stream(name, header["saved_at"])
+
+        start = time.time()
+        pool = ThreadPool(min(self.backfill_workers, len(names)))
+        try:
+            caught_up = pool.map(
+                lambda name: self._backfill(
+                    name, None if name in moved else
+                    header["high_ids"].get(name), header["saved_at"]), names)
+        finally:
+            pool.close()
+
+        logger.info("caught up %d of %d streams in %.2f seconds",
+                    sum(caught_up), len(names), time.time() - start)
+
+        return header["since"] if all(caught_up) else None
+
+    def _backfill(self, stream, high_id, saved_at):
+        """ Index the messages of a stream sent after a snapshot.
+
+        Args:
+            stream: Zulip stream to catch up.
+            high_id: Latest message of the stream in the snapshot (None = no
+                message of the stream was indexed).
+            saved_at: Epoch timestamp when the snapshot was saved, used when
+                the stream had no message indexed.
+
+        Returns:
+            True if every message since the snapshot was indexed (False if
+            more than MAX_BACKFILL were sent).
+        """
+
+        new_msgs = []
+        for msgs_chunk, complete in self._iter_pages(stream):
+            for msg in reversed(msgs_chunk):
+                if high_id:
+                    indexed = msg["id"] <= high_id
+                else:
+                    indexed = msg["timestamp"] < saved_at
+                if indexed:
+                    complete = True
+                    break
+                new_msgs.append(msg)
+
+            if complete:
+                break
+            if len(new_msgs) >= self.MAX_BACKFILL:
+                return False
+
+        for msg in reversed(new_msgs):
+            if not self._bot_msg(msg):
+                self.participant_index.add(
+                    dict(msg, type="stream", display_recipient=stream))
+
+        return True
+
+    def _register_events(self):
+        """ Register the event queue, if it is not registered yet.
+
+        Messages are received from the moment the queue is registered, even
+        if they are consumed later (e.g. after catching up a snapshot).
+        """
+
+        if self.event_queue:
+            if self.event_queue.queue_id is None:
+                self.event_queue.register()
+
+        elif self.client and self.client_queue is None:
+            result = self.client.register(event_types=self.EVENT_TYPES)
+            if result.get("result") != "success":
+                raise RuntimeError("could not register an event queue (%s)" %
+                                   result)
+            self.client_queue = {"queue_id": result["queue_id"],
+                                 "last_event_id": result["last_event_id"]}
+
+    def _run_client_events(self, callback):
+        """ Call a function with each event of the zulip.Client queue.
+
+        Like zulip.Client.call_on_each_event, but starting from the queue
+        registered by _register_events.
+        """
+
+        while True:
+            try:
+                self._register_events()
+            except RuntimeError as error:
+                logger.warning("event queue: %s", error)
+                time.sleep(1)
+                continue
+
+            result = self.client.get_events(**self.client_queue)
+            if result.get("result") != "success":
+                logger.warning("could not get events: %s", result)
+                if result.get("code") == "BAD_EVENT_QUEUE_ID":
+                    self.client_queue = None  # events meanwhile are lost
+                else:
+                    time.sleep(1)
+                continue
+
+            for event in result["events"]:
+                self.client_queue["last_event_id"] = max(
+                    self.client_queue["last_event_id"], int(event["id"]))
+                if event["type"] != "heartbeat":
+                    callback(event)
+
+    def _save_periodically(self):
+        def save():
+            while True:
+                time.sleep(self.SNAPSHOT_INTERVAL)
+                try:
+                    self.save_snapshot()
+                except (IOError, OSError):
+                    logger.exception("snapshot could not be saved")
+
+        thread = threading.Thread(target=save, name="snapshot")
+        thread.daemon = True
+        thread.start()
+
+    def _subscribe_in_background(self, streams=None, done=None):
+        """ Subscribe to streams from a thread, without delaying the events
+        (messages of the streams are received once subscribed).
+
+        Args:
+            streams: Streams in the form [{'name': stream}] (None = discover
+                all the streams of the bot).
+            done: Event set once the subscriptions are done (optional).
+        """
+
+        def subscribe():
+            try:
+                self.failed_subscriptions.extend(
+                    self.subscribe_to_streams(streams))
+            except (IOError, RuntimeError):
+                logger.exception("streams could not be subscribed")
+            finally:
+                if done:
+                    done.set()
+
+        thread = threading.Thread(target=subscribe, name="subscriptions")
+        thread.daemon = True
+        thread.start()
+
+    def _start_index_in_background(self, header=None):
+        """ Catch up the snapshot and start the participant index from a
+        thread, without delaying the events.
+
+        The index is complete once the messages sent since the snapshot are
+        indexed and the streams are subscribed (messages of other streams
+        are not received before). Pings are answered from history meanwhile.
+
+        Args:
+            header: Header of the snapshot loaded (None = no snapshot, the
+                index is complete from when the streams are subscribed). A
+                snapshot caught up is complete from its start, the bot was
+                subscribed to its streams already.
+        """
+
+        def start():
+            since = None
+            if header:
+                try:
+                    since = self._catch_up(header)
+                except (IOError, RuntimeError):
+                    logger.exception("the snapshot could not be caught up")
+
+            self.subscribed.wait()
+            self.participant_index.start(since or arrow.now().timestamp)
+
+        thread = threading.Thread(target=start, name="index start")
+        thread.daemon = True
+        thread.start()
+
     def main(self):
         """ Blocking call that runs forever.
-            Calls self.respond() on every message received."""
-
-        self.client.call_on_each_message(lambda msg: self.respond(msg))
+            Calls self.on_message() on every message received and keeps the
+            streams up to date with the streams created. With a snapshot,
+            starts warm and saves the snapshot periodically and on exit.
+            The snapshot is caught up and deferred subscriptions are done
+            while listening (the event queue is registered first), and the
+            participant index is complete only once they are done."""
+
+        header = None
+        if self.snapshot:
+            header = self._load_snapshot()
+            self._save_periodically()
+            signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        self._register_events()
+
+        self.dispatcher.start()
+        if self.defer_subscriptions:
+            self._subscribe_in_background(done=self.subscribed)
+        self._start_index_in_background(header)
+        try:
+            if self.event_queue:
+                self.event_queue.run(self.on_event)
+            else:
+                self._run_client_events(self.on_event)
+        finally:
+            if self.snapshot:
+                self.save_snapshot()
 
 
-def get_bot():
+def get_bot(shard=None):
     """Create a Zulip pinging bot.
 
+    Args:
+        shard: Tuple (shard, number of shards) of a sharded bot (None = the
+            bot handles every stream). Each shard has its own history,
+            snapshot and metrics port (PINGBOT_METRICS_PORT + shard).
+
     Attributes:
         zulip_username: Username of the bot in Zulip (email).
         zulip_api_key: API key of the bot in Zulip.
         key_word: Word that triggers the bot's action.
         short_key_word: Alternative short key word.
         subscribed_streams: Streams to suscribe ([] = all streams)
+        history_path: Path of the local messages history cache.
+        recorder: Optional capture of the messages pinged participants were
+            extracted from (see MessageRecorder).
+        site: Url of the Zulip server (optional, e.g. a local fake_zulip).
+        pooled_client: Use the pooled transport instead of zulip.Client.
+        profiler: Optional profiling of a sample of the pings.
+        snapshot_path: Path of the snapshot used to start warm.
+
+    The bot starts listening before subscribing to the streams (see
+    defer_subscriptions), so it is up as soon as possible after a restart.
     """
 
     zulip_username = os.environ['ZULIP_USR']
@@ -466,11 +2287,69 @@ def get_bot():
     short_key_word = 'PingBot'
 
     subscribed_streams = []
+    history_path = os.environ.get('PINGBOT_HISTORY', 'history.db')
+    site = os.environ.get('ZULIP_SITE')
+    pooled_client = bool(os.environ.get('PINGBOT_POOLED_CLIENT'))
+
+    profiler = None
+    if os.environ.get('PINGBOT_PROFILE_RATE'):
+        profiler = SlowPingProfiler(
+            float(os.environ['PINGBOT_PROFILE_RATE']),
+            directory=os.environ.get('PINGBOT_PROFILE_DIR'))
+
+    recorder = None
+    if os.environ.get('PINGBOT_RECORD'):
+        recorder = MessageRecorder(
+            os.environ['PINGBOT_RECORD'],
+            float(os.environ.get('PINGBOT_RECORD_RATE', 0.1)),
+            int(os.environ.get('PINGBOT_RECORD_MAX_BYTES', 50 * 1024 * 1024)))
+
+    snapshot_path = os.environ.get('PINGBOT_SNAPSHOT', 'snapshot.jsonl')
+    metrics_file = os.environ.get('PINGBOT_METRICS_FILE')
+    if shard:
+        history_path = _shard_path(history_path, shard[0])
+        snapshot_path = _shard_path(snapshot_path, shard[0])
+        metrics_file = metrics_file and _shard_path(metrics_file, shard[0])
 
     new_bot = PingingBot(zulip_username, zulip_api_key, key_word,
-                         short_key_word, subscribed_streams)
+                         short_key_word, subscribed_streams, history_path,
+                         recorder=recorder, site=site,
+                         pooled_client=pooled_client, profiler=profiler,
+                         snapshot_path=snapshot_path, shard=shard,
+                         defer_subscriptions=True)
+
+    if os.environ.get('PINGBOT_METRICS_PORT'):
+        new_bot.metrics.serve(int(os.environ['PINGBOT_METRICS_PORT']) +
+                              (shard[0] if shard else 0))
+    if metrics_file:
+        new_bot.metrics.write_periodically(metrics_file)
 
     return new_bot
 
+
+def _shard_path(path, shard):
+    """ Path of a file of a shard ("history.db" -> "history-1.db"). """
+
+    if path == ":memory:":
+        return path
+
+    root, ext = os.path.splitext(path)
+    return "%s-%d%s" % (root, shard, ext)
+
+
+def run_shard(shard, shards):
+    """ Run the bot of a shard (in a worker process of the Supervisor). """
+
+    get_bot((shard, shards)).main()
+
 if __name__ == '__main__':
-    get_bot().main()
+    logging.basicConfig(
+        level=os.environ.get('PINGBOT_LOG_LEVEL', 'INFO').upper(),
+        format="%(asctime)s %(levelname)s %(processName)s %(name)s: "
+               "%(message)s")
+
+    shards = int(os.environ.get('PINGBOT_SHARDS', 1))
+    if shards > 1:
+        Supervisor(shards, run_shard).run()
+    else:
+        get_bot().main()
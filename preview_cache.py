@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import binascii
+import os
+import threading
+import time
+
+
+class Preview():
+
+    """ Participants of a ping waiting for its issuer to confirm them.
+
+        Attributes:
+            issuer_email: Email of the issuer, the only one that can use it.
+            issuer_name: Full name of the issuer.
+            stream: Zulip stream where the ping will be sent.
+            subject: Subject where the ping will be sent.
+            since: Time (arrow) from when participants were collected.
+            collector: ParticipantCollector with the candidates.
+            issuer_msg: Message of the issuer added to the ping (optional).
+            oldest_id: Id of the oldest message scanned (None = no message),
+                the anchor to collect older participants from.
+            lock: Held while a command of the issuer is applied.
+    """
+
+    def __init__(self, issuer_email, issuer_name, stream, subject, since,
+                 collector, issuer_msg=None):
+        self.issuer_email = issuer_email
+        self.issuer_name = issuer_name
+        self.stream = stream
+        self.subject = subject
+        self.since = since
+        self.collector = collector
+        self.issuer_msg = issuer_msg
+        self.oldest_id = None
+        self.lock = threading.Lock()
+
+    def track(self, msgs):
+        """ Iterate over messages scanned keeping the oldest id. """
+
+        for msg in msgs:
+            if self.oldest_id is None or msg["id"] < self.oldest_id:
+                self.oldest_id = msg["id"]
+            yield msg
+
+
+class PreviewCache():
+
+    """ Previews kept in memory under a short token until they expire.
+
+        Attributes:
+            ttl: Seconds a preview can be used after its last command.
+            max_previews: Previews kept (the oldest ones are dropped).
+    """
+
+    def __init__(self, ttl=600, max_previews=1000):
+        self.ttl = ttl
+        self.max_previews = max_previews
+
+        self.lock = threading.Lock()
+        self.previews = {}  # token: (last used, preview)
+
+    def add(self, preview, accept=None):
+        """ Keep a preview returning its token.
+
+        Args:
+            preview: Preview to keep.
+            accept: Function telling if a token can be used (e.g. if it
+                belongs to the shard of the bot), optional.
+        """
+
+        with self.lock:
+            self._expire()
+            token = binascii.hexlify(os.urandom(3)).decode("ascii")
+            while token in self.previews or accept and not accept(token):
+                token = binascii.hexlify(os.urandom(3)).decode("ascii")
+            self.previews[token] = (time.time(), preview)
+
+        return token
+
+    def get(self, token, issuer_email):
+        """ Preview of a token, if it did not expire and the issuer is the
+        same one that asked for it (None otherwise).
+        """
+
+        with self.lock:
+            self._expire()
+            _, preview = self.previews.get(token, (None, None))
+            if preview is None or preview.issuer_email != issuer_email:
+                return None
+
+            self.previews[token] = (time.time(), preview)
+            return preview
+
+    def remove(self, token):
+        """ Forget a preview (confirmed or cancelled).
+
+        Returns:
+            True if the preview was still kept.
+        """
+
+        with self.lock:
+            return self.previews.pop(token, None) is not None
+
+    def _expire(self):
+        now = time.time()
+        for token, (used, _) in self.previews.items():
+            if now - used >= self.ttl:
+                del self.previews[token]
+
+        if len(self.previews) > self.max_previews:
+            oldest = sorted(self.previews.items(),
+                            key=lambda item: item[1][0])
+            for token, _ in oldest[:len(self.previews) - self.max_previews]:
+                del self.previews[token]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import json
+import os
+import Queue
+import random
+import threading
+
+
+class MessageRecorder():
+
+    """ Opt-in capture of the messages a ping collected participants from.
+
+        A sample of the captures is written by a background thread to a file
+        with one JSON object per line ({"issuer": ..., "msgs": [...]}), until
+        the file reaches a maximum size. Pings never wait for the disk: when
+        the writer falls behind, captures are dropped. Captured files can be
+        read back with replay() (e.g. to feed get_participants in tests).
+
+        Attributes:
+            path: File where captures are appended.
+            sample_rate: Fraction of the captures actually recorded (0 to 1).
+            max_bytes: Size of the file from which nothing else is written.
+            max_pending: Captures waiting to be written before dropping.
+    """
+
+    def __init__(self, path, sample_rate=0.1, max_bytes=50 * 1024 * 1024,
+                 max_pending=10):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+
+        self.queue = Queue.Queue(max_pending)
+        self.written = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self._write, name="recorder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sampled(self):
+        """ Decide if the next ping will be captured (see sample_rate). """
+
+        return random.random() < self.sample_rate
+
+    def record(self, msgs, issuer=None):
+        """ Capture the messages of a ping (already sampled).
+
+        Args:
+            msgs: Messages from where participants were extracted.
+            issuer: Participant that pinged the other ones.
+
+        Returns:
+            True if the capture was queued to be written.
+        """
+
+        try:
+            self.queue.put_nowait({"issuer": issuer,
+                                   "msgs": [dict(msg) for msg in msgs]})
+        except Queue.Full:
+            self.dropped += 1
+            return False
+
+        return True
+
+    def close(self):
+        """ Write the pending captures and stop the writer thread. """
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def _write(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+        while True:
+            capture = self.queue.get()
+            if capture is None:
+                break
+
+            line = json.dumps(capture, separators=(",", ":")) + "\n"
+            if size + len(line) > self.max_bytes:
+                self.dropped += 1
+                continue
+
+            with open(self.path, "a") as f:
+                f.write(line)
+
+            size += len(line)
+            self.written += 1
+
+    @classmethod
+    def replay(cls, path):
+        """ Iterate over the captures of a recorded file.
+
+        Args:
+            path: File written by a MessageRecorder.
+
+        Yields:
+            Dicts with the "issuer" and the "msgs" captured.
+        """
+
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import bisect
+import threading
+import time
+
+
+class _Scan():
+
+    """ A history scan of a stream-subject, in flight or finished. """
+
+    def __init__(self, since):
+        self.since = since
+        self.done = threading.Event()
+        self.finished = None  # time when the scan finished
+        self.msgs = None
+        self.timestamps = None
+        self.error = None
+
+    def msgs_since(self, since):
+        """ Latest messages of the senders of the scan later than a
+        timestamp (oldest first).
+        """
+
+        if since <= self.since:
+            return self.msgs
+
+        return self.msgs[bisect.bisect_right(self.timestamps, since):]
+
+
+class ScanCache():
+
+    """ Single-flight layer and short-lived cache of history scans.
+
+        Pings asking for the messages of the same stream-subject share one
+        scan: a ping arriving while a scan of the same or of a wider window
+        is in flight waits for it instead of scanning (coalesced), and a ping
+        arriving shortly after reuses its result (hit). Pings of a stream are
+        answered one after the other (see Dispatcher), so scans only overlap
+        when a ping collects the topics of other streams (see
+        get_participants_from).
+
+        A scan only keeps the latest message of each sender, which is enough
+        to tell the participants of any narrower window, so it holds one
+        message per participant however long the window is. Messages are
+        consumed as they are retrieved, one page at a time. A narrower window
+        is cut from the messages of a wider one with a binary search.
+
+        Attributes:
+            ttl: Seconds a finished scan is reused (messages sent afterwards
+                are not in it).
+            max_scans: Maximum finished scans kept.
+            stats: Number of hits, misses and coalesced pings.
+    """
+
+    def __init__(self, ttl=30, max_scans=100):
+        self.ttl = ttl
+        self.max_scans = max_scans
+
+        self.lock = threading.Lock()
+        self.scans = {}  # (stream, subject): list of _Scan
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    def get(self, stream, subject, since, scan):
+        """ Get the messages of a stream-subject later than a timestamp.
+
+        Args:
+            stream: Zulip stream of the messages.
+            subject: Subject of the messages.
+            since: Epoch timestamp from when messages are collected.
+            scan: Function returning the messages (any iterable, in any
+                order), called only if no scan covering the window can be
+                reused.
+
+        Returns:
+            The latest message of each sender later than since, from the
+            oldest to the latest.
+        """
+
+        key = (stream, subject)
+        with self.lock:
+            self._expire()
+
+            shared = self._find(key, since)
+            if shared is None:
+                self.stats["misses"] += 1
+                shared = _Scan(since)
+                self.scans.setdefault(key, []).append(shared)
+                running = True
+            else:
+                self.stats["hits" if shared.done.is_set()
+                           else "coalesced"] += 1
+                running = False
+
+        if running:
+            self._run(shared, scan)
+        else:
+            shared.done.wait()
+
+        if shared.error is not None:
+            raise shared.error
+
+        return shared.msgs_since(since)
+
+    def get_stats(self):
+        """ Return a copy of the counters including the scans kept. """
+
+        with self.lock:
+            return dict(self.stats, scans=sum(len(scans) for scans in
+                                              self.scans.values()))
+
+    def _find(self, key, since):
+        """ Scan of a window covering since (the narrowest one). """
+
+        covering = [shared for shared in self.scans.get(key, [])
+                    if shared.since <= since and shared.error is None]
+        if not covering:
+            return None
+
+        return max(covering, key=lambda shared: shared.since)
+
+    def _run(self, shared, scan):
+        try:
+            latest = {}  # sender id: latest message
+            for msg in scan():
+                kept = latest.get(msg["sender_id"])
+                if kept is None or kept["id"] < msg["id"]:
+                    latest[msg["sender_id"]] = msg
+
+            # pages retrieved from Zulip come newest first
+            msgs = sorted(latest.itervalues(),
+                          key=lambda msg: (msg["timestamp"], msg["id"]))
+            shared.timestamps = [msg["timestamp"] for msg in msgs]
+            shared.msgs = msgs
+        except Exception as error:
+            shared.error = error
+
+        # failed scans are not reused (see _find) and dropped by _expire
+        with self.lock:
+            shared.finished = time.time()
+            shared.done.set()
+
+    def _expire(self):
+        """ Forget expired scans and the oldest ones over max_scans. """
+
+        now = time.time()
+        finished = []
+        for key, scans in self.scans.items():
+            scans[:] = [shared for shared in scans
+                        if shared.finished is None or
+                        (shared.error is None and
+                         now - shared.finished < self.ttl)]
+            finished.extend((shared.finished, key, shared) for shared in scans
+                            if shared.finished is not None)
+            if not scans:
+                del self.scans[key]
+
+        finished.sort()
+        for _, key, shared in finished[:max(0, len(finished) -
+                                            self.max_scans)]:
+            self.scans[key].remove(shared)
+            if not self.scans[key]:
+                del self.scans[key]
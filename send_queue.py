@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import Queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SendError(RuntimeError):
+
+    """ A message rejected by Zulip.
+
+        Attributes:
+            retry: True if the message may be accepted later (rate limited).
+            headers: Headers of the response (None if unknown).
+    """
+
+    def __init__(self, msg, retry=False, headers=None):
+        RuntimeError.__init__(self, msg)
+        self.retry = retry
+        self.headers = headers
+
+
+class TokenBucket():
+
+    """ Rate limiter allowing bursts, tuned by the rate limit of Zulip.
+
+        Attributes:
+            rate: Tokens added per second.
+            capacity: Maximum tokens (the longest burst allowed).
+    """
+
+    def __init__(self, rate=1.0, capacity=10):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Wait for a token and take it. Returns the seconds waited. """
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, headers):
+        """ Follow the X-RateLimit headers of a Zulip response.
+
+        Args:
+            headers: Response headers (X-RateLimit-Remaining and
+                X-RateLimit-Reset, the epoch time when the limit resets).
+        """
+
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = float(headers["X-RateLimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self.lock:
+            self.tokens = min(self.tokens, remaining)
+            seconds = reset - time.time()
+            if seconds > 0:
+                self.rate = max(remaining / seconds, 1.0 / seconds)
+
+
+class SendQueue():
+
+    """ Outbound messages sent to Zulip by a background thread.
+
+        Messages are sent in the order they were queued, no faster than the
+        token bucket allows (tuned with the rate limit headers of the
+        responses). Sends failing because of the connection or the rate
+        limit are retried with exponential backoff, other failures are not
+        (sending a message twice would ping twice).
+        Callers never wait for Zulip: when the queue stays full for
+        put_timeout seconds, the message is dropped.
+
+        Attributes:
+            deliver: Function sending a message, returning the response
+                headers (or None) and raising IOError (connection errors) or
+                RuntimeError (e.g. SendError) if the message was not sent.
+            bucket: TokenBucket limiting the messages sent per second.
+            retries: Times a failed message is sent again.
+            backoff: Seconds waited before the first retry (then doubled).
+            metrics: Metrics where the send latency (from queued to sent) is
+                observed (optional).
+            stats: Messages sent, failed, retried and dropped, and latency.
+    """
+
+    def __init__(self, deliver, bucket=None, max_pending=100, retries=3,
+                 backoff=1, put_timeout=1, metrics=None):
+        self.deliver = deliver
+        self.bucket = bucket or TokenBucket()
+        self.retries = retries
+        self.backoff = backoff
+        self.put_timeout = put_timeout
+        self.metrics = metrics
+
+        self.queue = Queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.stats = {"sent": 0, "failed": 0, "retries": 0, "dropped": 0,
+                      "seconds": 0.0, "max_seconds": 0.0}
+
+        self.thread = threading.Thread(target=self._send, name="send-queue")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, msg):
+        """ Queue a message to be sent.
+
+        Returns:
+            False if the queue stayed full and the message was dropped.
+        """
+
+        try:
+            self.queue.put((time.time(), msg), timeout=self.put_timeout)
+        except Queue.Full:
+            with self.lock:
+                self.stats["dropped"] += 1
+            logger.error("send queue full, message to %s dropped",
+                         msg.get("to"))
+            return False
+
+        return True
+
+    def flush(self):
+        """ Wait until every message queued was sent (or failed). """
+
+        self.queue.join()
+
+    def get_stats(self):
+        """ Return a copy of the stats including messages waiting. """
+
+        with self.lock:
+            stats = dict(self.stats, pending=self.queue.qsize())
+
+        stats["mean_seconds"] = stats["seconds"] / (stats["sent"] or 1)
+        return stats
+
+    def _send(self):
+        while True:
+            queued, msg = self.queue.get()
+            try:
+                sent = self._send_one(msg)
+            except Exception:
+                logger.exception("error sending message to %s", msg.get("to"))
+                sent = False
+
+            seconds = time.time() - queued
+            with self.lock:
+                self.stats["sent" if sent else "failed"] += 1
+                if sent:
+                    self.stats["seconds"] += seconds
+                    self.stats["max_seconds"] = max(
+                        self.stats["max_seconds"], seconds)
+
+            if sent and self.metrics:
+                self.metrics.observe("pingbot_send_seconds", seconds)
+            self.queue.task_done()
+
+    def _send_one(self, msg):
+        """ Send a message retrying failures. Returns True if it was sent. """
+
+        for attempt in range(self.retries + 1):
+            self.bucket.take()
+            try:
+                headers = self.deliver(msg)
+            except IOError as error:
+                logger.warning("message to %s not sent (attempt %d): %s",
+                               msg.get("to"), attempt + 1, error)
+            except RuntimeError as error:
+                logger.warning("message to %s not sent (attempt %d): %s",
+                               msg.get("to"), attempt + 1, error)
+                if not getattr(error, "retry", False):
+                    break
+                if error.headers:
+                    self.bucket.update(error.headers)
+            else:
+                if headers:
+                    self.bucket.update(headers)
+                return True
+
+            if attempt < self.retries:
+                with self.lock:
+                    self.stats["retries"] += 1
+                time.sleep(self.backoff * 2 ** attempt)
+
+        logger.error("message to %s could not be sent", msg.get("to"))
+        return False
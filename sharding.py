@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:15], 16)
+
+
+def _run_worker(target, shard, shards):
+    # workers are stopped by SIGTERM, not by the handler of the supervisor
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(shard, shards)
+
+
+class HashRing():
+
+    """ Consistent hashing of stream names onto a number of shards.
+
+        Each shard is placed in many points of a ring and a stream belongs
+        to the shard of the first point after the hash of its name. When
+        the number of shards changes from N to N + 1, only about 1 / (N + 1)
+        of the streams move to another shard.
+
+        Attributes:
+            shards: Number of shards.
+            replicas: Points of each shard in the ring.
+    """
+
+    def __init__(self, shards, replicas=100):
+        self.shards = shards
+        self.replicas = replicas
+
+        points = sorted((_hash("%d:%d" % (shard, replica)), shard)
+                        for shard in range(shards)
+                        for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [shard for _, shard in points]
+
+    def shard_of(self, name):
+        """ Shard (0 to shards - 1) a stream name belongs to. """
+
+        index = bisect.bisect(self.hashes, _hash(name)) % len(self.hashes)
+        return self.owners[index]
+
+
+class Supervisor():
+
+    """ Runs one worker process per shard, restarting the ones that die.
+
+        Attributes:
+            shards: Number of worker processes.
+            target: Function run by each worker, called with the shard index
+                and the number of shards.
+            restart_wait: Seconds a worker must have run to be restarted at
+                once (workers dying faster wait this long to be restarted).
+            restarts: Times each shard was restarted.
+    """
+
+    def __init__(self, shards, target, restart_wait=5):
+        self.shards = shards
+        self.target = target
+        self.restart_wait = restart_wait
+
+        self.workers = {}  # shard: (process, start time)
+        self.restarts = {}
+        self.stopping = threading.Event()
+
+    def start(self):
+        """ Start a worker for every shard. """
+
+        for shard in range(self.shards):
+            self._start_worker(shard)
+
+    def check(self):
+        """ Restart the workers that died. """
+
+        for shard, (process, started) in sorted(self.workers.items()):
+            if process.is_alive() or self.stopping.is_set():
+                continue
+            if time.time() - started < self.restart_wait:
+                continue
+
+            logger.warning("shard %d died (exit code %s), restarting", shard,
+                           process.exitcode)
+            self.restarts[shard] = self.restarts.get(shard, 0) + 1
+            self._start_worker(shard)
+
+    def resize(self, shards):
+        """ Restart every worker with a new number of shards.
+
+        Each worker recomputes the streams it owns (see HashRing), so only
+        the streams moving between shards lose their warm caches.
+        """
+
+        logger.info("resizing from %d to %d shards", self.shards, shards)
+        self.stop()
+        self.stopping.clear()
+        self.shards = shards
+        self.workers = {}
+        self.start()
+
+    def stop(self, timeout=30):
+        """ Ask every worker to stop (SIGTERM) and wait for them. """
+
+        self.stopping.set()
+        for process, _ in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.time() + timeout
+        for process, _ in self.workers.values():
+            process.join(max(0, deadline - time.time()))
+
+    def run(self, interval=1):
+        """ Start the workers and keep them running until SIGTERM. """
+
+        signal.signal(signal.SIGTERM, lambda *args: self.stopping.set())
+        self.start()
+        try:
+            while not self.stopping.is_set():
+                self.check()
+                self.stopping.wait(interval)
+        finally:
+            self.stop()
+
+    def _start_worker(self, shard):
+        process = multiprocessing.Process(target=_run_worker,
+                                          args=(self.target, shard,
+                                                self.shards),
+                                          name="shard-%d" % shard)
+        process.start()
+        self.workers[shard] = (process, time.time())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot():
+
+    """ File with the state of the bot, to start warm after a restart.
+
+        The file has one JSON document per line: a header (a dict) followed
+        by one line per topic, [stream, subject, [[name, timestamp], ...]],
+        so it is written and read streaming without holding it as a whole.
+        It is written to a temporary file first and then renamed, so a crash
+        while writing never leaves a truncated snapshot.
+
+        Attributes:
+            path: Path of the snapshot file.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, header, topics):
+        """ Write a snapshot.
+
+        Args:
+            header: Dict with the state that is not per topic.
+            topics: Iterable of (stream, subject, [(name, timestamp)...]).
+        """
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(dict(header, version=self.VERSION),
+                               separators=(",", ":")) + "\n")
+            for topic in topics:
+                f.write(json.dumps(topic, separators=(",", ":")) + "\n")
+
+        os.rename(tmp_path, self.path)
+
+    def read(self):
+        """ Read the header of the snapshot and iterate over its topics.
+
+        Returns:
+            Tuple (header, iterator over the topics), or (None, None) if
+            there is no usable snapshot.
+        """
+
+        try:
+            f = open(self.path)
+            header = json.loads(f.readline())
+        except (IOError, ValueError) as error:
+            logger.info("no snapshot to start from: %s", error)
+            return None, None
+
+        if header.get("version") != self.VERSION:
+            f.close()
+            logger.warning("snapshot version %s ignored",
+                           header.get("version"))
+            return None, None
+
+        def topics():
+            with f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+        return header, topics()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import threading
+import time
+
+
+class StreamCache():
+
+    """ Names of the Zulip streams, listed again only when they get stale.
+
+        The list is asked to Zulip at most once every ttl seconds, sending the
+        ETag of the last list so the server can answer "not modified" without
+        the list. Streams created or deleted meanwhile are applied from the
+        event stream with add() and remove().
+
+        Attributes:
+            fetch: Function called with the last ETag (or None) returning a
+                tuple (stream names, ETag), or None if nothing changed.
+            ttl: Seconds the list is used before asking Zulip again.
+            fetches: Times the list was asked to Zulip.
+            not_modified: Times Zulip answered the list had not changed.
+    """
+
+    def __init__(self, fetch, ttl=300):
+        self.fetch = fetch
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.names = None
+        self.etag = None
+        self.expires = 0
+        self.fetches = 0
+        self.not_modified = 0
+
+    def get(self):
+        """ Return the stream names, refreshing them if they expired. """
+
+        with self.lock:
+            if self.names is None or time.time() >= self.expires:
+                self._refresh()
+
+            return list(self.names)
+
+    def add(self, name):
+        """ Add a stream created after the list was fetched. """
+
+        with self.lock:
+            if self.names is not None and name not in self.names:
+                self.names.append(name)
+
+    def remove(self, name):
+        """ Remove a stream deleted after the list was fetched. """
+
+        with self.lock:
+            if self.names is not None and name in self.names:
+                self.names.remove(name)
+
+    def invalidate(self):
+        """ Force the list to be asked again on the next get(). """
+
+        with self.lock:
+            self.expires = 0
+
+    def _refresh(self):
+        self.fetches += 1
+        result = self.fetch(self.etag if self.names is not None else None)
+
+        if result is None:
+            self.not_modified += 1
+        else:
+            self.names, self.etag = result
+
+        self.expires = time.time() + self.ttl
@@ -2,8 +2,80 @@ import unittest
 import nose
 import arrow
 import json
+import os
+import requests
+import tempfile
+import threading
+import time
 import pinging_bot
-from mock import Mock
+from dispatcher import Dispatcher
+from recorder import MessageRecorder
+import zulip_transport
+from fake_zulip import FakeZulipServer
+from history_cache import HistoryCache
+from participant_index import ParticipantIndex, ParticipantCollector
+from scan_cache import ScanCache
+from stream_cache import StreamCache
+from metrics import Metrics, SlowPingProfiler
+from snapshot import Snapshot
+from send_queue import SendError, SendQueue, TokenBucket
+from compact_msg import CompactMsg
+from id_index import IdIndex
+from sharding import HashRing, Supervisor
+from preview_cache import PreviewCache
+from mock import Mock, patch
+
+NOW = arrow.get(2015, 3, 18, 17, 10, 14)
+
+
+def make_bot(**attrs):
+    """Create a PingingBot without connecting to Zulip."""
+
+    with patch.object(pinging_bot.PingingBot, "__init__", return_value=None):
+        bot = pinging_bot.PingingBot()
+    bot.__dict__.update(attrs)
+
+    return bot
+
+
+def wait_for(condition, timeout=5):
+    """Wait until a condition is true, returning False after timeout."""
+
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+def make_msgs(num, subject="some subject", start_id=1):
+    """Create a synthetic stream history, one message per minute."""
+
+    msgs = []
+    for i in range(num):
+        msgs.append({"id": start_id + i,
+                     "timestamp": NOW.timestamp - (num - i) * 60,
+                     "subject": subject,
+                     "sender_full_name": "Name%d" % (i % 7),
+                     "sender_email": "an email",
+                     "sender_id": i % 7,
+                     "display_recipient": "some stream"})
+
+    return msgs
+
+
+def fake_chunks(server_msgs):
+    """Mock _get_msgs_chunk paging backwards through server_msgs."""
+
+    def get_msgs_chunk(chunk_size, stream, anchor=18446744073709551615,
+                       subject=None):
+        older = [msg for msg in server_msgs if msg["id"] <= anchor and
+                 subject in (None, msg["subject"])]
+        return older[-chunk_size:]
+
+    return Mock(side_effect=get_msgs_chunk)
 
 
 class BotTest(unittest.TestCase):
@@ -80,6 +152,26 @@ class BotTest(unittest.TestCase):
         self.assertEqual(w0, w0_exp)
         self.assertEqual(this_week, this_week_exp)
 
+    def test_parse_time_fast_path(self):
+
+        def parse(parser, time_str):
+            try:
+                return parser(time_str)
+            except Exception:
+                return None
+
+        def grammar(time_str):
+            return self.new_bot.TIME_GRAMMAR(time_str).message()
+
+        samples = ["5d", "m2", "7m", "2q", "10min", "10 minutes hi", "min 5",
+                   "today", "today hi", "d", "d0", "d 5 hi", "d hi", "week",
+                   "this week", "thisweek", "this week see you", "this",
+                   "10", "10 hello", "5d5"]
+
+        for time_str in samples:
+            self.assertEqual(parse(self.new_bot._parse_time_str, time_str),
+                             parse(grammar, time_str))
+
     def test_get_participants(self):
 
         with open("test_msgs.json") as f:
@@ -100,15 +192,17 @@ class BotTest(unittest.TestCase):
             data = json.load(f)
         test_msgs = data["msgs"]
 
-        self.new_bot._get_msgs_chunk = Mock(return_value=test_msgs)
-        self.new_bot.__init__ = Mock(return_value=None)
-
         stream = test_msgs[0]["display_recipient"]
         subject = test_msgs[0]["subject"]
         issuer = "Name1"
 
-        participants = self.new_bot().get_last_participants(2, stream, subject,
-                                                            issuer)
+        with patch.object(self.new_bot, "_get_msgs_chunk",
+                          Mock(return_value=test_msgs)), \
+                patch.object(self.new_bot, "__init__",
+                             Mock(return_value=None)), \
+                patch.object(arrow, "now", return_value=NOW):
+            participants = self.new_bot().get_last_participants(
+                2, stream, subject, issuer)
 
         self.assertEqual(len(participants), 2)
 
@@ -137,6 +231,1109 @@ class BotTest(unittest.TestCase):
 
         self.assertEqual(ping_msg["content"], exp_ping_msg)
 
+    def test_get_last_participants_stops_early(self):
+
+        for history in (None, HistoryCache()):
+            bot = make_bot(history=history, CHUNK_SIZE=3,
+                           _get_msgs_chunk=fake_chunks(make_msgs(30)))
+
+            with patch.object(arrow, "now", return_value=NOW):
+                participants = bot.get_last_participants(
+                    4, "some stream", "some subject", "my name")
+
+            # messages 30..27 were sent by Name1, Name0, Name6 and Name5
+            self.assertEqual(participants, ["@**Name1**", "@**Name0**",
+                                            "@**Name6**", "@**Name5**"])
+            self.assertEqual(bot._get_msgs_chunk.call_count, 2)
+
+    def test_cutoff_index(self):
+
+        msgs = [{"timestamp": timestamp} for timestamp in [1, 2, 2, 3, 5]]
+        cutoffs = [self.new_bot._cutoff_index(msgs, since)
+                   for since in [0, 1, 2, 4, 5]]
+
+        self.assertEqual(cutoffs, [0, 1, 3, 4, 5])
+
+        # only the timestamps looked at by the binary search are read
+        read = []
+
+        class Msg(dict):
+            def __getitem__(self, key):
+                read.append(key)
+                return dict.__getitem__(self, key)
+
+        msgs = [Msg(timestamp=timestamp) for timestamp in range(1000)]
+        self.assertEqual(self.new_bot._cutoff_index(msgs, 500), 501)
+        self.assertLessEqual(len(read), 11)
+
+    def test_history_cache(self):
+
+        cache = HistoryCache()
+        msgs = make_msgs(10)
+        cache.add("some stream", msgs)
+        cache.set_coverage("some stream", 1, 10, msgs[0]["timestamp"])
+
+        cached = cache.get_msgs("some stream", "some subject",
+                                msgs[4]["timestamp"])
+        self.assertEqual([msg["id"] for msg in cached], range(6, 11))
+
+        cached = cache.get_msgs("some stream", "some subject", 0, min_id=3,
+                                before_id=6, newest_first=True)
+        self.assertEqual([msg["id"] for msg in cached], [5, 4, 3])
+
+        cache.evict(msgs[4]["timestamp"])
+        self.assertEqual(cache.coverage("some stream"),
+                         (6, 10, msgs[4]["timestamp"]))
+
+    def test_get_msgs_fetches_only_gap(self):
+
+        server_msgs = make_msgs(10)
+        bot = make_bot(history=HistoryCache(), CHUNK_SIZE=3,
+                       _get_msgs_chunk=fake_chunks(server_msgs))
+
+        with patch.object(arrow, "now", return_value=NOW):
+            msgs = bot.get_msgs(arrow.get(0), "some stream", "some subject")
+            self.assertEqual([msg["id"] for msg in msgs], range(1, 11))
+            calls = bot._get_msgs_chunk.call_count
+
+            # two new messages only need one more chunk
+            server_msgs.extend(make_msgs(2, start_id=11))
+            msgs = bot.get_msgs(arrow.get(0), "some stream", "some subject")
+
+        self.assertEqual(len(msgs), 12)
+        self.assertEqual(bot._get_msgs_chunk.call_count, calls + 1)
+
+    def test_participant_index(self):
+
+        index = ParticipantIndex()
+        msgs = make_msgs(10)
+        for msg in msgs:
+            msg["type"] = "stream"
+            index.add(msg)
+
+        # Name0..Name6 last seen in messages 8, 9, 10, 4, 5, 6, 7
+        since = index.get_since("some stream", "some subject",
+                                msgs[4]["timestamp"], issuer="Name6")
+        self.assertEqual(since, ["Name5", "Name0", "Name1", "Name2"])
+
+        last = index.get_last("some stream", "some subject", 3)
+        self.assertEqual(last, ["Name2", "Name1", "Name0"])
+
+        index.start(msgs[0]["timestamp"])
+        self.assertTrue(index.covers(msgs[0]["timestamp"]))
+        self.assertFalse(index.covers(msgs[0]["timestamp"] - 1))
+        self.assertEqual(
+            index.get_last("some stream", "some subject", 7,
+                           since=msgs[7]["timestamp"]),
+            ["Name2", "Name1", "Name0"])
+
+        # senders older than the maximum time range are forgotten
+        index.add(dict(msgs[0], subject="old subject"))
+        index.prune(msgs[5]["timestamp"])
+        self.assertEqual(index.dump(),
+                         [("some stream", "some subject",
+                           [(msg["sender_full_name"], msg["timestamp"])
+                            for msg in msgs[6:]])])
+
+    def test_participant_collector(self):
+
+        msgs = make_msgs(10)
+        msgs[3]["sender_email"] = "pinging-bot@students.hackerschool.com"
+        msgs[5]["sender_full_name"] = "Renamed"
+
+        is_bot = Mock(side_effect=self.new_bot._bot_msg)
+        collector = ParticipantCollector("Name1", is_bot)
+        collector.add_all(msgs, limit=3)
+        self.assertEqual(collector.format(), ["@**Name0**", "@**Name2**",
+                                              "@**Name4**"])
+
+        collector.add_all(msgs)
+        self.assertEqual(collector.format()[3:], ["@**Renamed**",
+                                                  "@**Name6**"])
+        self.assertEqual(is_bot.call_count, 6)
+
+        # renamed users are pinged with their latest name, in any order
+        renamed = make_msgs(2)
+        renamed[0].update(sender_id=7, sender_full_name="Old Name")
+        renamed[1].update(sender_id=7, sender_full_name="New Name")
+        for msgs in [renamed, renamed[::-1]]:
+            self.assertEqual(self.new_bot.get_participants(msgs, "Name1"),
+                             ["@**New Name**"])
+
+    def test_get_last_participants_from_index(self):
+
+        index = ParticipantIndex()
+        msgs = make_msgs(10)
+        for msg in msgs:
+            msg["type"] = "stream"
+            index.add(msg)
+        index.start(msgs[0]["timestamp"])
+
+        bot = make_bot(participant_index=index, _get_msgs_chunk=Mock())
+        participants = bot.get_last_participants(2, "some stream",
+                                                 "some subject", "Name1")
+
+        self.assertEqual(participants, ["@**Name2**", "@**Name0**"])
+        self.assertFalse(bot._get_msgs_chunk.called)
+
+        # senders before the index is complete may not be the last ones
+        index.start(msgs[8]["timestamp"])
+        bot._get_msgs_chunk = fake_chunks(msgs)
+        with patch.object(arrow, "now", return_value=NOW):
+            participants = bot.get_last_participants(2, "some stream",
+                                                     "some subject", "Name1")
+        self.assertEqual(participants, ["@**Name2**", "@**Name0**"])
+        self.assertTrue(bot._get_msgs_chunk.called)
+
+    def test_adaptive_chunk_size(self):
+
+        bot = make_bot(_get_msgs_chunk=fake_chunks(make_msgs(1000)))
+
+        with patch.object(arrow, "now", return_value=NOW):
+            msgs = bot.get_msgs(NOW.replace(minutes=-10), "some stream",
+                                "some subject")
+
+            # a short window with an unknown rate asks a small chunk
+            self.assertEqual(len(msgs), 9)
+            self.assertEqual(bot._get_msgs_chunk.call_args[0][0], 100)
+
+            # one message per minute: 6 hours are 360 messages (+25%)
+            self.assertAlmostEqual(
+                bot.msg_rates[("some stream", "some subject")], 1 / 60.0)
+            self.assertEqual(bot._chunk_size("some stream", "some subject",
+                                             NOW.timestamp - 6 * 3600), 451)
+
+        self.assertEqual(bot._chunk_size("some stream", previous=3000), 5000)
+        self.assertEqual(bot._chunk_size("other stream", "other subject",
+                                         NOW.timestamp - 6 * 3600), 100)
+
+        # only the rates of the latest stream-subjects are kept
+        bot.MAX_RATES = 2
+        bot._observe_rate("other stream", "a", make_msgs(2))
+        bot._observe_rate("other stream", "b", make_msgs(2))
+        self.assertEqual(list(bot.msg_rates), [("other stream", "a"),
+                                               ("other stream", "b")])
+
+    def test_get_msgs_topic_narrow(self):
+
+        server_msgs = make_msgs(6) + make_msgs(4, "other subject", 7)
+        bot = make_bot(CHUNK_SIZE=3, _get_msgs_chunk=fake_chunks(server_msgs))
+
+        with patch.object(arrow, "now", return_value=NOW):
+            msgs = bot.get_msgs(NOW.replace(days=-1), "some stream",
+                                "some subject")
+
+        self.assertEqual(len(msgs), 6)
+        self.assertEqual(bot._get_msgs_chunk.call_args[0][3], "some subject")
+
+    def test_get_msgs_chunk_narrow_fallback(self):
+
+        rejected = Mock(status_code=400)
+        rejected.json.return_value = {
+            "result": "error",
+            "msg": "Invalid narrow operator: unknown operator topic"}
+        accepted = Mock(status_code=200, content="{}")
+        accepted.json.return_value = {"messages": make_msgs(2)}
+
+        bot = make_bot(transport=Mock())
+        bot.transport.get.side_effect = [rejected, accepted]
+        msgs = bot._get_msgs_chunk(10, "some stream", 5, "some subject")
+
+        narrows = [json.loads(call[1]["params"]["narrow"])
+                   for call in bot.transport.get.call_args_list]
+        self.assertEqual(len(narrows[0]), 2)
+        self.assertEqual(narrows[1], [{"operator": "stream",
+                                       "operand": "some stream"}])
+        self.assertEqual(len(msgs), 2)
+        self.assertFalse(bot.topic_narrow)
+        self.assertEqual(bot.msgs_fetched, 2)
+
+        # other errors (e.g. an unknown stream) keep the topic narrow
+        unknown = Mock(status_code=400, content="")
+        unknown.json.return_value = {"result": "error",
+                                     "msg": "Invalid stream name 'nope'"}
+        bot = make_bot(transport=Mock())
+        bot.transport.get.return_value = unknown
+        self.assertIsNone(bot._get_msgs_chunk(10, "nope", 5, "some subject"))
+        self.assertEqual(bot.transport.get.call_count, 1)
+        self.assertTrue(bot.topic_narrow)
+
+    def test_transport_retries(self):
+
+        limited = Mock(status_code=429, content="",
+                       headers={"Retry-After": "2"})
+        failed = Mock(status_code=503, content="", headers={})
+        ok = Mock(status_code=200, content="{}", headers={})
+
+        transport = zulip_transport.ZulipTransport("bot", "key", backoff=0.1)
+        with patch.object(transport.session, "request",
+                          side_effect=[limited, failed, ok]), \
+                patch.object(zulip_transport.time, "sleep") as sleep:
+            response = transport.get("messages")
+
+        self.assertIs(response, ok)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [2.0, 0.2])
+
+        stats = transport.get_stats()["messages"]
+        self.assertEqual((stats["calls"], stats["errors"], stats["retries"],
+                          stats["bytes"]), (3, 2, 2, 2))
+
+        # messages sent are not repeated by the transport
+        with patch.object(transport.session, "request",
+                          side_effect=[failed, ok]) as request:
+            response = transport.post("messages", retries=0)
+        self.assertIs(response, failed)
+        self.assertEqual(request.call_count, 1)
+
+    def test_dispatcher(self):
+
+        release = threading.Event()
+        submitted = threading.Event()
+        handled = []
+
+        def handler(item):
+            if item == "a1":
+                release.wait(5)
+            else:
+                submitted.wait(5)
+            handled.append(item)
+
+        dispatcher = Dispatcher(handler, workers=2, max_queue=3,
+                                submit_timeout=0)
+        dispatcher.start()
+
+        # "a2" waits for "a1" while "b1" is handled by the other worker
+        self.assertTrue(dispatcher.submit("a", "a1"))
+        self.assertTrue(dispatcher.submit("a", "a2"))
+        self.assertTrue(dispatcher.submit("b", "b1"))
+        self.assertFalse(dispatcher.submit("c", "c1"))
+
+        submitted.set()
+        self.assertTrue(wait_for(lambda: "b1" in handled))
+        self.assertEqual(handled, ["b1"])
+
+        release.set()
+        self.assertTrue(wait_for(
+            lambda: dispatcher.get_stats()["handled"] == 3))
+
+        self.assertEqual(handled, ["b1", "a1", "a2"])
+        stats = dispatcher.get_stats()
+        self.assertEqual((stats["handled"], stats["dropped"],
+                          stats["max_depth"]), (3, 1, 3))
+
+    def test_fetch_stats_per_thread(self):
+
+        chunks = fake_chunks(make_msgs(30))
+        release = threading.Event()
+        started = threading.Event()
+
+        def get_msgs_chunk(chunk_size, stream, anchor, subject=None):
+            if stream == "slow stream":
+                started.set()
+                release.wait(5)
+                return chunks(chunk_size, stream, anchor, subject)[-10:]
+            return chunks(chunk_size, stream, anchor, subject)
+
+        bot = make_bot(_get_msgs_chunk=get_msgs_chunk)
+        since = NOW.replace(hours=-1)
+        stats = []
+
+        def slow_search():
+            bot.get_msgs(since, "slow stream", "some subject")
+            stats.append(bot.last_fetch_stats)
+
+        thread = threading.Thread(target=slow_search)
+        thread.start()
+        self.assertTrue(started.wait(5))
+        bot.get_msgs(since, "some stream", "some subject")
+        release.set()
+        thread.join(5)
+
+        # each search only counts its own messages
+        self.assertEqual(bot.last_fetch_stats["kept"], 30)
+        self.assertEqual(stats[0]["kept"], 10)
+        self.assertEqual(bot.msgs_kept, 40)
+
+    def test_recorder_replay(self):
+
+        with open("test_msgs.json") as f:
+            test_msgs = json.load(f)["msgs"]
+
+        path = tempfile.mktemp(suffix=".jsonl")
+        try:
+            recorder = MessageRecorder(path, sample_rate=1)
+            self.assertTrue(recorder.record(test_msgs, "my name"))
+            recorder.close()
+
+            captures = list(MessageRecorder.replay(path))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.assertEqual(len(captures), 1)
+        participants = self.new_bot.get_participants(captures[0]["msgs"],
+                                                     captures[0]["issuer"])
+        self.assertEqual(participants, ["@**Name1**", "@**Name2**",
+                                        "@**Name3**", "@**Name4**",
+                                        "@**Name5**"])
+
+    def test_recorder_limits(self):
+
+        path = tempfile.mktemp(suffix=".jsonl")
+        try:
+            recorder = MessageRecorder(path, sample_rate=0)
+            self.assertFalse(recorder.sampled())
+
+            recorder = MessageRecorder(path, sample_rate=1, max_bytes=10)
+            recorder.record(make_msgs(10))
+            recorder.close()
+
+            self.assertEqual((recorder.written, recorder.dropped), (0, 1))
+            self.assertFalse(os.path.exists(path))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_fake_zulip_end_to_end(self):
+
+        server = FakeZulipServer().start()
+        try:
+            server.generate(msgs_per_stream=300, topics=3, senders=20)
+            bot = pinging_bot.PingingBot(
+                "pinging-bot@students.hackerschool.com", "key", "PingingBot",
+                "PingBot", ["stream 0"], site=server.url)
+
+            bot.respond({"type": "stream", "content": "PingBot 3",
+                         "display_recipient": "stream 0",
+                         "subject": "topic 0",
+                         "sender_full_name": "User 10",
+                         "sender_email": "user10@example.com"})
+            bot.send_queue.flush()
+        finally:
+            server.stop()
+
+        topic_msgs = [msg for msg in server.msgs[:-1]
+                      if msg["subject"] == "topic 0"]
+        expected = bot.get_participants(reversed(topic_msgs), "User 10")[:3]
+
+        reply = server.msgs[-1]
+        self.assertEqual(reply["sender_email"],
+                         "pinging-bot@students.hackerschool.com")
+        self.assertEqual((reply["display_recipient"], reply["subject"]),
+                         ("stream 0", "topic 0"))
+        for participant in expected:
+            self.assertIn(participant, reply["content"])
+        self.assertEqual(server.calls["/v1/messages"], 2)
+
+        metrics = bot.metrics.render()
+        for stage in ["parse", "collect", "fetch_page", "format", "send"]:
+            self.assertIn('pingbot_stage_seconds_count{stage="%s"} 1' % stage,
+                          metrics)
+        self.assertIn('pingbot_pings_total{kind="num"} 1', metrics)
+
+    def test_stream_cache_and_subscriptions(self):
+
+        server = FakeZulipServer().start()
+        try:
+            server.generate(streams=250, msgs_per_stream=1)
+            bot = pinging_bot.PingingBot(
+                "pinging-bot@students.hackerschool.com", "key", "PingingBot",
+                "PingBot", site=server.url)
+
+            # 3 batches of streams, the list of streams asked only once
+            self.assertEqual(server.calls["/v1/users/me/subscriptions"], 3)
+            self.assertEqual(len(bot.streams), 250)
+            self.assertEqual(server.calls["/v1/streams"], 1)
+
+            bot.stream_cache.invalidate()
+            self.assertEqual(len(bot.streams), 250)
+            self.assertEqual(bot.stream_cache.not_modified, 1)
+
+            server.create_stream("new stream")
+            bot.on_event(server.events[-1])
+            self.assertIn({"name": "new stream"}, bot.streams)
+            self.assertTrue(wait_for(
+                lambda: server.calls["/v1/users/me/subscriptions"] == 4))
+            self.assertEqual(server.calls["/v1/streams"], 2)
+        finally:
+            server.stop()
+
+        bot.transport = Mock()
+        bot.transport.post.side_effect = IOError("connection refused")
+        self.assertEqual(bot.subscribe_to_streams([{"name": "a"}]), ["a"])
+
+    def test_scan_cache(self):
+
+        msgs = make_msgs(100)
+        for msg in msgs:
+            msg["sender_id"] = msg["id"]
+        release = threading.Event()
+        started = threading.Event()
+        scans = []
+
+        def scan():
+            scans.append(1)
+            started.set()
+            release.wait(5)
+            return msgs
+
+        cache = ScanCache()
+        results = []
+
+        def ping(since):
+            results.append(cache.get("stream", "subject", since, scan))
+
+        # a 2 hour ping is in flight when a 1 hour ping arrives
+        threads = [threading.Thread(target=ping, args=(NOW.timestamp - 7200,))]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        threads.append(threading.Thread(target=ping,
+                                        args=(NOW.timestamp - 3600,)))
+        threads[1].start()
+        self.assertTrue(wait_for(
+            lambda: cache.get_stats()["coalesced"] == 1))
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(sorted(len(result) for result in results), [59, 100])
+
+        # a narrower window is cut from the finished scan
+        self.assertEqual(cache.get("stream", "subject", NOW.timestamp - 600,
+                                   scan), msgs[-9:])
+        self.assertEqual(len(scans), 1)
+
+        # a wider window needs a new scan
+        cache.get("stream", "subject", NOW.timestamp - 86400, scan)
+        self.assertEqual(len(scans), 2)
+        self.assertEqual(cache.get_stats(), {"hits": 1, "misses": 2,
+                                             "coalesced": 1, "scans": 2})
+
+        # pages retrieved from Zulip come newest first
+        cache.get("other", "subject", NOW.timestamp - 600,
+                  lambda: msgs[-5:] + msgs[-10:-5])
+        self.assertEqual(cache.get("other", "subject", NOW.timestamp - 180,
+                                   scan), msgs[-2:])
+
+        # only the latest message of each sender is kept
+        repeated = make_msgs(100)
+        self.assertEqual(cache.get("repeated", "subject", 0,
+                                   lambda: iter(repeated[::-1])),
+                         repeated[-7:])
+        self.assertEqual(cache.get("repeated", "subject",
+                                   repeated[-3]["timestamp"], scan),
+                         repeated[-2:])
+
+        # a ping of a topic waits for the scan of a ping from another stream
+        server_msgs = make_msgs(100)
+        chunks = fake_chunks(server_msgs)
+        release.clear()
+
+        def get_msgs_chunk(*args):
+            release.wait(5)
+            return chunks(*args)
+
+        sent = []
+        bot = make_bot(key_word="pingbot", short_key_word="pb",
+                       _get_msgs_chunk=get_msgs_chunk,
+                       send_message=sent.append, scan_cache=ScanCache(),
+                       participant_index=ParticipantIndex())
+        bot.dispatcher = Dispatcher(bot.respond, workers=2)
+        bot.dispatcher.start()
+        trigger = {"id": 200, "type": "stream", "timestamp": NOW.timestamp,
+                   "subject": "some subject", "sender_id": 99,
+                   "sender_full_name": "Issuer", "sender_email": "issuer"}
+        with patch.object(arrow, "now", return_value=NOW):
+            bot.on_message(dict(trigger, content="PingBot 1h",
+                                display_recipient="some stream"))
+            self.assertTrue(wait_for(
+                lambda: bot.scan_cache.get_stats()["misses"] == 1))
+            bot.on_message(dict(trigger, display_recipient="other stream",
+                                content="PingBot 1h in "
+                                        "#**some stream>some subject**"))
+            self.assertTrue(wait_for(
+                lambda: bot.scan_cache.get_stats()["coalesced"] == 1))
+            release.set()
+            self.assertTrue(wait_for(lambda: len(sent) == 2))
+
+        self.assertEqual(bot.scan_cache.get_stats()["misses"], 1)
+        self.assertEqual(sent[0]["content"].split("\n")[1],
+                         sent[1]["content"].split("\n")[1])
+
+    def test_pooled_client_event_queue(self):
+
+        server = FakeZulipServer(poll_timeout=0.1).start()
+        try:
+            server.generate(msgs_per_stream=50, topics=1, senders=10)
+            bot = pinging_bot.PingingBot(
+                "pinging-bot@students.hackerschool.com", "key", "PingingBot",
+                "PingBot", ["stream 0"], site=server.url, pooled_client=True,
+                workers=1)
+            bot.dispatcher.start()
+            bot.event_queue.start(bot.on_event)
+
+            # the event queue is registered again if Zulip forgets it
+            self.assertTrue(wait_for(
+                lambda: bot.event_queue.queue_id is not None))
+            server.queues.clear()
+            self.assertTrue(wait_for(
+                lambda: server.calls.get("/v1/register") == 2 and
+                server.queues))
+
+            server.post_message("stream 0", "topic 0", "me@example.com",
+                                "PingBot 2")
+            self.assertTrue(wait_for(
+                lambda: server.msgs[-1]["content"] != "PingBot 2"))
+            bot.event_queue.stop()
+        finally:
+            server.stop()
+
+        reply = server.msgs[-1]
+        self.assertEqual(reply["sender_email"],
+                         "pinging-bot@students.hackerschool.com")
+        self.assertEqual(reply["content"].count("@**"), 2)
+        self.assertEqual(server.calls["/v1/register"], 2)
+
+    def test_metrics(self):
+
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.inc("pings_total", kind="time")
+        metrics.inc("pings_total", 2, kind="time")
+        metrics.observe("stage_seconds", 0.5, stage="send")
+        metrics.observe("stage_seconds", 5, stage="send")
+        metrics.inc("msgs_total", stream='say "hi"\\\n')
+        metrics.add_collector(lambda: {"queue_depth": 3})
+
+        server = metrics.serve(0)
+        try:
+            response = requests.get("http://127.0.0.1:%d/metrics" %
+                                    server.server_address[1])
+        finally:
+            server.shutdown()
+
+        self.assertEqual(response.text.splitlines(), [
+            '# TYPE msgs_total counter',
+            'msgs_total{stream="say \\"hi\\"\\\\\\n"} 1',
+            '# TYPE pings_total counter',
+            'pings_total{kind="time"} 3',
+            '# TYPE stage_seconds histogram',
+            'stage_seconds_bucket{stage="send",le="0.1"} 0',
+            'stage_seconds_bucket{stage="send",le="1"} 1',
+            'stage_seconds_bucket{stage="send",le="+Inf"} 2',
+            'stage_seconds_sum{stage="send"} 5.5',
+            'stage_seconds_count{stage="send"} 2',
+            '# TYPE queue_depth gauge',
+            'queue_depth 3'])
+
+        profiler = SlowPingProfiler(rate=1, keep=1)
+        self.assertEqual(profiler.run("ping", sum, [1, 2]), 3)
+        self.assertEqual(profiler.slowest[0][1], "ping")
+
+    def test_snapshot_warm_start(self):
+
+        server_msgs = make_msgs(15)
+        for msg in server_msgs:
+            msg["type"] = "stream"
+
+        path = tempfile.mktemp(suffix=".jsonl")
+        try:
+            bot = make_bot(participant_index=ParticipantIndex())
+            bot.participant_index.start(server_msgs[0]["timestamp"])
+            for msg in server_msgs[:10]:
+                bot.participant_index.add(msg)
+            bot.snapshot = Snapshot(path)
+            bot.save_snapshot()
+
+            # five messages were sent while the bot was restarting
+            restarted = make_bot(participant_index=ParticipantIndex(),
+                                 snapshot=Snapshot(path),
+                                 subscribed_streams=["some stream"],
+                                 _get_msgs_chunk=fake_chunks(server_msgs),
+                                 client=Mock())
+            # events are listened to before catching up
+            chunks_fetched = []
+            restarted.client.register.side_effect = lambda **kwargs: (
+                chunks_fetched.append(restarted._get_msgs_chunk.call_count)
+                or {"result": "success", "queue_id": "q1",
+                    "last_event_id": -1})
+            with patch.object(arrow, "now", return_value=NOW):
+                since = restarted.warm_start()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.assertEqual(since, server_msgs[0]["timestamp"])
+        # the index is the same as if the bot never stopped
+        for msg in server_msgs[10:]:
+            bot.participant_index.add(msg)
+        self.assertEqual(restarted.participant_index.dump(),
+                         bot.participant_index.dump())
+        self.assertEqual(restarted._get_msgs_chunk.call_count, 1)
+        self.assertEqual(chunks_fetched, [0])
+        self.assertEqual(restarted.client_queue,
+                         {"queue_id": "q1", "last_event_id": -1})
+
+    def test_snapshot_after_resize(self):
+
+        names = ["stream %d" % i for i in range(1000)]
+        moved = [name for name in names if HashRing(4).shard_of(name) == 3
+                 and HashRing(3).shard_of(name) == 0][0]
+        kept = [name for name in names if HashRing(4).shard_of(name) == 0][0]
+        msgs = make_msgs(10)
+        saved_at = msgs[5]["timestamp"]
+
+        path = tempfile.mktemp(suffix=".jsonl")
+        try:
+            bot = make_bot(participant_index=ParticipantIndex(),
+                           snapshot=Snapshot(path), ring=HashRing(4))
+            bot.participant_index.start(msgs[0]["timestamp"])
+            with patch.object(arrow, "now", return_value=arrow.get(saved_at)):
+                bot.save_snapshot()
+
+            # the stream was indexed by shard 3, it moved to shard 0
+            restarted = make_bot(participant_index=ParticipantIndex(),
+                                 snapshot=Snapshot(path), ring=HashRing(3),
+                                 subscribed_streams=[moved, kept],
+                                 _get_msgs_chunk=fake_chunks(msgs))
+            with patch.object(arrow, "now", return_value=NOW):
+                since = restarted.warm_start()
+                restarted.participant_index.start(since)
+                participants = restarted.get_participants_since(
+                    arrow.get(msgs[1]["timestamp"]), moved, "some subject",
+                    "Name0")
+                restarted.save_snapshot()
+            header, _ = Snapshot(path).read()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        index = restarted.participant_index
+        self.assertEqual(since, msgs[0]["timestamp"])
+        self.assertTrue(index.covers(msgs[1]["timestamp"], kept))
+        self.assertFalse(index.covers(msgs[1]["timestamp"], moved))
+        self.assertTrue(index.covers(saved_at, moved))
+        # senders seen before the snapshot are read from history
+        self.assertEqual(sorted(participants), ["@**Name%d**" % i
+                                                for i in range(1, 7)])
+        self.assertEqual(header["stream_since"], {moved: saved_at})
+
+    def test_client_events(self):
+
+        class Stop(Exception):
+            pass
+
+        bot = make_bot(client=Mock(), client_queue={"queue_id": "q1",
+                                                    "last_event_id": -1})
+        bot.client.register.return_value = {"result": "success",
+                                            "queue_id": "q2",
+                                            "last_event_id": 7}
+        bot.client.get_events.side_effect = [
+            {"result": "success",
+             "events": [{"id": 0, "type": "heartbeat"},
+                        {"id": 1, "type": "message"}]},
+            {"result": "error", "code": "BAD_EVENT_QUEUE_ID"},
+            {"result": "success", "events": [{"id": 8, "type": "stream"}]},
+            Stop()]
+        events = []
+
+        self.assertRaises(Stop, bot._run_client_events, events.append)
+        self.assertEqual(events, [{"id": 1, "type": "message"},
+                                  {"id": 8, "type": "stream"}])
+        self.assertEqual(
+            [call[1] for call in bot.client.get_events.call_args_list],
+            [{"queue_id": "q1", "last_event_id": -1},
+             {"queue_id": "q1", "last_event_id": 1},
+             {"queue_id": "q2", "last_event_id": 7},
+             {"queue_id": "q2", "last_event_id": 8}])
+
+    def test_send_queue(self):
+
+        mentions = " ".join("@**Name%d**" % i for i in range(30))
+        content = "Pinging:\n" + mentions
+        parts = pinging_bot.PingingBot._split_content(content, 100)
+        self.assertTrue(all(len(part) <= 100 for part in parts))
+        self.assertEqual(" ".join(parts).replace("\n", " "),
+                         content.replace("\n", " "))
+        self.assertTrue(all(part.startswith(("Pinging", "@**"))
+                            for part in parts))
+
+        bucket = TokenBucket(rate=1, capacity=5)
+        bucket.update({"X-RateLimit-Remaining": "100",
+                       "X-RateLimit-Reset": str(time.time() + 10)})
+        self.assertAlmostEqual(bucket.rate, 10, places=0)
+
+        # the first attempt fails, the retry is sent
+        deliver = Mock(side_effect=[IOError("connection reset"), None])
+        queue = SendQueue(deliver, bucket, backoff=0)
+        self.assertTrue(queue.put({"to": "stream", "content": "hi"}))
+        queue.flush()
+
+        self.assertEqual(deliver.call_count, 2)
+        stats = queue.get_stats()
+        self.assertEqual((stats["sent"], stats["failed"], stats["retries"]),
+                         (1, 0, 1))
+
+        # rate limited messages are retried, rejected ones are not
+        deliver.side_effect = [SendError("rate limited", retry=True), None,
+                               SendError("invalid stream")]
+        queue.put({"to": "stream", "content": "hi"})
+        queue.put({"to": "nope", "content": "hi"})
+        queue.flush()
+
+        self.assertEqual(deliver.call_count, 5)
+        stats = queue.get_stats()
+        self.assertEqual((stats["sent"], stats["failed"], stats["retries"]),
+                         (2, 1, 2))
+
+    def test_compact_msg(self):
+
+        server_msgs = []
+        for i in range(2):
+            msg = dict(make_msgs(1)[0], id=i + 1, content="x" * 100,
+                       avatar_url="https://example.com/avatar.png")
+            server_msgs.append(msg)
+        data = json.dumps({"result": "success", "messages": server_msgs})
+
+        msgs = json.loads(data, object_hook=CompactMsg.from_json)["messages"]
+        self.assertTrue(all(isinstance(msg, CompactMsg) for msg in msgs))
+        self.assertEqual(msgs[1]["id"], 2)
+        self.assertEqual(msgs[1].sender_full_name, "Name0")
+        self.assertIsNone(msgs[1].get("content"))
+        self.assertEqual(dict(msgs[0]),
+                         {field: server_msgs[0][field]
+                          for field in CompactMsg.FIELDS})
+        # repeated subjects and senders are shared
+        self.assertIs(msgs[0]["subject"], msgs[1]["subject"])
+        self.assertIs(msgs[0]["sender_email"], msgs[1]["sender_email"])
+
+        participants = pinging_bot.PingingBot.get_participants(msgs, "me")
+        self.assertEqual(participants, ["@**Name0**"])
+
+    def test_ping_multiple_sources(self):
+
+        self.assertEqual(
+            self.new_bot.parse_sources(
+                "PingBot 2w in #**some stream>topic a**, #**other** hi"),
+            ([("some stream", "topic a"), ("other", None)], "PingBot 2w hi"))
+        self.assertEqual(self.new_bot.parse_sources("PingBot in #**s**"),
+                         ([("s", None)], "PingBot"))
+        self.assertEqual(self.new_bot.parse_sources("PingBot 2w in a bit"),
+                         (None, "PingBot 2w in a bit"))
+
+        server_msgs = make_msgs(10, "topic a") + make_msgs(10, "topic b",
+                                                           start_id=11)
+        server_msgs[-1].update(sender_full_name="Only in b", sender_id=99)
+        chunks = fake_chunks(server_msgs)
+        release = threading.Event()
+
+        def get_msgs_chunk(chunk_size, stream, anchor, subject=None):
+            if stream == "slow stream":
+                release.wait(5)
+            return chunks(chunk_size, stream, anchor, subject)
+
+        bot = make_bot(_get_msgs_chunk=get_msgs_chunk, SOURCE_TIMEOUT=0.5)
+        sources = [("some stream", "topic a"), ("slow stream", None),
+                   ("some stream", "topic b"), ("some stream", "topic a")]
+        with patch.object(arrow, "now", return_value=NOW):
+            participants, failed = bot.get_participants_from(
+                sources, bot.get_participants_since, NOW.replace(days=-1),
+                "Name0")
+        release.set()
+
+        self.assertEqual(failed, [("slow stream", None)])
+        self.assertEqual(len(participants), 7)
+        self.assertEqual(participants[-1], "@**Only in b**")
+
+        # private streams can only be pinged from themselves
+        sent = []
+        bot = make_bot(_get_msgs_chunk=chunks, send_message=sent.append,
+                       private_streams=frozenset(["secret"]))
+        trigger = {"type": "stream", "display_recipient": "other stream",
+                   "subject": "hi", "sender_full_name": "Name0",
+                   "sender_email": "issuer"}
+        with patch.object(arrow, "now", return_value=NOW):
+            bot._respond(dict(trigger, content="PingBot 1d in #**secret**"))
+            bot._respond(dict(trigger, content="PingBot 1d in #**secret**, "
+                                               "#**some stream>topic a**"))
+        self.assertEqual((sent[0]["type"], sent[0]["to"]),
+                         ("private", "issuer"))
+        self.assertEqual(sent[1]["content"].count("@**"), 6)
+        self.assertIn("#**secret** not pinged", sent[1]["content"])
+
+        # streams are listed if they were not yet, unknown ones are refused
+        bot.private_streams = frozenset()
+        bot.transport = Mock()
+        bot.transport.get.return_value = Mock(
+            status_code=200, headers={},
+            json=lambda: {"streams": [{"name": "secret",
+                                       "invite_only": True},
+                                      {"name": "some stream"}]})
+        bot.stream_cache = StreamCache(bot._fetch_streams)
+        with patch.object(arrow, "now", return_value=NOW):
+            bot._respond(dict(trigger, content="PingBot 1d in #**secret**, "
+                                               "#**unknown**, "
+                                               "#**some stream>topic a**"))
+        self.assertEqual(sent[2]["content"].count("@**"), 6)
+        self.assertIn("#**secret**, #**unknown** not pinged",
+                      sent[2]["content"])
+
+        # the participant index answers for every topic of a stream
+        index = ParticipantIndex()
+        for msg in server_msgs:
+            index.add(dict(msg, type="stream"))
+        self.assertEqual(sorted(index.get_last("some stream", None, 2)),
+                         ["Name2", "Only in b"])
+        self.assertEqual(len(index.get_since("some stream", None, 0)), 8)
+
+    def test_id_index_window_scan(self):
+
+        server = FakeZulipServer().start()
+        try:
+            server.generate(msgs_per_stream=2000, topics=2, days=10)
+            bot = pinging_bot.PingingBot(
+                "pinging-bot@students.hackerschool.com", "key", "PingingBot",
+                "PingBot", ["stream 0"], site=server.url)
+            bot.RANGE_WORKERS = 3
+
+            # one point every 100 messages, as if learned from pages
+            points = [(msg["id"], msg["timestamp"])
+                      for msg in server.msgs[::100]]
+            bot.id_index.load({"stream 0": points})
+            since = server.msgs[1000]["timestamp"]
+            self.assertEqual(bot.id_index.floor("stream 0", since),
+                             points[10])
+
+            now = arrow.get(server.msgs[-1]["timestamp"])
+            with patch.object(arrow, "now", return_value=now):
+                msgs = bot.get_msgs(arrow.get(since), "stream 0", "topic 0")
+                fetched = bot.last_fetch_stats["fetched"]
+                pool = bot.range_pool
+                threads = threading.active_count()
+
+                # the ranges of every scan are retrieved by the same threads
+                bot.get_msgs(arrow.get(since), "stream 0", "topic 1")
+                self.assertIs(bot.range_pool, pool)
+                self.assertEqual(threading.active_count(), threads)
+
+                # a cold (or short) history cache is filled going forward
+                bot.history = HistoryCache()
+                bot._get_msgs_chunk = Mock(wraps=bot._get_msgs_chunk)
+                cached = bot.get_msgs(arrow.get(since), "stream 0", "topic 0")
+                wider_since = server.msgs[500]["timestamp"]
+                wider = bot.get_msgs(arrow.get(wider_since), "stream 0",
+                                     "topic 0")
+                forward = [call[1].get("forward") for call in
+                           bot._get_msgs_chunk.call_args_list]
+        finally:
+            server.stop()
+
+        self.assertEqual(cached, msgs)
+        self.assertEqual([msg["id"] for msg in wider],
+                         [msg["id"] for msg in server.msgs
+                          if msg["subject"] == "topic 0" and
+                          msg["timestamp"] > wider_since])
+        # only the latest messages are asked backwards, once per ping
+        self.assertTrue(forward[0])
+        self.assertEqual(forward.count(None), 2)
+
+        expected = [msg["id"] for msg in server.msgs
+                    if msg["subject"] == "topic 0" and
+                    msg["timestamp"] > since]
+        self.assertEqual([msg["id"] for msg in msgs], expected)
+        # only the window is retrieved, not the 1000 messages before it
+        self.assertLess(fetched, len(expected) * 1.5)
+
+        index = IdIndex(max_points=4)
+        index.load(bot.id_index.dump())
+        self.assertLessEqual(len(index.dump()["stream 0"]), 4)
+        self.assertEqual(index.dump()["stream 0"][-1],
+                         bot.id_index.dump()["stream 0"][-1])
+
+    def test_sharding(self):
+
+        names = ["stream %d" % i for i in range(1000)]
+        three = [HashRing(3).shard_of(name) for name in names]
+        four = [HashRing(4).shard_of(name) for name in names]
+
+        self.assertTrue(all(three.count(shard) > 200 for shard in range(3)))
+        # adding a shard only moves streams to the new one
+        moved = [(before, after) for before, after in zip(three, four)
+                 if before != after]
+        self.assertTrue(all(after == 3 for _, after in moved))
+        self.assertLess(len(moved), 400)
+
+        bots = [make_bot(ring=HashRing(3), shard=shard, key_word="pingbot",
+                         short_key_word="pingbot",
+                         participant_index=ParticipantIndex())
+                for shard in range(3)]
+        for msg in make_msgs(10):
+            msg.update(type="stream", display_recipient="stream 7",
+                       content="hi")
+            for bot in bots:
+                bot.on_message(msg)
+        indexed = [len(bot.participant_index.topics) for bot in bots]
+        self.assertEqual(indexed[three[7]], 1)
+        self.assertEqual(sum(indexed), 1)
+
+        # streams of other shards are not in the index, history is read
+        bot = bots[three[7]]
+        bot.participant_index.start(0)
+        other = names[three.index((three[7] + 1) % 3)]
+        bot._get_msgs_chunk = fake_chunks(make_msgs(10))
+        with patch.object(arrow, "now", return_value=NOW):
+            participants, _ = bot.get_participants_from(
+                [("stream 7", None), (other, None)],
+                bot.get_participants_since, NOW.replace(hours=-1), "Name0")
+        self.assertEqual(len(participants), 6)
+        self.assertEqual(bot._get_msgs_chunk.call_args[0][1], other)
+
+        # workers that die are restarted
+        supervisor = Supervisor(2, lambda shard, shards: None,
+                                restart_wait=0)
+        supervisor.start()
+        try:
+            for process, _ in supervisor.workers.values():
+                process.join(5)
+            supervisor.check()
+            self.assertEqual(supervisor.restarts, {0: 1, 1: 1})
+            supervisor.resize(3)
+            self.assertEqual(sorted(supervisor.workers), [0, 1, 2])
+        finally:
+            supervisor.stop()
+
+    def test_preview_confirm(self):
+
+        old_msgs = [{"id": i, "timestamp": NOW.replace(days=-40).timestamp,
+                     "subject": "some subject", "sender_id": 10 + i,
+                     "sender_full_name": "Old%d" % i,
+                     "sender_email": "an email"}
+                    for i in range(1, 6)]
+        chunks = fake_chunks(old_msgs + make_msgs(50, start_id=6))
+        sent = []
+        bot = make_bot(key_word="pingbot", short_key_word="pb",
+                       _get_msgs_chunk=chunks, send_message=sent.append,
+                       participant_index=ParticipantIndex(),
+                       preview_cache=PreviewCache())
+
+        def command(content, msg_type="private"):
+            bot.on_message({"id": 100, "type": msg_type, "content": content,
+                            "timestamp": NOW.timestamp,
+                            "display_recipient": "some stream",
+                            "subject": "some subject",
+                            "sender_full_name": "Name0",
+                            "sender_email": "issuer email",
+                            "sender_id": 0})
+            return sent[-1]
+
+        with patch.object(arrow, "now", return_value=NOW):
+            preview = command("PingBot preview 2h see this", "stream")
+            self.assertEqual(preview["type"], "private")
+            self.assertEqual(preview["to"], "issuer email")
+            self.assertIn("(6 participants)", preview["content"])
+            token = preview["content"].split("`")[1]
+
+            preview = command("PingBot exclude %s @**Name1**, name2" % token)
+            self.assertIn("(4 participants)", preview["content"])
+            self.assertNotIn("**Name1**", preview["content"])
+
+            # only messages older than the ones scanned are retrieved
+            calls = chunks.call_count
+            preview = command("PingBot extend %s 2m" % token)
+            self.assertIn("(9 participants)", preview["content"])
+            self.assertTrue(all(call[0][2] <= 6 for call in
+                                chunks.call_args_list[calls:]))
+
+            calls = chunks.call_count
+            ping = command("PingBot confirm %s" % token)
+
+        self.assertEqual(chunks.call_count, calls)
+        self.assertEqual((ping["type"], ping["to"], ping["subject"]),
+                         ("stream", "some stream", "some subject"))
+        self.assertIn("@**Old5** ", ping["content"])
+        self.assertNotIn("Name1", ping["content"])
+        self.assertIn("see this", ping["content"])
+
+        self.assertIn("unknown or expired",
+                      command("PingBot confirm %s" % token)["content"])
+
+        # previews are asked for in the topic to ping
+        error = command("PingBot preview")
+        self.assertEqual((error["type"], error["to"]),
+                         ("private", "issuer email"))
+        self.assertIn("only be asked for in the topic", error["content"])
+
+        # words that are not tokens make a normal ping
+        with patch.object(arrow, "now", return_value=NOW):
+            ping = command("PingBot confirm attendance please", "stream")
+        self.assertEqual(ping["type"], "stream")
+        self.assertIn("Pinging all participants", ping["content"])
+        self.assertIn("@**Name1**", ping["content"])
+
+    def test_deferred_subscriptions(self):
+
+        grammar = pinging_bot.PingingBot.TIME_GRAMMAR
+        self.assertIs(grammar, pinging_bot.PingingBot.TIME_GRAMMAR)
+
+        # the index is complete only once the streams are subscribed
+        waiting = make_bot(participant_index=ParticipantIndex(),
+                           subscribed=threading.Event())
+        waiting._start_index_in_background()
+        time.sleep(0.05)
+        self.assertIsNone(waiting.participant_index.since)
+        waiting.subscribed.set()
+        self.assertTrue(wait_for(
+            lambda: waiting.participant_index.since is not None))
+
+        # and once the snapshot is caught up, which does not delay events
+        caught_up = threading.Event()
+        waiting = make_bot(participant_index=ParticipantIndex(),
+                           subscribed=waiting.subscribed)
+        waiting._catch_up = lambda header: caught_up.wait(5) and \
+            header["since"]
+        waiting._start_index_in_background({"since": 1})
+        time.sleep(0.05)
+        self.assertIsNone(waiting.participant_index.since)
+        caught_up.set()
+        self.assertTrue(wait_for(
+            lambda: waiting.participant_index.since == 1))
+
+        server = FakeZulipServer(poll_timeout=1).start()
+        try:
+            server.generate(streams=250, msgs_per_stream=1)
+            bot = pinging_bot.PingingBot(
+                "pinging-bot@students.hackerschool.com", "key", "PingingBot",
+                "PingBot", site=server.url, pooled_client=True,
+                defer_subscriptions=True)
+            self.assertNotIn("/v1/users/me/subscriptions", server.calls)
+            batches = -(-250 // bot.SUBSCRIBE_BATCH)
+
+            # events are received while the streams are being subscribed
+            received = threading.Event()
+            bot.on_event = lambda event: received.set()
+            thread = threading.Thread(target=bot.main)
+            thread.daemon = True
+            thread.start()
+            for _ in range(500):
+                server.post_message("stream 0", "topic 0", "User 0", "hi")
+                if received.wait(0.01):
+                    break
+
+            self.assertTrue(received.is_set())
+            # the index is not complete until every stream is subscribed
+            self.assertTrue(bot.participant_index.since is None or
+                            bot.subscribed.is_set())
+            self.assertTrue(bot.subscribed.wait(10))
+            self.assertTrue(wait_for(
+                lambda: bot.participant_index.since is not None))
+            self.assertEqual(server.calls["/v1/users/me/subscriptions"],
+                             batches)
+            self.assertEqual(bot.failed_subscriptions, [])
+            bot.event_queue.stop()
+        finally:
+            server.stop()
+
 
 if __name__ == '__main__':
     nose.run(defaultTest=__name__)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ZulipTransport():
+
+    """ Shared HTTP session used for every call to the Zulip REST API.
+
+        Connections are pooled and kept alive between calls, responses are
+        asked gzipped, and calls failing with 429 (rate limited) or 5xx are
+        retried with exponential backoff, honoring the Retry-After header
+        (calls that must not be repeated, like sending a message, pass
+        retries=0).
+        Latency and bytes received are recorded per endpoint.
+
+        Attributes:
+            base_url: Zulip API url the endpoints are relative to.
+            timeout: Seconds to wait for the server before giving up.
+            retries: Times a failing call is retried.
+            backoff: Seconds waited before the first retry (then doubled).
+            stats: Per endpoint calls, errors, retries, seconds and bytes.
+    """
+
+    API_URL = "https://api.zulip.com/v1"
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    MAX_RETRY_AFTER = 60  # maximum seconds waited because of Retry-After
+
+    def __init__(self, username, api_key, base_url=API_URL, pool_size=10,
+                 timeout=30, retries=3, backoff=0.5):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.auth = (username, api_key)
+        self.session.headers.update({"Accept-Encoding": "gzip",
+                                     "Connection": "keep-alive"})
+
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, params=None, **kwargs):
+        """ GET a Zulip API endpoint (e.g. "messages"). """
+
+        return self.request("GET", endpoint, params=params, **kwargs)
+
+    def post(self, endpoint, data=None, **kwargs):
+        """ POST to a Zulip API endpoint (e.g. "users/me/subscriptions"). """
+
+        return self.request("POST", endpoint, data=data, **kwargs)
+
+    def request(self, method, endpoint, **kwargs):
+        """ Call a Zulip API endpoint retrying rate limits and server errors.
+
+        Args:
+            method: HTTP method ("GET", "POST", etc.).
+            endpoint: Path of the endpoint relative to base_url.
+            kwargs: Other arguments passed to requests (params, data, etc.),
+                and retries to override the times the call is retried.
+
+        Returns:
+            The last response received (the caller checks its status code).
+        """
+
+        url = "/".join([self.base_url, endpoint.lstrip("/")])
+        kwargs.setdefault("timeout", self.timeout)
+        retries = kwargs.pop("retries", self.retries)
+
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(endpoint, time.time() - start, 0, error=True)
+                if attempt >= retries:
+                    raise
+                response = None
+
+            if response is not None:
+                self._record(endpoint, time.time() - start,
+                             len(response.content),
+                             error=response.status_code >= 400)
+
+                if (response.status_code not in self.RETRY_STATUS or
+                        attempt >= retries):
+                    return response
+
+            time.sleep(self._retry_wait(response, attempt))
+            self._record_retry(endpoint)
+            attempt += 1
+
+    def _retry_wait(self, response, attempt):
+        """ Seconds to wait before retrying a failed call. """
+
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+
+        try:
+            return min(float(retry_after), self.MAX_RETRY_AFTER)
+        except (TypeError, ValueError):
+            return self.backoff * 2 ** attempt
+
+    def _endpoint_stats(self, endpoint):
+        return self.stats.setdefault(endpoint, {"calls": 0, "errors": 0,
+                                                "retries": 0, "seconds": 0.0,
+                                                "bytes": 0})
+
+    def _record(self, endpoint, seconds, num_bytes, error=False):
+        with self.lock:
+            stats = self._endpoint_stats(endpoint)
+            stats["calls"] += 1
+            stats["errors"] += 1 if error else 0
+            stats["seconds"] += seconds
+            stats["bytes"] += num_bytes
+
+    def _record_retry(self, endpoint):
+        with self.lock:
+            self._endpoint_stats(endpoint)["retries"] += 1
+
+    def get_stats(self):
+        """ Return a copy of the per endpoint stats with mean latency. """
+
+        with self.lock:
+            stats = {endpoint: dict(values)
+                     for endpoint, values in self.stats.items()}
+
+        for values in stats.values():
+            values["mean_seconds"] = values["seconds"] / (values["calls"] or 1)
+
+        return stats
+
+    def export_stats(self, path):
+        """ Write the per endpoint stats to a JSON file. """
+
+        with open(path, "w") as f:
+            json.dump(self.get_stats(), f, indent=1, sort_keys=True)